@@ -0,0 +1,297 @@
+"""
+A compact log of everything that happens to the world during a run,
+so runs can be replayed (to reproduce bugs) and compared.
+
+The log is an append-only binary file.  After the file header, it is
+a list of records, each with a small header:
+
+    +----------+-----------+----------------+------------------+
+    | type (1) | tick (4)  | length (4)     | payload (length) |
+    +----------+-----------+----------------+------------------+
+
+(little endian, the payload is marshalled).  The record types are:
+
+1. REC_STRINGS: new entries for the string table.  Every subject ID,
+   key, action and string value is written once and then referred to
+   by its index in the table.
+2. REC_SNAPSHOT: the whole world, as it is at the START of the tick.
+   One is written every snapshotInterval ticks.
+3. REC_ACTION: a call to WorldState.ExecuteAction (agent, action,
+   subject) and the changes to the facts it made.  Each change is
+   (subject, key, op, value), where op is one of OP_SET,
+   OP_SET_STRING (the value is in the string table), OP_SET_LIST or
+   OP_SET_TUPLE (a list or tuple of strings, as string table
+   indexes) or OP_DELETE.
+
+To get the world at the end of any tick, the reader loads the last
+snapshot at or before it, then applies the changes of the actions up
+to that tick.  The changes are applied straight to the fact
+dictionaries (the actions are not run again), so replay does not
+depend on the rules in ExecuteAction staying the same.
+
+NOTE:
+1.  Only changes made through EventLogWriter.ExecuteAction are logged.
+    Anything else that changes the world (e.g. adding an agent after
+    the first tick) needs a new snapshot (WriteSnapshot).
+2.  An action's changes are worked out by comparing the facts of the
+    subjects it can touch (the agent, the subject of the action and
+    the target of an activator) before and after it runs.
+"""
+
+import marshal
+import os
+import struct
+
+from GOAP_Spaceship_Sim import WorldState, kActivatorTarget
+
+LOG_MAGIC = "GOAPLOG1"
+RECORD_HEADER = struct.Struct("<BII")
+
+REC_STRINGS = 1
+REC_SNAPSHOT = 2
+REC_ACTION = 3
+
+OP_SET = 0
+OP_SET_STRING = 1
+OP_SET_LIST = 2
+OP_SET_TUPLE = 3
+OP_DELETE = 4
+
+DEFAULT_SNAPSHOT_INTERVAL = 1000
+
+
+class EventLogWriter(object):
+    def __init__(self, fileName, snapshotInterval=DEFAULT_SNAPSHOT_INTERVAL):
+        self.fileName = fileName
+        self.snapshotInterval = snapshotInterval
+        self.logFile = open(fileName, "wb")
+        self.logFile.write(LOG_MAGIC)
+        self.strings = {}
+        self.newStrings = []
+        self.tick = 0
+        self.lastSnapshotTick = None
+        # Counters.
+        self.actionCount = 0
+        self.snapshotCount = 0
+
+    def StringCode(self, text):
+        code = self.strings.get(text)
+        if code is None:
+            code = len(self.strings)
+            self.strings[text] = code
+            self.newStrings.append(text)
+        return code
+
+    def EncodeFact(self, sid, key, value):
+        op = OP_SET
+        if isinstance(value, basestring):
+            op = OP_SET_STRING
+            value = self.StringCode(value)
+        elif isinstance(value, (list, tuple)) and all(isinstance(item, basestring) for item in value):
+            op = OP_SET_LIST if isinstance(value, list) else OP_SET_TUPLE
+            value = tuple(self.StringCode(item) for item in value)
+        return (self.StringCode(sid), self.StringCode(key), op, value)
+
+    def WriteRecord(self, recordType, payload):
+        # Strings have to be in the log before the record using them.
+        if len(self.newStrings) > 0:
+            data = marshal.dumps(self.newStrings)
+            self.logFile.write(RECORD_HEADER.pack(REC_STRINGS, self.tick, len(data)))
+            self.logFile.write(data)
+            self.newStrings = []
+        data = marshal.dumps(payload)
+        self.logFile.write(RECORD_HEADER.pack(recordType, self.tick, len(data)))
+        self.logFile.write(data)
+
+    # Called at the start of every tick, before any actions.  Writes a
+    # snapshot if it is time for one.
+    def BeginTick(self, tick, worldState):
+        self.tick = tick
+        if self.lastSnapshotTick is None or tick - self.lastSnapshotTick >= self.snapshotInterval:
+            self.WriteSnapshot(worldState)
+
+    def WriteSnapshot(self, worldState):
+        stateDict = worldState.worldState
+        facts = []
+        for sid in stateDict:
+            for key, value in stateDict[sid].iteritems():
+                facts.append(self.EncodeFact(sid, key, value))
+        self.WriteRecord(REC_SNAPSHOT, facts)
+        self.lastSnapshotTick = self.tick
+        self.snapshotCount += 1
+
+    # Run the action on the world and log it with the changes it made.
+    def ExecuteAction(self, worldState, agentID, action, actionSubjectID):
+        stateDict = worldState.worldState
+        sids = [agentID, actionSubjectID]
+        target = stateDict[actionSubjectID].get(kActivatorTarget)
+        if target is not None:
+            sids.append(target)
+        before = [(sid, stateDict[sid].copy()) for sid in sids]
+        worldState.ExecuteAction(agentID, action, actionSubjectID)
+        deltas = []
+        for sid, oldFacts in before:
+            newFacts = stateDict[sid]
+            for key, value in newFacts.iteritems():
+                if key not in oldFacts or oldFacts[key] != value:
+                    deltas.append(self.EncodeFact(sid, key, value))
+            for key in oldFacts:
+                if key not in newFacts:
+                    deltas.append((self.StringCode(sid), self.StringCode(key), OP_DELETE, None))
+        self.WriteRecord(REC_ACTION, (self.StringCode(agentID), self.StringCode(action),
+                                      self.StringCode(actionSubjectID), deltas))
+        self.actionCount += 1
+
+    def Close(self):
+        self.logFile.close()
+
+
+class EventLogReader(object):
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.strings = []
+        # (tick, offset) of every snapshot, in order.
+        self.snapshots = []
+        self.lastTick = 0
+        self.actionCount = 0
+        self.ReadIndex()
+
+    # Skim the log: read the string table and find the snapshots.  Only
+    # the record headers of everything else are read.
+    def ReadIndex(self):
+        with open(self.fileName, "rb") as logFile:
+            if logFile.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                raise ValueError("%s is not an event log." % self.fileName)
+            while True:
+                offset = logFile.tell()
+                header = logFile.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                recordType, tick, length = RECORD_HEADER.unpack(header)
+                if recordType == REC_STRINGS:
+                    self.strings.extend(marshal.loads(logFile.read(length)))
+                    continue
+                if recordType == REC_SNAPSHOT:
+                    self.snapshots.append((tick, offset))
+                elif recordType == REC_ACTION:
+                    self.actionCount += 1
+                logFile.seek(length, os.SEEK_CUR)
+                self.lastTick = max(self.lastTick, tick)
+
+    # The snapshot to start from to get to the tick.
+    def FindSnapshot(self, tick):
+        if len(self.snapshots) == 0 or tick < self.snapshots[0][0]:
+            raise ValueError("%s does not have a snapshot at or before tick %d." % (self.fileName, tick))
+        index = len(self.snapshots) - 1
+        while self.snapshots[index][0] > tick:
+            index -= 1
+        return index
+
+    # Read the records from a snapshot up to (and including) the tick,
+    # in one go.  Everything for the tick is before the next snapshot,
+    # so the file is only read up to there.  Yields (recordType, tick,
+    # payload).
+    def ReadRecords(self, index, lastTick):
+        offset = self.snapshots[index][1]
+        endIndex = index + 1
+        while endIndex < len(self.snapshots) and self.snapshots[endIndex][0] <= lastTick:
+            endIndex += 1
+        with open(self.fileName, "rb") as logFile:
+            logFile.seek(offset)
+            if endIndex < len(self.snapshots):
+                data = logFile.read(self.snapshots[endIndex][1] - offset)
+            else:
+                data = logFile.read()
+        position = 0
+        headerSize = RECORD_HEADER.size
+        while position + headerSize <= len(data):
+            recordType, tick, length = RECORD_HEADER.unpack_from(data, position)
+            if tick > lastTick:
+                break
+            position += headerSize
+            if recordType != REC_STRINGS:
+                yield recordType, tick, marshal.loads(data[position:position + length])
+            position += length
+
+    # The world state dictionary at the end of the tick.
+    def Seek(self, tick):
+        strings = self.strings
+        stateDict = None
+        for recordType, recordTick, payload in self.ReadRecords(self.FindSnapshot(tick), tick):
+            if recordType == REC_SNAPSHOT:
+                stateDict = {}
+                facts = payload
+            else:
+                facts = payload[3]
+            for sidCode, keyCode, op, value in facts:
+                sid = strings[sidCode]
+                if op == OP_DELETE:
+                    del stateDict[sid][strings[keyCode]]
+                else:
+                    if op == OP_SET_STRING:
+                        value = strings[value]
+                    elif op == OP_SET_LIST:
+                        value = [strings[code] for code in value]
+                    elif op == OP_SET_TUPLE:
+                        value = tuple(strings[code] for code in value)
+                    stateDict.setdefault(sid, {})[strings[keyCode]] = value
+        return stateDict
+
+    def CreateWorldState(self, tick):
+        worldState = WorldState()
+        worldState.worldState = self.Seek(tick)
+        return worldState
+
+    # The actions between two ticks (inclusive), as
+    # (tick, agentID, action, actionSubjectID).
+    def GetActions(self, startTick, endTick):
+        strings = self.strings
+        result = []
+        index = self.FindSnapshot(max(startTick, self.snapshots[0][0]))
+        for recordType, tick, payload in self.ReadRecords(index, endTick):
+            if recordType == REC_ACTION and tick >= startTick:
+                agentCode, actionCode, subjectCode, deltas = payload
+                result.append((tick, strings[agentCode], strings[actionCode], strings[subjectCode]))
+        return result
+
+
+if __name__ == "__main__":
+    import argparse
+    import copy
+    import time
+    from Simulation import Simulation
+    from GOAP_Spaceship_Sim import kIsActivated, sidShuttleLaunch, cRoom1, cRoom2
+
+    parser = argparse.ArgumentParser(description="Record a simulation run and replay it.")
+    parser.add_argument("--agents", type=int, default=200)
+    parser.add_argument("--ticks", type=int, default=36000)
+    parser.add_argument("--snapshot-interval", type=int, default=DEFAULT_SNAPSHOT_INTERVAL)
+    parser.add_argument("--log", default="simulation.goaplog")
+    args = parser.parse_args()
+
+    writer = EventLogWriter(args.log, args.snapshot_interval)
+    simulation = Simulation(WorldState(), eventLog=writer)
+    goalList = [(sidShuttleLaunch, kIsActivated, True)]
+    for idx in xrange(args.agents):
+        simulation.AddAgent("Agent %d" % (idx + 1), [cRoom1, cRoom2][idx % 2], goalList)
+    # Keep a copy of the world at a few ticks to check the replay.
+    checkTicks = set([1, 2, 3, 5, 8, 13, 21, args.ticks // 2, args.ticks])
+    expected = {}
+    start = time.time()
+    for idx in xrange(args.ticks):
+        simulation.Tick()
+        if simulation.tick in checkTicks:
+            expected[simulation.tick] = copy.deepcopy(simulation.worldState.worldState)
+    writer.Close()
+    print "Recorded %d ticks, %d actions, %d snapshots in %.3f s (%d bytes)" % (
+        args.ticks, writer.actionCount, writer.snapshotCount, time.time() - start,
+        os.path.getsize(args.log))
+
+    start = time.time()
+    reader = EventLogReader(args.log)
+    print "Read the index in %.3f ms" % ((time.time() - start) * 1000.0)
+    for tick in sorted(expected):
+        start = time.time()
+        stateDict = reader.Seek(tick)
+        print "Seek to tick %6d: %.3f ms  %s" % (tick, (time.time() - start) * 1000.0,
+                                                 "OK" if stateDict == expected[tick] else "DIFFERENT")
@@ -0,0 +1,163 @@
+"""
+A compact, column oriented store for world state facts.
+
+The WorldState keeps its facts as a dictionary of dictionaries, keyed
+by subject ID and then by key.  That is convenient for the planner,
+but building it one assignment at a time is very slow for large maps.
+
+The FactTable holds the same (subjectID, key, value) triples in
+pre-sized arrays.  Facts are added a whole column at a time (one key
+for many subjects).  Once all the facts are loaded, the table is
+frozen and the per subject dictionaries are built once, in a single
+pass.  A frozen table can be shared by any number of WorldStates;
+each one gets its own (shallow) copy of the subject dictionaries.
+
+NOTE:
+1.  Values in a frozen table are shared between every world state
+    created from it.  They must be treated as immutable (replace a
+    list, do not append to it).
+"""
+
+import numpy
+
+
+class FactTable(object):
+    # The default number of facts to reserve space for.
+    DEFAULT_CAPACITY = 1024
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        # Subject IDs and keys are stored as integer codes.  These
+        # are the tables to go back and forth between them.
+        self.subjects = []
+        self.subjectIndex = {}
+        self.keys = []
+        self.keyIndex = {}
+        # The facts themselves.  Only the first "count" entries
+        # are valid.
+        self.count = 0
+        self.sidCodes = numpy.zeros(capacity, dtype=numpy.int32)
+        self.keyCodes = numpy.zeros(capacity, dtype=numpy.int16)
+        self.values = numpy.empty(capacity, dtype=object)
+        # Built when the table is frozen.
+        self.frozen = False
+        self.stateDict = None
+
+    # Make sure there is room for at least "count" more facts.  The
+    # arrays grow by doubling so bulk loads do not resize often.
+    def Reserve(self, count):
+        needed = self.count + count
+        capacity = len(self.values)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity = max(capacity * 2, 1)
+        self.sidCodes = numpy.resize(self.sidCodes, capacity)
+        self.keyCodes = numpy.resize(self.keyCodes, capacity)
+        values = numpy.empty(capacity, dtype=object)
+        values[:self.count] = self.values[:self.count]
+        self.values = values
+
+    def InternSubject(self, sid):
+        code = self.subjectIndex.get(sid)
+        if code is None:
+            code = len(self.subjects)
+            self.subjects.append(sid)
+            self.subjectIndex[sid] = code
+        return code
+
+    def InternKey(self, key):
+        code = self.keyIndex.get(key)
+        if code is None:
+            code = len(self.keys)
+            self.keys.append(key)
+            self.keyIndex[key] = code
+        return code
+
+    # Reserve space for the facts and fill in the subject and key
+    # codes.  Returns the slice the values should be written to.
+    def AllocateFacts(self, sids, key):
+        if self.frozen:
+            raise ValueError("Cannot add facts to a frozen FactTable.")
+        count = len(sids)
+        self.Reserve(count)
+        start = self.count
+        end = start + count
+        self.sidCodes[start:end] = [self.InternSubject(sid) for sid in sids]
+        self.keyCodes[start:end] = self.InternKey(key)
+        self.count = end
+        return start, end
+
+    # Add the same key for a list of subjects, with one value per
+    # subject.
+    def AddFacts(self, sids, key, values):
+        if len(values) != len(sids):
+            raise ValueError("Expected %d values for key %s, found %d." % (len(sids), key, len(values)))
+        start, end = self.AllocateFacts(sids, key)
+        # Assign one object at a time so that tuple and list values
+        # (room portals, inventories) are not unpacked by numpy.
+        values = list(values)
+        for idx in xrange(start, end):
+            self.values[idx] = values[idx - start]
+
+    # Add the same key and the same value for a list of subjects.
+    def AddConstantFacts(self, sids, key, value):
+        start, end = self.AllocateFacts(sids, key)
+        for idx in xrange(start, end):
+            self.values[idx] = value
+
+    # Add facts in the same (subjectID, key, value) form used by
+    # WorldState.SetDefaultStates.
+    def AddStates(self, states):
+        columns = {}
+        for sid, key, value in states:
+            sids, values = columns.setdefault(key, ([], []))
+            sids.append(sid)
+            values.append(value)
+        for key in columns:
+            sids, values = columns[key]
+            self.AddFacts(sids, key, values)
+
+    # Stop accepting facts and build the per subject dictionaries.
+    # The facts are grouped by subject with a single stable sort, so a
+    # later fact for the same (subject, key) replaces an earlier one.
+    def Freeze(self):
+        if self.frozen:
+            return self
+        count = self.count
+        self.sidCodes = self.sidCodes[:count].copy()
+        self.keyCodes = self.keyCodes[:count].copy()
+        self.values = self.values[:count].copy()
+        for array in (self.sidCodes, self.keyCodes, self.values):
+            array.flags.writeable = False
+
+        order = numpy.argsort(self.sidCodes, kind="mergesort")
+        sortedSids = self.sidCodes[order]
+        keyNames = numpy.array(self.keys, dtype=object)
+        sortedKeys = keyNames[self.keyCodes[order]].tolist()
+        sortedValues = self.values[order].tolist()
+        bounds = [0] + (numpy.flatnonzero(numpy.diff(sortedSids)) + 1).tolist() + [count]
+        stateDict = {}
+        for idx in xrange(len(bounds) - 1):
+            start = bounds[idx]
+            end = bounds[idx + 1]
+            if start == end:
+                continue
+            sid = self.subjects[sortedSids[start]]
+            stateDict[sid] = dict(zip(sortedKeys[start:end], sortedValues[start:end]))
+        self.stateDict = stateDict
+        self.frozen = True
+        return self
+
+    # Create a new world state dictionary from the frozen facts.
+    # Only the subject dictionaries are copied.
+    def CreateStateDict(self):
+        if not self.frozen:
+            self.Freeze()
+        stateDict = self.stateDict
+        return dict((sid, stateDict[sid].copy()) for sid in stateDict)
+
+    def GetSubjectCount(self):
+        return len(self.subjects)
+
+    def GetFactCount(self):
+        return self.count
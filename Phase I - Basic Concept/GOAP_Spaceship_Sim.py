@@ -1,4 +1,8 @@
 import copy
+import itertools
+import time
+
+from PlannerStats import PlannerStats
 
 # For this experiment, the world will be defined as a simple tile map with
 # the map laid out as below:
@@ -70,6 +74,7 @@ kSubjectType = "Subject Type"           # What kind of "thing" is this?
 kIsBeingCarried = "Is Carried By"       # Something that was picked up (game object perspective)
 kIsCarrying = "Is Carrying"             # List of subject IDs
 kAction = "Action"                      # List of actionIDs
+kPowerSource = "Power Source"           # Subject ID of the generator powering this
 
 # These keys define the different types of game objects that exist.
 goDoor = "Access Door"
@@ -88,6 +93,9 @@ gaActivateDoor = "Activate Door"
 gaActivateRADoor = "Activate RA Door"
 gaActivateShuttle = "Activate Shuttle"
 gaActivateShuttleGen = "Activate Shuttle Gen"
+# A learned sequence of the actions above (see MacroActions.py).  The
+# subject ID is the ID of the macro.
+gaMacro = "Macro"
 
 # Subject IDs
 sidAgent = "Agent"
@@ -105,6 +113,12 @@ sidShuttleLaunch = "Shuttle Activator"
 cRoom1 = "Room 1"
 cRoom2 = "Room 2"
 cRoom3 = "Room 3"
+cAgentActions = [gaGoThroughDoor,
+                 gaPickUpObject,
+                 gaActivateDoor,
+                 gaActivateRADoor,
+                 gaActivateShuttle,
+                 gaActivateShuttleGen]
 
 
 # Given an action and the subject type, is the action compatible?
@@ -137,27 +151,6 @@ def IsActionAllowed(action, subjectType):
         return False
     return False
 
-def GetRoomDistanceCost(srcRoom,desRoom):
-    costs = {
-        cRoom1:{
-            cRoom1:0,
-            cRoom2:1,
-            cRoom3:2
-        },
-        cRoom2:{
-            cRoom1:1,
-            cRoom2:0,
-            cRoom3:1
-        },
-        cRoom3:{
-            cRoom1:2,
-            cRoom2:1,
-            cRoom3:0
-        }
-    }
-    return costs[srcRoom][desRoom]
-
-
 def GetActionCost(action):
     if action == gaGoThroughDoor:
         return 1
@@ -174,10 +167,89 @@ def GetActionCost(action):
     return 25
 
 
+# The preconditions of each action, as (link, key, value).  The fact
+# is on the action's subject when link is None, otherwise on the
+# subject named by the subject's link fact (e.g. the door an
+# activator opens).  GetActionPreconditions, the precondition checks
+# and GetActionFactSets are all made from this table.
+cActionPreconditions = {
+    gaGoThroughDoor: [(None, kIsClosed, False)],
+    # The door should be closed before we try to open it.
+    gaActivateDoor: [(kActivatorTarget, kIsClosed, True)],
+    gaActivateRADoor: [(kActivatorTarget, kIsClosed, True)],
+    # There are not any constraints on what can be picked up.
+    gaPickUpObject: [],
+    gaActivateShuttle: [(None, kIsActivated, False), (kPowerSource, kIsPowered, True)],
+    gaActivateShuttleGen: [(None, kIsPowered, False)],
+}
+
+# The procedural preconditions: the subject type the agent has to be
+# carrying to do the action.
+cActionCarriedTypes = {
+    gaActivateRADoor: goRedDoorKey,
+}
+
+cMissing = object()
+
+# Make the precondition check for an action, as a function of the
+# world state.  It gives the same answer as GetPreconditionsForAction
+# (no preconditions left) and CheckPreconditionsForAction together,
+# but stops at the first fact that does not match and does not build
+# any lists.
+def CreatePreconditionCheck(action):
+    preconditions = cActionPreconditions[action]
+    carriedType = cActionCarriedTypes.get(action)
+    def CheckPreconditions(worldState, agentID, actionSubjectID):
+        facts = worldState.worldState
+        for link, key, value in preconditions:
+            sid = actionSubjectID if link is None else facts[actionSubjectID][link]
+            if facts[sid].get(key, cMissing) != value:
+                return False
+        if carriedType is not None:
+            return worldState.IsCarryingType(agentID, carriedType)
+        return True
+    return CheckPreconditions
+
+# Only the preconditions that the macro's own steps do not make true.
+# The rest is checked as the steps are run (see ExecuteMacro).
+def CanApplyMacro(worldState, agentID, actionSubjectID):
+    return worldState.macroLibrary.macros[actionSubjectID].CheckPreconditions(worldState)
+
+cPreconditionChecks = dict((action, CreatePreconditionCheck(action)) for action in cActionPreconditions)
+cPreconditionChecks[gaMacro] = CanApplyMacro
+
+
 class WorldState(object):
-    def __init__(self):
+    # If a fact table is passed in, the world is built from its
+    # (frozen) facts instead of the hand written default states.
+    def __init__(self, factTable=None):
         self.worldState = {}
-        self.SetDefaultStates()
+        # Room to room distances, calculated on demand from the
+        # room portals.  Shared between copies of the world state.
+        self.roomDistances = {}
+        # The subject types each agent is carrying, calculated on
+        # demand.  An agent's entry is dropped by the actions that
+        # change what it carries.
+        self.carriedTypes = {}
+        # The MacroLibrary to offer macros from in GetValidActions, or
+        # None for only the normal actions.  Shared between copies.
+        self.macroLibrary = None
+        # The ReservationTable of subjects claimed by agents, or None.
+        # Shared between copies.
+        self.reservations = None
+        if factTable is None:
+            self.SetDefaultStates()
+        else:
+            self.worldState = factTable.CreateStateDict()
+
+    # Only the facts need to be copied.  Everything else is derived
+    # from data that does not change (rooms, portals) and is shared.
+    def __deepcopy__(self, memo):
+        result = self.__class__.__new__(self.__class__)
+        result.__dict__.update(self.__dict__)
+        result.worldState = copy.deepcopy(self.worldState, memo)
+        result.carriedTypes = self.carriedTypes.copy()
+        return result
 
     # Setup the default game world.
     def SetDefaultStates(self):
@@ -185,12 +257,7 @@ class WorldState(object):
             # Agent
             (sidAgent, kInRoom, cRoom2),
             (sidAgent, kSubjectType, goAgent),
-            (sidAgent, kAction, [gaGoThroughDoor,
-                                 gaPickUpObject,
-                                 gaActivateDoor,
-                                 gaActivateRADoor,
-                                 gaActivateShuttle,
-                                 gaActivateShuttleGen]),
+            (sidAgent, kAction, cAgentActions),
             (sidAgent, kIsCarrying, []),
             # Red Access Card
             (sidRedCard, kInRoom, cRoom1),
@@ -225,6 +292,7 @@ class WorldState(object):
             (sidShuttleLaunch, kIsActivated, False),
             (sidShuttleLaunch, kInRoom, cRoom3),
             (sidShuttleLaunch, kSubjectType, goShuttleAct),
+            (sidShuttleLaunch, kPowerSource, sidShuttleGen),
         ]
         self.worldState = {}
         for (sid, key, value) in states:
@@ -232,33 +300,64 @@ class WorldState(object):
                 self.worldState[sid] = {}
             self.worldState[sid][key] = value
 
+    # Add an agent to the world, standing in the given room and not
+    # carrying anything.
+    def AddAgent(self, agentID, room, actions=cAgentActions):
+        self.carriedTypes.pop(agentID, None)
+        self.worldState[agentID] = {
+            kInRoom: room,
+            kSubjectType: goAgent,
+            kAction: actions,
+            kIsCarrying: [],
+        }
+
+    # Is the subject in the agent's room (or a portal out of it)?
+    def IsSubjectInReach(self, agentID, sid):
+        agentRoom = self.worldState[agentID][kInRoom]
+        facts = self.worldState[sid]
+        if facts.has_key(kInRoom):
+            return facts[kInRoom] == agentRoom
+        return agentRoom in facts.get(kRoomPortal, ())
+
     # Based on the room ID, create a list of all the subjectIDs
     # in the room that are NOT the agent
     def GetGameObjectsForAgent(self, agentID):
-        # The agent's current room
-        agentRoom = self.worldState[agentID][kInRoom]
         # Iterate over ALL states (lots?)
-        result = []
-        for sid in self.worldState.keys():
-            sidRooms = []
-            if sid == agentID:
-                continue
-            if self.worldState[sid].has_key(kInRoom):
-                sidRooms = [self.worldState[sid][kInRoom]]
-            elif self.worldState[sid].has_key(kRoomPortal):
-                sidRooms = list(self.worldState[sid][kRoomPortal])
-                # Now that we have the room list, check if the agent
-            # is in any of them.
-            if agentRoom in sidRooms:
-                result.append(sid)
-        #print "Game Room Objects: ROOM[%s] %s" % (agentRoom, result)
-        return result
+        return [sid for sid in self.worldState.keys()
+                if sid != agentID and self.IsSubjectInReach(agentID, sid)]
+
+    # The number of portals that have to be passed through to get
+    # from one room to the other.  The distances are calculated
+    # with a breadth first search over the room portals the first
+    # time a source room is asked for.
+    def GetRoomDistanceCost(self, srcRoom, desRoom):
+        if not self.roomDistances.has_key(srcRoom):
+            adjacent = {}
+            for sid in self.worldState.keys():
+                if self.worldState[sid].has_key(kRoomPortal):
+                    pr1, pr2 = self.worldState[sid][kRoomPortal]
+                    adjacent.setdefault(pr1, []).append(pr2)
+                    adjacent.setdefault(pr2, []).append(pr1)
+            distances = {srcRoom: 0}
+            queue = [srcRoom]
+            while len(queue) > 0:
+                room = queue.pop(0)
+                for other in adjacent.get(room, []):
+                    if not distances.has_key(other):
+                        distances[other] = distances[room] + 1
+                        queue.append(other)
+            self.roomDistances[srcRoom] = distances
+        # Unreachable rooms are treated as being very far away.
+        return self.roomDistances[srcRoom].get(desRoom, len(self.roomDistances[srcRoom]))
 
     # Generate a list of actions that the agent can execute
     # in the current room.  This will generate a list of
     # tuples.  Each tuple will be of the form;
     # (agentID, actionID, actionSubjectID)
-    def GetValidActions(self, agentID):
+    #
+    # With a tick (and a reservation table), the actions on subjects
+    # other agents have claimed for that tick are left out.
+    def GetValidActions(self, agentID, tick=None):
         # Get the list of actions that the agent can perform
         actionList = self.worldState[agentID][kAction]
         # Get the list of objects in the room
@@ -269,63 +368,120 @@ class WorldState(object):
             for sid in objectList:
                 if IsActionAllowed(action, self.worldState[sid][kSubjectType]):
                     result.append((agentID, action, sid))
+        if self.macroLibrary is not None:
+            result.extend(self.macroLibrary.GetValidMacros(self, agentID, result))
+        if self.reservations is not None and tick is not None:
+            result = [actionTup for actionTup in result if not self.IsActionReserved(actionTup, tick)]
         return result
 
+    # Is the subject of the action (or of any step of a macro) claimed
+    # by another agent?  The steps of a macro are a tick apart.
+    def IsActionReserved(self, actionTup, tick):
+        agentID, action, actionSubjectID = actionTup
+        if action == gaMacro:
+            steps = self.macroLibrary.macros[actionSubjectID].steps
+        else:
+            steps = ((action, actionSubjectID),)
+        for offset, (stepAction, stepSubjectID) in enumerate(steps):
+            if self.reservations.IsReservedByOther(agentID, stepAction, stepSubjectID, tick + offset):
+                return True
+        return False
+
 
     # Generate a list of precondition tuples that must be satisfied as world
     # states.  If the world state is already satisfied, then it is NOT added
     # to the list.  Tuples are of the form: (subjectID, key, value)
     def GetPreconditionsForAction(self, agentID, action, actionSubjectID):
-        result = []
-        if action == gaGoThroughDoor:
-            result.append((actionSubjectID, kIsClosed, False))
-        elif action == gaActivateDoor:
-            # Get the subjectID that the door is tied to and use
-            # this.  The door should be closed before we try to
-            # open it.
-            result.append((self.worldState[actionSubjectID][kActivatorTarget], kIsClosed, True))
-        elif action == gaActivateRADoor:
-            result.append((self.worldState[actionSubjectID][kActivatorTarget], kIsClosed, True))
-            # NOTE:  There is also a procedural check to see if the agent has the Red Door Key.
-        elif action == gaPickUpObject:
-            # There are not any constraints on what can be picked up.  As long as it can
-            # be picked up.
-            pass
-        elif action == gaActivateShuttle:
-            result.append((sidShuttleLaunch, kIsActivated, False))
-            result.append((sidShuttleGen, kIsPowered, True))
-        elif action == gaActivateShuttleGen:
-            result.append((sidShuttleGen, kIsPowered, False))
-
+        result = self.GetActionPreconditions(agentID, action, actionSubjectID)
         # Now remove any of these that have already been met in the current world state
         result = [(sid, key, value) for (sid, key, value) in result if
                   not self.worldState[sid].has_key(key) or self.worldState[sid][key] != value]
         return result
 
+    # All the precondition tuples for an action, met or not.
+    def GetActionPreconditions(self, agentID, action, actionSubjectID):
+        result = []
+        for link, key, value in cActionPreconditions.get(action, ()):
+            if link is None:
+                result.append((actionSubjectID, key, value))
+            else:
+                result.append((self.worldState[actionSubjectID][link], key, value))
+        return result
+
     # Procedural preconditions are used to prune paths from the tree.  This allows
     # complex calculations to be done to evaluate whether an action should be run or
     # not.
     def CheckPreconditionsForAction(self, agentID, action, actionSubjectID):
-        result = True
+        carriedType = cActionCarriedTypes.get(action)
+        if carriedType is not None:
+            # Check the agent's inventory (e.g. for the Red Access Card).
+            return self.IsCarryingType(agentID, carriedType)
+        return True
+
+    # The facts an action reads and the facts it writes, as two
+    # frozensets of (subjectID, key).  Reads include everything that
+    # decides if the action can be done at all (the rooms used by
+    # GetValidActions, the preconditions and the procedural checks).
+    # Two actions whose writes do not touch each other's reads or
+    # writes can be done in either order with the same result.
+    def GetActionFactSets(self, agentID, action, actionSubjectID):
+        if action == gaMacro:
+            uses = frozenset()
+            writes = frozenset()
+            for stepAction, stepSubjectID in self.macroLibrary.macros[actionSubjectID].steps:
+                stepUses, stepWrites = self.GetActionFactSets(agentID, stepAction, stepSubjectID)
+                uses |= stepUses
+                writes |= stepWrites
+            return uses, writes
+        facts = self.worldState[actionSubjectID]
+        reads = [(agentID, kInRoom), (agentID, kAction), (actionSubjectID, kSubjectType),
+                 (actionSubjectID, kInRoom), (actionSubjectID, kRoomPortal)]
+        for link, key, value in cActionPreconditions.get(action, ()):
+            if link is None:
+                reads.append((actionSubjectID, key))
+            else:
+                reads.append((actionSubjectID, link))
+                reads.append((facts[link], key))
+        if action in cActionCarriedTypes:
+            # Anything picked up changes the inventory.
+            reads.append((agentID, kIsCarrying))
+        writes = []
         if action == gaGoThroughDoor:
-            pass
-        elif action == gaActivateDoor:
-            pass
-        elif action == gaActivateRADoor:
-            # Iterate through the agent's inventory and see if it has the
-            # Red Access Card.  If it does not, return False
-            inventory = self.worldState[agentID][kIsCarrying]
-            for sid in inventory:
-                if self.worldState[sid][kSubjectType] == goRedDoorKey:
-                    return True
-            return False
+            writes.append((agentID, kInRoom))
+        elif action == gaActivateDoor or action == gaActivateRADoor:
+            writes.append((facts[kActivatorTarget], kIsClosed))
         elif action == gaPickUpObject:
-            pass
+            writes.extend([(actionSubjectID, kInRoom), (actionSubjectID, kIsBeingCarried),
+                           (agentID, kIsCarrying)])
         elif action == gaActivateShuttle:
-            pass
+            writes.append((actionSubjectID, kIsActivated))
         elif action == gaActivateShuttleGen:
-            pass
-        return result
+            writes.append((actionSubjectID, kIsPowered))
+        writes = frozenset(writes)
+        return frozenset(reads) | writes, writes
+
+    # Is the agent carrying something of the subject type?
+    def IsCarryingType(self, agentID, subjectType):
+        carried = self.carriedTypes.get(agentID)
+        if carried is None:
+            carried = frozenset(self.worldState[sid][kSubjectType]
+                                for sid in self.worldState[agentID][kIsCarrying])
+            self.carriedTypes[agentID] = carried
+        return subjectType in carried
+
+    # Call this after changing what an agent carries other than with
+    # ExecuteAction.
+    def InvalidateDerivedFacts(self):
+        self.carriedTypes = {}
+
+    # Can the action be done now?  This is the same as there being no
+    # preconditions left (GetPreconditionsForAction) and the
+    # procedural check passing (CheckPreconditionsForAction).
+    def CanExecuteAction(self, agentID, action, actionSubjectID):
+        check = cPreconditionChecks.get(action)
+        if check is None:
+            return True
+        return check(self, agentID, actionSubjectID)
 
     def ExecuteAction(self, agentID, action, actionSubjectID):
         if action == gaGoThroughDoor:
@@ -344,13 +500,32 @@ class WorldState(object):
         elif action == gaPickUpObject:
             del self.worldState[actionSubjectID][kInRoom]
             self.worldState[actionSubjectID][kIsBeingCarried] = agentID
-            if not actionSubjectID in self.worldState[agentID][kIsCarrying]:
-                self.worldState[agentID][kIsCarrying].append(actionSubjectID)
+            # The inventory is replaced rather than appended to so that
+            # world states can share their lists with a base state.
+            inventory = self.worldState[agentID][kIsCarrying]
+            if not actionSubjectID in inventory:
+                self.worldState[agentID][kIsCarrying] = inventory + [actionSubjectID]
+                self.carriedTypes.pop(agentID, None)
         elif action == gaActivateShuttle:
             self.worldState[actionSubjectID][kIsActivated] = True
         elif action == gaActivateShuttleGen:
             self.worldState[actionSubjectID][kIsPowered] = True
 
+    # Run the steps of a macro one at a time, checking each one as it
+    # would be checked on its own (the subject is where the agent is
+    # and the preconditions are met).  Returns False if a step can not
+    # be done; the world is left part way through the macro.
+    def ExecuteMacro(self, agentID, macroID):
+        for action, actionSubjectID in self.macroLibrary.macros[macroID].steps:
+            if not self.IsSubjectInReach(agentID, actionSubjectID):
+                return False
+            if not action in self.worldState[agentID][kAction]:
+                return False
+            if not self.CanExecuteAction(agentID, action, actionSubjectID):
+                return False
+            self.ExecuteAction(agentID, action, actionSubjectID)
+        return True
+
     def Dump(self):
         keys = self.worldState.keys()
         keys.sort()
@@ -363,16 +538,25 @@ class WorldState(object):
 
 
 class PlannerNode(object):
-    def __init__(self, worldState, goalList, actionHistory):
+    def __init__(self, worldState, goalList, actionHistory, tick=0):
         self.worldState = copy.deepcopy(worldState)
         self.actionHistory = copy.deepcopy(actionHistory)
         self.goalList = copy.deepcopy(goalList)
         self.score = 0
+        # The number of steps from the start of the plan, one tick a
+        # step.  A macro counts as all of its steps.
+        self.tick = tick
+        # Actions that do not need to be tried from this node (see
+        # Planner sleepSets).
+        self.sleepSet = frozenset()
 
     def CalculateScore(self,agentID):
         score = 0
         for agentIDOther, action, actionSubjectID in self.actionHistory:
-            score += GetActionCost(action)
+            if action == gaMacro:
+                score += self.worldState.macroLibrary.macros[actionSubjectID].cost
+            else:
+                score += GetActionCost(action)
         # Add in something for how far away the agent is from the
         # final room.  This may help or may hinder depending on how
         # much back-and-forth is required.
@@ -381,7 +565,7 @@ class PlannerNode(object):
             desRoom = self.worldState.worldState[self.goalList[0][0]][kInRoom]
         else:
             desRoom = srcRoom
-        roomCost = GetRoomDistanceCost(srcRoom,desRoom)
+        roomCost = self.worldState.GetRoomDistanceCost(srcRoom,desRoom)
         score += roomCost*5
         return score
 
@@ -397,16 +581,20 @@ class PlannerNode(object):
             if len(self.actionHistory) > 0 and self.actionHistory[-1] == actionTup:
                 return False
         # Cannot apply it if there are preconditions that are not met.
-        preconds = self.worldState.GetPreconditionsForAction(agentID, action, actionSubjectID)
-        if len(preconds) > 0:
-            return False
-        if not self.worldState.CheckPreconditionsForAction(agentID,action,actionSubjectID):
-            return False
-        return True
+        return self.worldState.CanExecuteAction(agentID, action, actionSubjectID)
 
-    def ApplyAction(self, agentID, action, actionSubjectID):
+    # The score can be left to the caller (e.g. to time it on its own).
+    # Returns False if the action was a macro that could not be run all
+    # the way through (the node should then be thrown away).
+    def ApplyAction(self, agentID, action, actionSubjectID, updateScore=True):
         # Execute the action
-        self.worldState.ExecuteAction(agentID, action, actionSubjectID)
+        if action == gaMacro:
+            if not self.worldState.ExecuteMacro(agentID, actionSubjectID):
+                return False
+            self.tick += len(self.worldState.macroLibrary.macros[actionSubjectID].steps)
+        else:
+            self.worldState.ExecuteAction(agentID, action, actionSubjectID)
+            self.tick += 1
         # Now look through the goal states and compare them to the generated
         # world states. If any of the states have been satisfied, pull them
         # from the goal states.
@@ -417,58 +605,123 @@ class PlannerNode(object):
         # try this again.
         self.actionHistory.append((agentID, action, actionSubjectID))
         # Update the score
-        self.score = self.CalculateScore(agentID)
+        if updateScore:
+            self.score = self.CalculateScore(agentID)
+        return True
+
+    # A key that is the same for any two nodes with the same facts
+    # and goals (whatever actions were used to get there).  With
+    # reservations, the tick is part of the key too.
+    def GetStateKey(self):
+        facts = []
+        for sid, sidFacts in self.worldState.worldState.iteritems():
+            for key, value in sidFacts.iteritems():
+                if isinstance(value, list):
+                    value = tuple(value)
+                facts.append((sid, key, value))
+        if self.worldState.reservations is not None:
+            return (frozenset(facts), tuple(self.goalList), self.tick)
+        return (frozenset(facts), tuple(self.goalList))
 
 
 class Planner(object):
-    def __init__(self, goalList, worldState, agentID):
+    # Set verbose to False to plan without printing every node
+    # (e.g. when many agents are planning).
+    #
+    # With pruneDuplicates, a node whose facts and goals are the same
+    # as a node already generated is dropped.  With detailedStats,
+    # the time spent in each part of the search is kept, and with
+    # profile the search is also run under cProfile (see PlannerStats).
+    #
+    # With sleepSets, only one order of actions that do not depend on
+    # each other is searched.  Each node carries a "sleep set" of
+    # actions that were already tried from an earlier point and do not
+    # depend on the actions taken since; doing them now would only
+    # reach a state that is reached in another order.  When a node
+    # creates a child with action A, the child sleeps on the parent's
+    # sleep set and the actions the parent already applied before A,
+    # keeping only the ones that commute with A.  Sleep sets are not
+    # used with reservations: what an action may do depends on the
+    # tick it is done at, and two orders of the same actions do them
+    # at different ticks.
+    #
+    # With a macroLibrary, the plans found are added to the library and
+    # the macros learned from earlier plans are offered as actions (see
+    # MacroActions.py).  Macros are expanded back into their steps in
+    # the plan that is returned.
+    #
+    # With reservations (a ReservationTable), the actions on subjects
+    # other agents have claimed are left out, taking the plan to start
+    # at startTick (see SubjectReservations.py).  Two nodes are then
+    # only duplicates if they are also at the same tick.
+    def __init__(self, goalList, worldState, agentID, verbose=True,
+                 pruneDuplicates=False, profile=False, sleepSets=False, macroLibrary=None,
+                 reservations=None, startTick=0, detailedStats=False):
         self.goalList = copy.deepcopy(goalList)
         self.worldState = copy.deepcopy(worldState)
         self.agentID = agentID
+        self.verbose = verbose
+        self.pruneDuplicates = pruneDuplicates
+        self.profile = profile
+        self.detailedStats = detailedStats
+        self.sleepSets = sleepSets and reservations is None
+        self.macroLibrary = macroLibrary
+        self.worldState.macroLibrary = macroLibrary
+        self.reservations = reservations
+        self.startTick = startTick
+        self.worldState.reservations = reservations
+        # The statistics for the last search.
+        self.stats = None
+        # (reads, writes) for each action.  The facts that decide
+        # which facts an action uses (activator targets and power
+        # sources) are never changed by an action, so these can be
+        # kept for the whole search.
+        self.actionFactSets = {}
+
+    def GetActionFactSets(self, worldState, actionTup):
+        factSets = self.actionFactSets.get(actionTup)
+        if factSets is None:
+            factSets = worldState.GetActionFactSets(*actionTup)
+            self.actionFactSets[actionTup] = factSets
+        return factSets
+
+    # Do the two actions commute (can be done in either order with the
+    # same result and without one stopping the other)?
+    def AreIndependent(self, worldState, actionTup1, actionTup2):
+        uses1, writes1 = self.GetActionFactSets(worldState, actionTup1)
+        uses2, writes2 = self.GetActionFactSets(worldState, actionTup2)
+        return writes1.isdisjoint(uses2) and writes2.isdisjoint(uses1)
+
+    # The sleep set for a child created with actionTup, where explored
+    # are the actions the parent applied before it.
+    def CalculateSleepSet(self, worldState, sleepSet, explored, actionTup):
+        return frozenset(other for other in itertools.chain(sleepSet, explored)
+                         if self.AreIndependent(worldState, actionTup, other))
+
+    # Replace the macros in a plan with their steps.
+    def ExpandMacros(self, actions):
+        result = []
+        for agentID, action, actionSubjectID in actions:
+            if action == gaMacro:
+                for stepAction, stepSubjectID in self.macroLibrary.macros[actionSubjectID].steps:
+                    result.append((agentID, stepAction, stepSubjectID))
+            else:
+                result.append((agentID, action, actionSubjectID))
+        return result
 
-    def PlanActions(self, uniqueActions, iterCountLimit):
-        iterCount = 0
-        openList = [PlannerNode(self.worldState, self.goalList, [])]
-        while len(openList) > 0:
-            iterCount = iterCount + 1
-            if iterCountLimit != None and iterCount >= iterCountLimit:
-                return []
-                # Sort the list so the least cost node is at the front.
-            openList.sort(key=lambda x: x.score,reverse=False)
-            # Pull off the least cost node.
-            node = openList[0]
-            print
-            print "-------------------"
-            print "Generating Nodes [%d] (open list len = %d)" % (iterCount, len(openList))
-            print "  History = ", node.actionHistory
-            print "  Score   = ", node.score
-            print "-------------------"
-            # Take it off the open list
-            openList.remove(node)
-            # Generate the valid actions for the node
-            validActions = node.worldState.GetValidActions(self.agentID)
-            # If the action has not been applied already and the
-            # preconditions have been met, then apply the action to the
-            # world state and update the goals.
-            for agentID, action, actionSubjectID in validActions:
-                if node.CanApplyAction(agentID, action, actionSubjectID, uniqueActions):
-                    # This action is applicable, create a new node, apply
-                    # the action, add it to the open list.
-                    print " - Creating node to apply action: ", (agentID, action, actionSubjectID)
-                    newNode = PlannerNode(node.worldState, node.goalList, node.actionHistory)
-                    print "   - Executing Action:", (agentID, action, actionSubjectID)
-                    newNode.ApplyAction(agentID, action, actionSubjectID)
-                    # If the new node has an empty goal set, it means we are done!
-                    if len(newNode.goalList) == 0:
-                        return iterCount, newNode.actionHistory
-                    print "   - Node Action History: ", newNode.actionHistory
-                    print "   - Node Score for Actions: ", newNode.score
-                    openList.append(newNode)
-                    # If we got here, it means we tried EVERYTHING possible and could not
-            # create a valid plan.
-        return (iterCount,[])
+    # Returns (iterCount, actions), or (iterCount, actions, stats) with
+    # returnStats.
+    def PlanActions(self, uniqueActions, iterCountLimit, returnStats=False):
+        search = PlannerSearch(self, uniqueActions, iterCountLimit)
+        search.Step()
+        search.FinishStats()
+        if returnStats:
+            return (search.iterCount, search.actions, search.stats)
+        return (search.iterCount, search.actions)
 
     def PrintSolutionBanner(self,iterCount,actions):
+        if not self.verbose:
+            return
         if len(actions) > 0:
             print "   ----------------------------------"
             print "   SOLUTION FOUND"
@@ -482,16 +735,216 @@ class Planner(object):
             print "   ----------------------------------"
 
 
-    def PlanActionsMixed(self, iterCountLimit=100):
-        iterCount1, actions = self.PlanActions(uniqueActions=True, iterCountLimit=None)
-        # If we got an answer from unique actions, then we are done.
-        if len(actions) > 0:
-            self.PrintSolutionBanner(iterCount1,actions)
-            return actions
-        # Return the result from the longer search.
-        iterCount2, actions = self.PlanActions(uniqueActions=False, iterCountLimit=iterCountLimit)
-        self.PrintSolutionBanner(iterCount1+iterCount2, actions)
-        return actions
+    # Returns the actions, or (actions, stats) with returnStats.
+    def PlanActionsMixed(self, iterCountLimit=100, returnStats=False):
+        search = MixedPlannerSearch(self, iterCountLimit)
+        search.Step()
+        if returnStats:
+            return (search.actions, search.stats)
+        return search.actions
+
+
+# The search loop used by Planner.PlanActions, in a form that can be
+# stopped after a number of node expansions and picked up again
+# later.  Call Step() until it returns True, then the plan is in
+# actions (empty if there is no plan).
+class PlannerSearch(object):
+    def __init__(self, planner, uniqueActions, iterCountLimit, stats=None):
+        self.planner = planner
+        self.uniqueActions = uniqueActions
+        self.iterCountLimit = iterCountLimit
+        self.iterCount = 0
+        root = PlannerNode(planner.worldState, planner.goalList, [])
+        self.openList = [root]
+        self.done = False
+        self.actions = []
+        # The stats can be shared by more than one search.
+        if stats is None:
+            stats = PlannerStats(planner.profile, planner.detailedStats)
+            stats.rootHeuristic = root.CalculateScore(planner.agentID)
+        self.stats = stats
+        planner.stats = stats
+        # State key -> the sleep set it was reached with.
+        self.seen = {}
+        if planner.pruneDuplicates:
+            self.seen[root.GetStateKey()] = root.sleepSet
+
+    # Expand up to maxExpansions nodes (or as many as it takes, if
+    # None).  Returns True when the search is finished.
+    def Step(self, maxExpansions=None):
+        stats = self.stats
+        stats.StartProfile()
+        start = time.time()
+        try:
+            return self.StepSearch(maxExpansions)
+        finally:
+            stats.searchTime += time.time() - start
+            stats.StopProfile()
+
+    def StepSearch(self, maxExpansions):
+        planner = self.planner
+        stats = self.stats
+        detailed = stats.detailed
+        openList = self.openList
+        expansions = 0
+        while not self.done:
+            if len(openList) == 0:
+                # If we got here, it means we tried EVERYTHING possible and could not
+                # create a valid plan.
+                self.Finish([])
+                break
+            if maxExpansions is not None and expansions >= maxExpansions:
+                break
+            expansions += 1
+            self.iterCount = self.iterCount + 1
+            if self.iterCountLimit != None and self.iterCount >= self.iterCountLimit:
+                self.Finish([])
+                break
+            # Sort the list so the least cost node is at the front.
+            openList.sort(key=lambda x: x.score,reverse=False)
+            # Pull off the least cost node.
+            node = openList[0]
+            if planner.verbose:
+                print
+                print "-------------------"
+                print "Generating Nodes [%d] (open list len = %d)" % (self.iterCount, len(openList))
+                print "  History = ", node.actionHistory
+                print "  Score   = ", node.score
+                print "-------------------"
+            # Take it off the open list
+            openList.remove(node)
+            stats.nodesExpanded += 1
+            # Generate the valid actions for the node
+            if detailed:
+                timer = time.time()
+            validActions = node.worldState.GetValidActions(planner.agentID, planner.startTick + node.tick)
+            if detailed:
+                stats.validActionsTime += time.time() - timer
+            # If the action has not been applied already and the
+            # preconditions have been met, then apply the action to the
+            # world state and update the goals.
+            explored = []
+            for agentID, action, actionSubjectID in validActions:
+                if planner.sleepSets and (agentID, action, actionSubjectID) in node.sleepSet:
+                    stats.sleepSetPruned += 1
+                    continue
+                if detailed:
+                    timer = time.time()
+                canApply = node.CanApplyAction(agentID, action, actionSubjectID, self.uniqueActions)
+                if detailed:
+                    stats.canApplyTime += time.time() - timer
+                if canApply:
+                    # This action is applicable, create a new node, apply
+                    # the action, add it to the open list.
+                    if planner.verbose:
+                        print " - Creating node to apply action: ", (agentID, action, actionSubjectID)
+                    if detailed:
+                        timer = time.time()
+                    newNode = PlannerNode(node.worldState, node.goalList, node.actionHistory, node.tick)
+                    if detailed:
+                        stats.copyTime += time.time() - timer
+                    if planner.verbose:
+                        print "   - Executing Action:", (agentID, action, actionSubjectID)
+                    if detailed:
+                        timer = time.time()
+                    applied = newNode.ApplyAction(agentID, action, actionSubjectID, updateScore=False)
+                    if detailed:
+                        stats.applyTime += time.time() - timer
+                    if not applied:
+                        continue
+                    if detailed:
+                        timer = time.time()
+                    newNode.score = newNode.CalculateScore(agentID)
+                    if detailed:
+                        stats.scoreTime += time.time() - timer
+                    stats.nodesGenerated += 1
+                    # If the new node has an empty goal set, it means we are done!
+                    if len(newNode.goalList) == 0:
+                        self.Finish(newNode.actionHistory)
+                        break
+                    if planner.sleepSets:
+                        actionTup = (agentID, action, actionSubjectID)
+                        newNode.sleepSet = planner.CalculateSleepSet(node.worldState, node.sleepSet,
+                                                                     explored, actionTup)
+                        explored.append(actionTup)
+                    if planner.pruneDuplicates:
+                        stateKey = newNode.GetStateKey()
+                        seenSleepSet = self.seen.get(stateKey)
+                        # With sleep sets, a state seen before is only a
+                        # duplicate if it was reached with no more
+                        # actions asleep than now.  Otherwise it is
+                        # searched again, with only the actions asleep
+                        # both times.
+                        if seenSleepSet is not None and seenSleepSet <= newNode.sleepSet:
+                            stats.duplicatesPruned += 1
+                            continue
+                        if seenSleepSet is not None:
+                            newNode.sleepSet = seenSleepSet & newNode.sleepSet
+                        self.seen[stateKey] = newNode.sleepSet
+                    if planner.verbose:
+                        print "   - Node Action History: ", newNode.actionHistory
+                        print "   - Node Score for Actions: ", newNode.score
+                    openList.append(newNode)
+            stats.peakFrontier = max(stats.peakFrontier, len(openList))
+            stats.SampleMemory()
+        return self.done
+
+    def Finish(self, actions):
+        planner = self.planner
+        if planner.macroLibrary is not None and len(actions) > 0:
+            actions = planner.ExpandMacros(actions)
+            planner.macroLibrary.RecordPlan(actions)
+        self.done = True
+        self.actions = actions
+        # Nothing more to expand; let the nodes go.
+        self.openList = []
+        self.seen = {}
+
+    # Fill in the parts of the stats that depend on the plan.
+    def FinishStats(self):
+        stats = self.stats
+        stats.planLength = len(self.actions)
+        stats.planCost = sum(GetActionCost(action) for agentID, action, actionSubjectID in self.actions)
+        stats.FinishProfile()
+
+
+# The search used by Planner.PlanActionsMixed, which can also be run a
+# few nodes at a time.  The unique actions search is tried first and,
+# if it finds nothing, the longer (limited) search is run.
+class MixedPlannerSearch(object):
+    def __init__(self, planner, iterCountLimit=100):
+        self.planner = planner
+        self.iterCountLimit = iterCountLimit
+        self.search = PlannerSearch(planner, True, None)
+        # Both searches add to the same stats.
+        self.stats = self.search.stats
+        self.uniqueIterCount = 0
+        self.done = False
+        self.actions = []
+
+    def GetIterCount(self):
+        return self.uniqueIterCount + self.search.iterCount
+
+    def Step(self, maxExpansions=None):
+        while not self.done:
+            before = self.search.iterCount
+            finished = self.search.Step(maxExpansions)
+            if maxExpansions is not None:
+                maxExpansions -= self.search.iterCount - before
+            if not finished:
+                break
+            if self.search.uniqueActions and len(self.search.actions) == 0:
+                # Return the result from the longer search.
+                self.uniqueIterCount = self.search.iterCount
+                self.search = PlannerSearch(self.planner, False, self.iterCountLimit, self.stats)
+            else:
+                self.done = True
+                self.actions = self.search.actions
+                self.search.FinishStats()
+                self.planner.PrintSolutionBanner(self.GetIterCount(), self.actions)
+            if maxExpansions is not None and maxExpansions <= 0:
+                break
+        return self.done
 
 
 def PrintActions(actions):
@@ -503,11 +956,13 @@ def PrintActions(actions):
         for act in actions:
             print "  - ", act
 
-baseWorldState = WorldState()
-#baseWorldState.Dump()
-goalList = [
-    (sidShuttleLaunch, kIsActivated, True)
-]
-planner = Planner(goalList, baseWorldState, sidAgent)
-actions = planner.PlanActionsMixed()
-PrintActions(actions)
+if __name__ == "__main__":
+    baseWorldState = WorldState()
+    #baseWorldState.Dump()
+    goalList = [
+        (sidShuttleLaunch, kIsActivated, True)
+    ]
+    planner = Planner(goalList, baseWorldState, sidAgent, detailedStats=True)
+    actions = planner.PlanActionsMixed()
+    PrintActions(actions)
+    planner.stats.Dump()
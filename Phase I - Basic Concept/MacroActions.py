@@ -0,0 +1,224 @@
+"""
+Macro actions learned from the plans the planner has made.
+
+The same short runs of actions turn up in plan after plan ("Activate
+Door" then "Go Through Door" through the same door, or "Activate RA
+Door" then "Go Through Door").  The planner finds them one node at a
+time, every time.  A MacroLibrary learns them and offers each one to
+the planner as a single action, so the plans are fewer steps deep.
+
+1. Every plan the planner finds (with a macroLibrary) is passed to
+   RecordPlan.  Every run of 2 to maxLength actions in it is counted,
+   with the agent left out so the runs of all agents add up.
+2. The runs seen at least minCount times are compiled into
+   MacroActions, best first (count times the steps saved), up to
+   maxMacros of them.  A macro has:
+   - the steps, as (action, subjectID),
+   - the preconditions: the preconditions of each step that are not
+     made true by an earlier step,
+   - the effects: the (subjectID, key) facts the steps write (with
+     None for the agent),
+   - the cost: the sum of the costs of the steps.
+3. WorldState.GetValidActions adds (agentID, gaMacro, macroID) for
+   every macro whose first step is valid.  The planner checks the
+   preconditions before copying the node, then runs the steps one
+   at a time on the copy (WorldState.ExecuteMacro), checking each
+   one as usual.  The plan that is returned has the macros expanded.
+
+The counts are saved to a JSON file (if the library has a file name)
+so the learning carries over between runs.  The counts table is kept
+to maxMacros * COUNT_TABLE_FACTOR entries; the least frequent runs
+are dropped first.
+
+NOTE:
+1.  Macros are made of actual subject IDs, so they are only useful on
+    the map they were learned on.  Macros with subjects that are not
+    in the world are skipped when compiling.
+2.  The procedural checks (e.g. carrying the red key) are not part of
+    the preconditions; they are checked when the steps are run.
+3.  Macros compiled once are kept (by ID) for as long as the library
+    is, even if they drop out of the active set, so a search that is
+    still using one can look it up.
+"""
+
+import json
+import os
+
+from GOAP_Spaceship_Sim import GetActionCost, gaMacro
+
+DEFAULT_MAX_MACROS = 32
+DEFAULT_MAX_LENGTH = 3
+DEFAULT_MIN_COUNT = 3
+COUNT_TABLE_FACTOR = 8
+LIBRARY_VERSION = 1
+
+
+def CreateMacroID(steps):
+    return " > ".join("%s: %s" % (action, actionSubjectID) for action, actionSubjectID in steps)
+
+
+class MacroAction(object):
+    def __init__(self, steps, preconditions, effects, cost, count):
+        self.macroID = CreateMacroID(steps)
+        self.steps = steps
+        self.preconditions = preconditions
+        self.effects = effects
+        self.cost = cost
+        self.count = count
+
+    def CheckPreconditions(self, worldState):
+        facts = worldState.worldState
+        for sid, key, value in self.preconditions:
+            if facts[sid].get(key) != value:
+                return False
+        return True
+
+
+class MacroLibrary(object):
+    def __init__(self, fileName=None, maxMacros=DEFAULT_MAX_MACROS, maxLength=DEFAULT_MAX_LENGTH,
+                 minCount=DEFAULT_MIN_COUNT):
+        self.fileName = fileName
+        self.maxMacros = maxMacros
+        self.maxLength = maxLength
+        self.minCount = minCount
+        # steps -> the number of times they were seen in a plan.
+        self.counts = {}
+        # macroID -> MacroAction, for every macro compiled.
+        self.macros = {}
+        # (action, subjectID) of the first step -> the active macros
+        # starting with it.  None when it needs to be compiled again.
+        self.firstSteps = None
+        self.plansRecorded = 0
+        if fileName is not None and os.path.exists(fileName):
+            self.Load()
+
+    # Count the runs of actions in a plan.
+    def RecordPlan(self, actions):
+        steps = [(action, actionSubjectID) for agentID, action, actionSubjectID in actions]
+        for length in xrange(2, self.maxLength + 1):
+            for start in xrange(len(steps) - length + 1):
+                run = tuple(steps[start:start + length])
+                self.counts[run] = self.counts.get(run, 0) + 1
+        self.plansRecorded += 1
+        self.PruneCounts()
+        self.firstSteps = None
+
+    def PruneCounts(self):
+        maxCounts = self.maxMacros * COUNT_TABLE_FACTOR
+        if len(self.counts) <= maxCounts:
+            return
+        runs = sorted(self.counts.iteritems(), key=lambda item: (-item[1], item[0]))
+        self.counts = dict(runs[:maxCounts])
+
+    def CompileMacro(self, worldState, steps, count):
+        preconditions = []
+        effects = set()
+        cost = 0
+        for action, actionSubjectID in steps:
+            for sid, key, value in worldState.GetActionPreconditions(None, action, actionSubjectID):
+                if not (sid, key) in effects:
+                    preconditions.append((sid, key, value))
+            uses, writes = worldState.GetActionFactSets(None, action, actionSubjectID)
+            effects |= writes
+            cost += GetActionCost(action)
+        return MacroAction(steps, tuple(preconditions), frozenset(effects), cost, count)
+
+    # Work out the active macros from the counts.
+    def Compile(self, worldState):
+        facts = worldState.worldState
+        candidates = [(count * (len(steps) - 1), count, steps) for steps, count in self.counts.iteritems()
+                      if count >= self.minCount]
+        candidates.sort(key=lambda item: (-item[0], item[2]))
+        self.firstSteps = {}
+        active = 0
+        for saving, count, steps in candidates:
+            if active >= self.maxMacros:
+                break
+            if not all(facts.has_key(actionSubjectID) for action, actionSubjectID in steps):
+                continue
+            macro = self.CompileMacro(worldState, steps, count)
+            self.macros[macro.macroID] = macro
+            self.firstSteps.setdefault(steps[0], []).append(macro)
+            active += 1
+
+    def GetActiveMacros(self, worldState):
+        if self.firstSteps is None:
+            self.Compile(worldState)
+        return [macro for macros in self.firstSteps.itervalues() for macro in macros]
+
+    # The macro actions to add to the valid actions of an agent.
+    def GetValidMacros(self, worldState, agentID, validActions):
+        if self.firstSteps is None:
+            self.Compile(worldState)
+        result = []
+        for validAgentID, action, actionSubjectID in validActions:
+            for macro in self.firstSteps.get((action, actionSubjectID), []):
+                result.append((agentID, gaMacro, macro.macroID))
+        return result
+
+    def Load(self):
+        with open(self.fileName) as libraryFile:
+            data = json.load(libraryFile)
+        if data.get("version") != LIBRARY_VERSION:
+            print "Ignoring macro library %s (version %s)" % (self.fileName, data.get("version"))
+            return False
+        self.counts = {}
+        for steps, count in data["counts"]:
+            self.counts[tuple((action, actionSubjectID) for action, actionSubjectID in steps)] = count
+        self.plansRecorded = data.get("plans", 0)
+        self.PruneCounts()
+        self.firstSteps = None
+        return True
+
+    # Written to a temporary file first, so a crash does not leave a
+    # half written library behind.
+    def Save(self):
+        runs = sorted(self.counts.iteritems(), key=lambda item: (-item[1], item[0]))
+        data = {
+            "version": LIBRARY_VERSION,
+            "plans": self.plansRecorded,
+            "counts": [[[list(step) for step in steps], count] for steps, count in runs],
+        }
+        tempName = self.fileName + ".tmp"
+        with open(tempName, "w") as libraryFile:
+            json.dump(data, libraryFile)
+        os.rename(tempName, self.fileName)
+        return True
+
+
+if __name__ == "__main__":
+    import argparse
+    import copy
+    from GOAP_Spaceship_Sim import (WorldState, Planner, PrintActions, kIsActivated, sidShuttleLaunch,
+                                    cRoom1, cRoom2, cRoom3)
+
+    parser = argparse.ArgumentParser(description="Learn macro actions and compare the planner with and without them.")
+    parser.add_argument("--library", default=None, help="JSON file to load and save the library in.")
+    parser.add_argument("--min-count", type=int, default=DEFAULT_MIN_COUNT)
+    args = parser.parse_args()
+
+    library = MacroLibrary(args.library, minCount=args.min_count)
+    goalList = [(sidShuttleLaunch, kIsActivated, True)]
+    baseWorldState = WorldState()
+    # Learn from a few agents in each room.
+    for idx in xrange(6):
+        worldState = copy.deepcopy(baseWorldState)
+        worldState.AddAgent("Agent", [cRoom1, cRoom2, cRoom3][idx % 3])
+        Planner(goalList, worldState, "Agent", verbose=False, macroLibrary=library).PlanActionsMixed()
+    print "Learned from %d plans:" % library.plansRecorded
+    for macro in sorted(library.GetActiveMacros(baseWorldState), key=lambda macro: -macro.count):
+        print " - [%d] %s" % (macro.count, macro.macroID)
+
+    for room in (cRoom1, cRoom2):
+        worldState = copy.deepcopy(baseWorldState)
+        worldState.AddAgent("Agent", room)
+        for useMacros in (False, True):
+            planner = Planner(goalList, worldState, "Agent", verbose=False,
+                              macroLibrary=copy.deepcopy(library) if useMacros else None)
+            actions, stats = planner.PlanActionsMixed(returnStats=True)
+            print "From %s, %s macros: %d actions, %d nodes expanded, %d generated, %.3f ms" % (
+                room, "with" if useMacros else "without", len(actions), stats.nodesExpanded,
+                stats.nodesGenerated, stats.searchTime * 1000.0)
+        PrintActions(actions)
+    if args.library is not None:
+        library.Save()
@@ -0,0 +1,206 @@
+"""
+A scheduler that spreads the planning for many agents over many ticks.
+
+Running Planner.PlanActionsMixed for every agent that needs a plan on
+the same tick makes that tick take much longer than the others.  The
+scheduler instead keeps a queue of planning requests and, each tick,
+only does as much searching as fits in a fixed time budget:
+
+1. A request is queued with a priority (lower is more important) and
+   an optional deadline (the tick the plan is wanted by).  Requests
+   are served by priority, then by deadline, then in the order they
+   were made.
+2. Each request runs a MixedPlannerSearch, which can be stopped after
+   a number of node expansions and picked up again on a later tick.
+   The search works on a copy of the world as it was when the search
+   was started (the first time the request reaches the front of the
+   queue), so the copy is made inside the budget as well.
+3. In Update, the search at the front of the queue is advanced in
+   slices of SLICE_EXPANSIONS nodes.  After each slice the time is
+   checked against the budget for the tick.  A single request is not
+   given more than maxExpansionsPerTick nodes in one tick, so one
+   long search does not starve the others.
+4. When a search finishes, the request's callback is called with the
+   request and the plan (an empty list if no plan was found).
+
+NOTE:
+1.  Smooth tick times are preferred over the latency of any one plan.
+    A slice is never interrupted, so a tick can go over the budget by
+    (at most) the time it takes to expand one slice.
+2.  An agent only has one request at a time.  Asking again for the
+    same agent cancels the request that is already queued.
+3.  With a ReservationTable, the planner leaves out the subjects other
+    agents have claimed as they are when the search is started, for a
+    plan starting at the startTick of the request.
+"""
+
+import heapq
+import itertools
+import time
+
+from GOAP_Spaceship_Sim import Planner, MixedPlannerSearch
+
+
+class PlanRequest(object):
+    def __init__(self, agentID, goalList, worldState, callback,
+                 priority, deadline, iterCountLimit, requestTick, reservations=None, startTick=0):
+        self.agentID = agentID
+        self.goalList = goalList
+        self.callback = callback
+        self.priority = priority
+        self.deadline = deadline
+        self.requestTick = requestTick
+        self.worldState = worldState
+        self.iterCountLimit = iterCountLimit
+        self.reservations = reservations
+        self.startTick = startTick
+        # Created by Start.
+        self.planner = None
+        self.search = None
+        self.cancelled = False
+        # Filled in as the request is worked on.
+        self.expansions = 0
+        self.seconds = 0.0
+        self.finishTick = None
+
+    # The Planner takes a copy of the world state.
+    def Start(self):
+        self.planner = Planner(self.goalList, self.worldState, self.agentID, verbose=False,
+                               pruneDuplicates=True, sleepSets=True,
+                               reservations=self.reservations, startTick=self.startTick)
+        self.search = MixedPlannerSearch(self.planner, self.iterCountLimit)
+        self.worldState = None
+
+    def IsDone(self):
+        return self.search is not None and self.search.done
+
+    def GetPlan(self):
+        return self.search.actions
+
+
+class PlanScheduler(object):
+    # The default time to spend planning each tick (in milliseconds).
+    DEFAULT_TICK_BUDGET_MS = 2.0
+    # The most nodes a single request can expand in one tick.
+    DEFAULT_MAX_EXPANSIONS_PER_TICK = 50
+    # Nodes expanded between checks of the clock.
+    SLICE_EXPANSIONS = 4
+
+    def __init__(self, tickBudgetMs=DEFAULT_TICK_BUDGET_MS,
+                 maxExpansionsPerTick=DEFAULT_MAX_EXPANSIONS_PER_TICK):
+        self.tickBudgetMs = tickBudgetMs
+        self.maxExpansionsPerTick = maxExpansionsPerTick
+        self.queue = []
+        self.sequence = itertools.count()
+        self.agentRequests = {}
+        self.tick = 0
+        # Counters for the whole run.
+        self.requestsMade = 0
+        self.requestsCompleted = 0
+        self.requestsCancelled = 0
+        self.totalExpansions = 0
+        self.totalLatencyTicks = 0
+        self.maxTickMs = 0.0
+        self.totalTickMs = 0.0
+
+    # Queue a planning request.  The callback is called as
+    # callback(request, actions) when the search finishes.  Returns the
+    # request (which can be passed to Cancel).
+    def RequestPlan(self, agentID, goalList, worldState, callback,
+                    priority=0, deadline=None, iterCountLimit=100, reservations=None, startTick=0):
+        self.Cancel(agentID)
+        request = PlanRequest(agentID, goalList, worldState, callback,
+                              priority, deadline, iterCountLimit, self.tick, reservations, startTick)
+        self.agentRequests[agentID] = request
+        self.Push(request)
+        self.requestsMade += 1
+        return request
+
+    def Push(self, request):
+        deadline = request.deadline
+        if deadline is None:
+            deadline = float("inf")
+        heapq.heappush(self.queue, (request.priority, deadline, self.sequence.next(), request))
+
+    # Cancel the request for an agent (if it has one).  The request is
+    # dropped from the queue when it reaches the front.
+    def Cancel(self, agentID):
+        request = self.agentRequests.pop(agentID, None)
+        if request is None:
+            return False
+        request.cancelled = True
+        self.requestsCancelled += 1
+        return True
+
+    def IsPending(self, agentID):
+        return agentID in self.agentRequests
+
+    def GetPendingCount(self):
+        return len(self.agentRequests)
+
+    # Do the planning for one tick.  Returns the number of node
+    # expansions done.
+    def Update(self):
+        self.tick += 1
+        start = time.time()
+        budget = self.tickBudgetMs / 1000.0
+        expansions = 0
+        # Requests that used up their nodes for this tick go back in
+        # the queue once the tick is over.
+        deferred = []
+        while len(self.queue) > 0 and time.time() - start < budget:
+            request = self.queue[0][3]
+            if request.cancelled:
+                heapq.heappop(self.queue)
+                continue
+            tickExpansions = 0
+            if request.search is None:
+                sliceStart = time.time()
+                request.Start()
+                request.seconds += time.time() - sliceStart
+            while time.time() - start < budget and tickExpansions < self.maxExpansionsPerTick:
+                sliceStart = time.time()
+                before = request.search.GetIterCount()
+                sliceSize = min(PlanScheduler.SLICE_EXPANSIONS, self.maxExpansionsPerTick - tickExpansions)
+                done = request.search.Step(sliceSize)
+                count = request.search.GetIterCount() - before
+                request.seconds += time.time() - sliceStart
+                request.expansions += count
+                tickExpansions += count
+                if done:
+                    break
+            expansions += tickExpansions
+            if request.IsDone():
+                heapq.heappop(self.queue)
+                self.FinishRequest(request)
+            elif tickExpansions >= self.maxExpansionsPerTick:
+                deferred.append(heapq.heappop(self.queue))
+        for entry in deferred:
+            heapq.heappush(self.queue, entry)
+        self.totalExpansions += expansions
+        tickMs = (time.time() - start) * 1000.0
+        self.totalTickMs += tickMs
+        self.maxTickMs = max(self.maxTickMs, tickMs)
+        return expansions
+
+    def FinishRequest(self, request):
+        request.finishTick = self.tick
+        del self.agentRequests[request.agentID]
+        self.requestsCompleted += 1
+        self.totalLatencyTicks += request.finishTick - request.requestTick
+        request.callback(request, request.GetPlan())
+
+    def CreateReport(self):
+        ticks = max(self.tick, 1)
+        completed = max(self.requestsCompleted, 1)
+        return {
+            "Scheduler Ticks": self.tick,
+            "Requests Made": self.requestsMade,
+            "Requests Completed": self.requestsCompleted,
+            "Requests Cancelled": self.requestsCancelled,
+            "Requests Pending": len(self.agentRequests),
+            "Node Expansions": self.totalExpansions,
+            "Mean Plan Latency Ticks": self.totalLatencyTicks / float(completed),
+            "Mean Planning Ms Per Tick": self.totalTickMs / ticks,
+            "Max Planning Ms Per Tick": self.maxTickMs,
+        }
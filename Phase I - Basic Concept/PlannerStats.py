@@ -0,0 +1,169 @@
+"""
+Statistics about what the planner did to find (or not find) a plan.
+
+Every search fills in a PlannerStats object:
+
+1. The number of nodes expanded (taken off the open list) and
+   generated (created by applying an action), the number of
+   duplicate states pruned and actions skipped by sleep sets (if the
+   planner is using them) and the largest the open list got.
+2. The time spent in the search and, with detailed stats, in each
+   part of it: GetValidActions, CanApplyAction, copying the node,
+   ApplyAction (not counting the score) and CalculateScore.
+3. How good the heuristic was: the estimate for the start node
+   compared to the cost of the plan found, and the plan length
+   compared to the nodes expanded (the "penetrance"; 1.0 means no
+   node was wasted).
+4. The peak memory used by the process during the search.
+
+The counters are always kept.  The timers for each part of the
+search cost about ten time.time() calls per action, so they are only
+kept with detailed stats (Planner(..., detailedStats=True)).  With
+profiling turned on (Planner(..., profile=True)) the stats are
+detailed and the search is also run under cProfile, with the report
+kept in profileText.
+
+NOTE:
+1.  Python 2 does not have tracemalloc, so the memory is the resident
+    set size of the whole process.  It is read from /proc, so it is
+    sampled after every expansion only with detailed stats, and every
+    MEMORY_SAMPLE_INTERVAL expansions otherwise.
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+from StringIO import StringIO
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE_LINES = 25
+# Expansions between memory samples without detailed stats.
+MEMORY_SAMPLE_INTERVAL = 64
+
+
+# The most memory the process has used so far, in KB (0 where it can
+# not be read).
+def GetPeakMemoryKB():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes on Mac OS X.
+        peak /= 1024
+    return peak
+
+
+# The memory used by the process, in KB.  This is the current resident
+# set size where it can be read (Linux), otherwise the peak.  The map
+# tools in Phase II use these too.
+def GetMemoryUsageKB():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return GetPeakMemoryKB()
+
+
+class PlannerStats(object):
+    def __init__(self, profile=False, detailed=False):
+        # Time each part of the search and sample the memory after
+        # every expansion.
+        self.detailed = detailed or profile
+        self.nodesExpanded = 0
+        self.nodesGenerated = 0
+        self.duplicatesPruned = 0
+        self.sleepSetPruned = 0
+        self.peakFrontier = 0
+        # Seconds spent in each part of the search (only with
+        # detailed stats) and in the whole search.
+        self.validActionsTime = 0.0
+        self.canApplyTime = 0.0
+        self.copyTime = 0.0
+        self.applyTime = 0.0
+        self.scoreTime = 0.0
+        self.searchTime = 0.0
+        # Filled in when the search finishes.
+        self.rootHeuristic = 0
+        self.planCost = 0
+        self.planLength = 0
+        self.startMemoryKB = GetMemoryUsageKB()
+        self.peakMemoryKB = self.startMemoryKB
+        # Only used when profiling.
+        self.profiler = cProfile.Profile() if profile else None
+        self.profileText = None
+
+    # Called after each expansion.
+    def SampleMemory(self):
+        if not self.detailed and self.nodesExpanded % MEMORY_SAMPLE_INTERVAL != 0:
+            return
+        self.peakMemoryKB = max(self.peakMemoryKB, GetMemoryUsageKB())
+
+    def StartProfile(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def StopProfile(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def FinishProfile(self):
+        if self.profiler is None:
+            return
+        stream = StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+        self.profileText = stream.getvalue()
+        self.profiler = None
+
+    # The start node's estimate over the real cost of the plan.  1.0 is
+    # a perfect estimate; above 1.0 the heuristic over estimates.
+    def GetHeuristicRatio(self):
+        if self.planCost == 0:
+            return 0.0
+        return self.rootHeuristic * 1.0 / self.planCost
+
+    def GetPenetrance(self):
+        if self.nodesExpanded == 0:
+            return 0.0
+        return self.planLength * 1.0 / self.nodesExpanded
+
+    def ToDict(self):
+        return {
+            "Nodes Expanded": self.nodesExpanded,
+            "Nodes Generated": self.nodesGenerated,
+            "Duplicates Pruned": self.duplicatesPruned,
+            "Sleep Set Pruned": self.sleepSetPruned,
+            "Peak Frontier": self.peakFrontier,
+            "GetValidActions Seconds": self.validActionsTime,
+            "CanApplyAction Seconds": self.canApplyTime,
+            "Copy Node Seconds": self.copyTime,
+            "ApplyAction Seconds": self.applyTime,
+            "CalculateScore Seconds": self.scoreTime,
+            "Search Seconds": self.searchTime,
+            "Root Heuristic": self.rootHeuristic,
+            "Plan Cost": self.planCost,
+            "Plan Length": self.planLength,
+            "Heuristic Ratio": self.GetHeuristicRatio(),
+            "Penetrance": self.GetPenetrance(),
+            "Peak Memory KB": self.peakMemoryKB - self.startMemoryKB,
+        }
+
+    def Dump(self):
+        print '----------------- PLANNER STATS ------------------ '
+        stats = self.ToDict()
+        for key in sorted(stats):
+            value = stats[key]
+            if isinstance(value, float):
+                print " - [%-24s] %.6f" % (key, value)
+            else:
+                print " - [%-24s] %s" % (key, value)
+        print '-------------------------------------------------- '
+        if self.profileText is not None:
+            print self.profileText
+        print
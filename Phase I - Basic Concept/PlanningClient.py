@@ -0,0 +1,146 @@
+"""
+A client for the planning service, and a load generator to measure it.
+
+The load generator opens a number of connections (one thread each).
+Every connection sends plan requests one after the other and times
+how long each one takes to come back.  The requests are picked from
+a few different variants (different starting rooms and carried
+items), so that some of them are identical and can be coalesced by
+the service.
+
+At the end, the latency percentiles and the throughput are printed.
+
+Usage:
+    python PlanningService.py &
+    python PlanningClient.py --clients 8 --requests 50
+"""
+
+import argparse
+import random
+import socket
+import threading
+import time
+
+from PlanningService import (FRAME_HEADER, MSG_PLAN_REQUEST, MSG_ERROR,
+                             EncodeFrame, DecodeBody, ParseAddress, AddAddressArguments)
+from GOAP_Spaceship_Sim import (kIsActivated, kInRoom, sidShuttleLaunch, sidRedCard,
+                                cRoom1, cRoom2, cRoom3)
+
+LATENCY_PERCENTILES = [50, 90, 95, 99]
+
+
+class PlanningClient(object):
+    def __init__(self, address):
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(address)
+        self.nextRequestID = 1
+
+    def ReadExactly(self, count):
+        chunks = []
+        while count > 0:
+            data = self.sock.recv(count)
+            if len(data) == 0:
+                raise IOError("Connection closed by the planning service.")
+            chunks.append(data)
+            count -= len(data)
+        return "".join(chunks)
+
+    # Send a plan request and wait for the answer.  Returns the plan
+    # (a list of (agent, action, subjectID)).
+    def RequestPlan(self, agentID, room, goalList, facts=None, iterCountLimit=100):
+        body = {"agent": agentID, "room": room, "goals": goalList, "limit": iterCountLimit}
+        if facts:
+            body["facts"] = facts
+        requestID = self.nextRequestID
+        self.nextRequestID += 1
+        self.sock.sendall(EncodeFrame(MSG_PLAN_REQUEST, requestID, body))
+        length, msgType, answerID = FRAME_HEADER.unpack(self.ReadExactly(FRAME_HEADER.size))
+        result = DecodeBody(self.ReadExactly(length))
+        if answerID != requestID:
+            raise IOError("Expected an answer to request %d, got %d." % (requestID, answerID))
+        if msgType == MSG_ERROR:
+            raise ValueError(result["error"])
+        return [tuple(action) for action in result["plan"]]
+
+    def Close(self):
+        self.sock.close()
+
+
+# The different requests the load generator picks from.
+def CreateRequestVariants():
+    goalList = [[sidShuttleLaunch, kIsActivated, True]]
+    variants = []
+    for room in (cRoom1, cRoom2, cRoom3):
+        variants.append(("Agent", room, goalList, None))
+        variants.append(("Agent", room, goalList, [[sidRedCard, kInRoom, room]]))
+    return variants
+
+
+def Percentile(sortedValues, percent):
+    if len(sortedValues) == 0:
+        return 0.0
+    index = int(round((len(sortedValues) - 1) * percent / 100.0))
+    return sortedValues[index]
+
+
+def RunLoadTest(address, clients, requests, seed=1):
+    variants = CreateRequestVariants()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def ClientThread(index):
+        rand = random.Random(seed + index)
+        client = PlanningClient(address)
+        try:
+            for idx in xrange(requests):
+                agentID, room, goalList, facts = rand.choice(variants)
+                start = time.time()
+                try:
+                    client.RequestPlan(agentID, room, goalList, facts)
+                except ValueError, err:
+                    with lock:
+                        errors.append(str(err))
+                    continue
+                elapsed = time.time() - start
+                with lock:
+                    latencies.append(elapsed)
+        finally:
+            client.Close()
+
+    threads = [threading.Thread(target=ClientThread, args=(index,)) for index in xrange(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    PrintLoadReport(latencies, errors, elapsed)
+    return latencies
+
+
+def PrintLoadReport(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    print '----------------- LOAD TEST REPORT ------------------ '
+    print " - Requests        : %d (%d errors)" % (len(latencies) + len(errors), len(errors))
+    print " - Seconds         : %.3f" % elapsed
+    print " - Requests/Second : %.1f" % (len(latencies) / max(elapsed, 1e-9))
+    for percent in LATENCY_PERCENTILES:
+        print " - p%-15d: %.2f ms" % (percent, Percentile(latencies, percent) * 1000.0)
+    if len(latencies) > 0:
+        print " - max             : %.2f ms" % (latencies[-1] * 1000.0)
+    print '----------------------------------------------------- '
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the GOAP planning service.")
+    AddAddressArguments(parser)
+    parser.add_argument("--clients", type=int, default=8, help="Number of connections.")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per connection.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    RunLoadTest(ParseAddress(args), args.clients, args.requests, args.seed)
@@ -0,0 +1,348 @@
+"""
+A planning service that runs next to the game servers.
+
+The service listens on a local TCP port (or a Unix socket) and plans
+for agents on request.  The searches are run in a pool of worker
+processes; the service itself only reads requests, hands them to the
+pool and writes the results back, all from a single event loop
+(asyncore).
+
+Each message is a frame:
+
+    +---------------+--------+-------------+------------------+
+    | length (4)    | type(1)| request (4) | body (length)    |
+    +---------------+--------+-------------+------------------+
+
+All numbers are unsigned, big endian.  The body is UTF-8 JSON.  The
+request number is chosen by the client and sent back with the result
+so a client can have many requests in flight on one connection.
+A frame longer than MAX_FRAME_BYTES is answered with a MSG_ERROR
+and the connection is closed, before any of the body is read.
+
+A plan request (MSG_PLAN_REQUEST) body is:
+
+    {
+        "agent": "Agent",                   # The agent to plan for
+        "room": "Room 1",                   # The room it starts in
+        "goals": [[sid, key, value], ...],  # The goal list
+        "facts": [[sid, key, value], ...],  # (optional) Changes to the
+                                            # default world state
+        "limit": 100                        # (optional) iterCountLimit
+    }
+
+The answer is a MSG_PLAN_RESULT with {"plan": [[agent, action, sid],
+...], "seconds": planning time} or a MSG_ERROR with {"error": text}.
+
+Identical requests (same body) that arrive while one is already being
+planned are not planned again.  They wait for the first one and get
+the same result.
+
+NOTE:
+1.  Tuples (e.g. room portals) come back from JSON as lists.  The
+    world state only unpacks or iterates them, so this does not
+    matter to the planner.
+2.  The default world is built once in each worker process and
+    copied for each request.
+"""
+
+import argparse
+import asynchat
+import asyncore
+import collections
+import copy
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+
+from GOAP_Spaceship_Sim import (WorldState, Planner, kRoomPortal, kIsClosed, kSubjectType,
+                                kIsActivated, goDoor, sidShuttleLaunch, cRoom1, cRoom3)
+
+MSG_PLAN_REQUEST = 1
+MSG_PLAN_RESULT = 2
+MSG_ERROR = 3
+
+FRAME_HEADER = struct.Struct("!IBI")
+# A plan request is a few hundred bytes; anything this big is not one.
+MAX_FRAME_BYTES = 1024 * 1024
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 7117
+
+
+def EncodeFrame(msgType, requestID, body):
+    payload = json.dumps(body, separators=(",", ":"))
+    return FRAME_HEADER.pack(len(payload), msgType, requestID) + payload
+
+
+def DecodeBody(payload):
+    if len(payload) == 0:
+        return {}
+    return json.loads(payload)
+
+
+# The key used to find identical requests.  Keys are sorted so the
+# same request always gives the same key.
+def RequestKey(body):
+    return json.dumps(body, sort_keys=True, separators=(",", ":"))
+
+
+#######################################################################
+# Worker process
+#######################################################################
+# The default world, built once per worker.
+workerWorld = None
+
+
+def InitWorker():
+    global workerWorld
+    workerWorld = WorldState()
+
+
+# Run one plan request.  This is called in a worker process, so it
+# only takes and returns simple data.
+def PlanRequestWorker(body):
+    start = time.time()
+    try:
+        worldState = copy.deepcopy(workerWorld)
+        facts = body.get("facts", [])
+        for sid, key, value in facts:
+            worldState.worldState.setdefault(sid, {})[key] = value
+        if len(facts) > 0:
+            worldState.InvalidateDerivedFacts()
+        if any(key == kRoomPortal for sid, key, value in facts):
+            # The room distances are shared with the worker's default
+            # world; this request has its own rooms.
+            worldState.roomDistances = {}
+        agentID = body["agent"]
+        worldState.AddAgent(agentID, body["room"])
+        goalList = [tuple(goal) for goal in body["goals"]]
+        planner = Planner(goalList, worldState, agentID, verbose=False, pruneDuplicates=True, sleepSets=True)
+        plan = planner.PlanActionsMixed(body.get("limit", 100))
+        return (MSG_PLAN_RESULT, {"plan": plan, "seconds": time.time() - start})
+    except Exception, err:
+        traceback.print_exc()
+        return (MSG_ERROR, {"error": "%s: %s" % (err.__class__.__name__, err)})
+
+
+# The room distances the worker has cached for its default world.
+def GetWorkerRoomDistances():
+    return workerWorld.roomDistances
+
+
+# Send a request that adds a door between rooms 1 and 3, then one for
+# the default world, to the same worker.  The worker's cached room
+# distances must still be those of the default world.
+def CheckWorkerRoomDistances():
+    goals = [[sidShuttleLaunch, kIsActivated, True]]
+    shortcut = [["Shortcut", kRoomPortal, [cRoom1, cRoom3]],
+                ["Shortcut", kIsClosed, False],
+                ["Shortcut", kSubjectType, goDoor]]
+    pool = multiprocessing.Pool(1, InitWorker)
+    try:
+        results = [pool.apply(PlanRequestWorker, (body,)) for body in
+                   ({"agent": "Agent", "room": cRoom1, "goals": goals, "facts": shortcut},
+                    {"agent": "Agent", "room": cRoom1, "goals": goals})]
+        cached = pool.apply(GetWorkerRoomDistances)
+    finally:
+        pool.terminate()
+        pool.join()
+    for msgType, body in results:
+        if msgType != MSG_PLAN_RESULT or len(body["plan"]) == 0:
+            print "Request failed: %s" % body
+            return False
+    world = WorldState()
+    for srcRoom, distances in cached.iteritems():
+        for desRoom, distance in distances.iteritems():
+            if world.GetRoomDistanceCost(srcRoom, desRoom) != distance:
+                print "Worker has %s -> %s = %d, expected %d." % (
+                    srcRoom, desRoom, distance, world.GetRoomDistanceCost(srcRoom, desRoom))
+                return False
+    print "Worker room distances are those of the default world."
+    return True
+
+
+#######################################################################
+# Service
+#######################################################################
+# One client connection.  Frames are read with the header size as the
+# terminator, then the body length.
+class PlanningChannel(asynchat.async_chat):
+    def __init__(self, sock, service):
+        asynchat.async_chat.__init__(self, sock)
+        self.service = service
+        self.buffer = []
+        self.header = None
+        # Set once a frame has been refused; anything after it is dropped.
+        self.refused = False
+        self.set_terminator(FRAME_HEADER.size)
+
+    def collect_incoming_data(self, data):
+        if not self.refused:
+            self.buffer.append(data)
+
+    def found_terminator(self):
+        data = "".join(self.buffer)
+        self.buffer = []
+        if self.header is None:
+            self.header = FRAME_HEADER.unpack(data)
+            length, msgType, requestID = self.header
+            if length > MAX_FRAME_BYTES:
+                # Do not buffer it.  The rest of the stream can not be
+                # trusted either, so drop the connection.
+                self.service.errorCount += 1
+                self.SendMessage(MSG_ERROR, requestID, {"error": "Frame of %d bytes is over the limit of %d." % (
+                    length, MAX_FRAME_BYTES)})
+                self.close_when_done()
+                self.refused = True
+                self.set_terminator(None)
+                return
+            if length > 0:
+                self.set_terminator(length)
+                return
+            data = ""
+        length, msgType, requestID = self.header
+        self.header = None
+        self.set_terminator(FRAME_HEADER.size)
+        self.service.HandleMessage(self, msgType, requestID, data)
+
+    def SendMessage(self, msgType, requestID, body):
+        self.push(EncodeFrame(msgType, requestID, body))
+
+    def handle_close(self):
+        self.close()
+
+
+class PlanningService(asyncore.dispatcher):
+    def __init__(self, address, processes=None):
+        asyncore.dispatcher.__init__(self)
+        # Start the workers before any sockets are opened, so they do
+        # not hold on to them.
+        self.pool = multiprocessing.Pool(processes, InitWorker)
+        if isinstance(address, basestring):
+            if os.path.exists(address):
+                os.remove(address)
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(128)
+        self.address = address
+        # Requests being planned: key -> [(channel, requestID), ...]
+        self.inFlight = {}
+        # Results from the pool are handed to the event loop through
+        # this queue; a byte on the pipe wakes the loop up.
+        self.results = collections.deque()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.wakeup = WakeupDispatcher(self.wakeRead, self)
+        # Counters.
+        self.requestCount = 0
+        self.coalescedCount = 0
+        self.errorCount = 0
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            PlanningChannel(pair[0], self)
+
+    def HandleMessage(self, channel, msgType, requestID, payload):
+        if msgType != MSG_PLAN_REQUEST:
+            self.errorCount += 1
+            channel.SendMessage(MSG_ERROR, requestID, {"error": "Unknown message type %d." % msgType})
+            return
+        try:
+            body = DecodeBody(payload)
+        except ValueError, err:
+            self.errorCount += 1
+            channel.SendMessage(MSG_ERROR, requestID, {"error": "Bad request: %s" % err})
+            return
+        self.requestCount += 1
+        key = RequestKey(body)
+        if key in self.inFlight:
+            self.coalescedCount += 1
+            self.inFlight[key].append((channel, requestID))
+            return
+        self.inFlight[key] = [(channel, requestID)]
+        self.pool.apply_async(PlanRequestWorker, (body,),
+                              callback=lambda result: self.PostResult(key, result))
+
+    # Called on the pool's result thread.
+    def PostResult(self, key, result):
+        self.results.append((key, result))
+        os.write(self.wakeWrite, "x")
+
+    # Called on the event loop.
+    def SendResults(self):
+        while len(self.results) > 0:
+            key, (msgType, body) = self.results.popleft()
+            for channel, requestID in self.inFlight.pop(key, []):
+                if channel.connected:
+                    channel.SendMessage(msgType, requestID, body)
+
+    def Serve(self):
+        print "Planning service listening on", self.address
+        try:
+            asyncore.loop(timeout=1.0, use_poll=True)
+        finally:
+            self.Shutdown()
+
+    def Shutdown(self):
+        self.close()
+        if isinstance(self.address, basestring) and os.path.exists(self.address):
+            os.remove(self.address)
+        self.pool.terminate()
+        self.pool.join()
+        print "Requests = %d, coalesced = %d, errors = %d" % (
+            self.requestCount, self.coalescedCount, self.errorCount)
+
+
+class WakeupDispatcher(asyncore.file_dispatcher):
+    def __init__(self, fd, service):
+        asyncore.file_dispatcher.__init__(self, fd)
+        self.service = service
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.service.SendResults()
+
+
+# Where to listen: a TCP port or (if given) a Unix socket path.
+def ParseAddress(args):
+    if args.unix is not None:
+        return args.unix
+    return (args.host, args.port)
+
+
+def AddAddressArguments(parser):
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", default=None, help="Path of a Unix socket to use instead of TCP.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the GOAP planning service.")
+    AddAddressArguments(parser)
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of planning processes (default: one per CPU).")
+    parser.add_argument("--check", action="store_true",
+                        help="Check that a request's facts do not change a worker's cached data, then exit.")
+    args = parser.parse_args()
+    if args.check:
+        raise SystemExit(0 if CheckWorkerRoomDistances() else 1)
+    service = PlanningService(ParseAddress(args), args.processes)
+    # Shut down cleanly when stopped by the process manager.  This is
+    # set after the pool is started so the workers keep the default.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        service.Serve()
+    except KeyboardInterrupt:
+        pass
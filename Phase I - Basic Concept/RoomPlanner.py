@@ -0,0 +1,342 @@
+"""
+Two level planning: first the rooms, then the actions in each room.
+
+The header of GOAP_Spaceship_Sim.py breaks the ideal plan down by
+room, with the "goto" left implicit.  This does the same for the
+planner.  A deep goal on a big ship becomes one small search over the
+rooms plus a few small concrete searches, instead of one huge search
+over every action in every room.
+
+1. The abstract problem only knows about rooms, doors and keys.  Its
+   state is (room the agent is in, key types held, goal tasks done).
+   The steps are:
+   - abGoThroughDoor: move to the room on the other side of a door.
+     A closed door needs an activator on this side (and the key for
+     it, for a red door) and costs one more, to open it.
+   - abPickUp: pick up a key item in this room (only keys that some
+     activator needs, and only one of each type).
+   - abUse: do the next goal task in this room.  The goal tasks are
+     the goals, each preceded by what it depends on (a shuttle needs
+     its generator powered first).
+   The cheapest list of steps is found with a uniform cost search.
+2. The steps are cut into segments, one per room visited.  The goals
+   of a segment are the facts its steps make true: the items carried,
+   the tasks done and, last, the agent in the next room.
+3. A segment is only refined into concrete actions (with the normal
+   Planner) when it is about to run, against the world as it is
+   then.  If a segment can not be refined (the world changed), the
+   rooms are planned again from where the agent is.
+
+Abstract plans are kept in a RoomPlanCache, keyed by everything the
+abstract search looks at (start room, keys held, goal tasks, closed
+doors and where the loose keys are), so agents with the same problem share
+one.  The steps do not name the agent; the goals for an agent are made
+from them when the segments are built.
+
+NOTE:
+1.  Which doors are open is read from the world at the start and not
+    tracked in the abstract state, so going back through a door that
+    was opened on the way costs (and needs) the same as the first
+    time.  Every door on the test ships has activators on both sides.
+2.  A RoomPlanCache belongs to one map.  The rooms, portals and
+    activators are read from the first world it is used with.
+3.  Goals on subjects that are not in a room (e.g. doors) are left to
+    the concrete search of the last segment.
+"""
+
+import copy
+import heapq
+import itertools
+
+from GOAP_Spaceship_Sim import (Planner, IsActionAllowed, gaPickUpObject,
+                                kInRoom, kRoomPortal, kIsClosed, kActivatorTarget, kSubjectType,
+                                kIsActivated, kIsPowered, kIsBeingCarried, kIsCarrying, kPowerSource,
+                                goDoorAct, goRedDoorAct, goRedDoorKey)
+
+# The abstract steps.
+abGoThroughDoor = "Go Through Door"
+abPickUp = "Pick Up"
+abUse = "Use"
+
+# The key type (if any) each kind of activator needs.
+cActivatorKeyTypes = {
+    goDoorAct: None,
+    goRedDoorAct: goRedDoorKey,
+}
+
+
+# The parts of the world that do not change: which rooms each door
+# joins and where the activators for each door are.
+class RoomGraph(object):
+    def __init__(self, worldState):
+        facts = worldState.worldState
+        # room -> [(doorID, other room), ...]
+        self.roomDoors = {}
+        # doorID -> [(room, key type or None), ...]
+        self.doorActivators = {}
+        for sid, sidFacts in facts.iteritems():
+            if sidFacts.has_key(kRoomPortal):
+                room1, room2 = sidFacts[kRoomPortal]
+                self.roomDoors.setdefault(room1, []).append((sid, room2))
+                self.roomDoors.setdefault(room2, []).append((sid, room1))
+            elif sidFacts.has_key(kActivatorTarget) and sidFacts.has_key(kInRoom):
+                subjectType = sidFacts.get(kSubjectType)
+                if cActivatorKeyTypes.has_key(subjectType):
+                    self.doorActivators.setdefault(sidFacts[kActivatorTarget], []).append(
+                        (sidFacts[kInRoom], cActivatorKeyTypes[subjectType]))
+        for doors in self.roomDoors.itervalues():
+            doors.sort()
+        self.keyTypes = frozenset(keyType for keyType in cActivatorKeyTypes.itervalues() if keyType is not None)
+
+
+# Abstract plans shared between agents on the same map.
+class RoomPlanCache(object):
+    def __init__(self):
+        self.graph = None
+        # key -> tuple of steps, or None if there is no plan.
+        self.plans = {}
+        self.hits = 0
+        self.misses = 0
+
+    def GetGraph(self, worldState):
+        if self.graph is None:
+            self.graph = RoomGraph(worldState)
+        return self.graph
+
+
+# The goals, each preceded by the goals it depends on, as a list of
+# (room, goals) tasks.  Goals already met are left out.
+def CreateGoalTasks(worldState, goalList):
+    facts = worldState.worldState
+    tasks = []
+    otherGoals = []
+    for goal in goalList:
+        sid, key, value = goal
+        if facts[sid].get(key) == value:
+            continue
+        if not facts[sid].has_key(kInRoom):
+            otherGoals.append(goal)
+            continue
+        powerSource = facts[sid].get(kPowerSource)
+        if key == kIsActivated and powerSource is not None and not facts[powerSource].get(kIsPowered):
+            tasks.append((facts[powerSource][kInRoom], ((powerSource, kIsPowered, True),)))
+        tasks.append((facts[sid][kInRoom], (goal,)))
+    return tasks, otherGoals
+
+
+# Find the cheapest list of abstract steps from the start state to
+# every task done.  Returns None if there is not one.
+def SearchRooms(graph, startRoom, heldTypes, tasks, closedDoors, looseKeys):
+    start = (startRoom, heldTypes, 0)
+    counter = itertools.count()
+    openList = [(0, next(counter), start, ())]
+    closed = set()
+    while len(openList) > 0:
+        cost, seq, state, steps = heapq.heappop(openList)
+        if state in closed:
+            continue
+        closed.add(state)
+        room, held, taskIndex = state
+        if taskIndex == len(tasks):
+            return steps
+        successors = []
+        if tasks[taskIndex][0] == room:
+            successors.append((1, (room, held, taskIndex + 1), (abUse, taskIndex, room)))
+        for itemID, itemRoom, keyType in looseKeys:
+            if itemRoom == room and not keyType in held:
+                successors.append((1, (room, held | frozenset([keyType]), taskIndex),
+                                   (abPickUp, itemID, room)))
+        for doorID, otherRoom in graph.roomDoors.get(room, []):
+            stepCost = 1
+            if doorID in closedDoors:
+                canOpen = False
+                for activatorRoom, keyType in graph.doorActivators.get(doorID, []):
+                    if activatorRoom == room and (keyType is None or keyType in held):
+                        canOpen = True
+                        break
+                if not canOpen:
+                    continue
+                stepCost = 2
+            successors.append((stepCost, (otherRoom, held, taskIndex),
+                               (abGoThroughDoor, doorID, otherRoom)))
+        for stepCost, newState, step in successors:
+            if not newState in closed:
+                heapq.heappush(openList, (cost + stepCost, next(counter), newState, steps + (step,)))
+    return None
+
+
+# A part of the plan that is done in one room.
+class PlanSegment(object):
+    def __init__(self, room, goalList, subjects):
+        self.room = room
+        self.goalList = goalList
+        # The subjects that have to still be in the room (items to pick
+        # up and things to use).
+        self.subjects = subjects
+        # The concrete actions, once refined.
+        self.actions = None
+
+
+class RoomPlanner(object):
+    def __init__(self, goalList, agentID, cache=None, iterCountLimit=100, reservations=None):
+        self.goalList = goalList
+        self.agentID = agentID
+        self.cache = cache if cache is not None else RoomPlanCache()
+        self.iterCountLimit = iterCountLimit
+        # The ReservationTable the segments are planned against, or None.
+        self.reservations = reservations
+        self.segments = []
+        self.segmentIndex = 0
+        # Counters.
+        self.roomPlansMade = 0
+        self.segmentsRefined = 0
+
+    # Plan the rooms from the world as it is now.  Returns True if a
+    # plan was found.
+    def PlanRooms(self, worldState):
+        facts = worldState.worldState
+        graph = self.cache.GetGraph(worldState)
+        agentFacts = facts[self.agentID]
+        startRoom = agentFacts[kInRoom]
+        heldTypes = frozenset(facts[sid][kSubjectType] for sid in agentFacts.get(kIsCarrying, [])
+                              if facts[sid].get(kSubjectType) in graph.keyTypes)
+        tasks, otherGoals = CreateGoalTasks(worldState, self.goalList)
+        closedDoors = frozenset(doorID for doorID in graph.doorActivators if facts[doorID].get(kIsClosed))
+        looseKeys = []
+        for sid, sidFacts in facts.iteritems():
+            subjectType = sidFacts.get(kSubjectType)
+            if (subjectType in graph.keyTypes and sidFacts.has_key(kInRoom) and
+                    IsActionAllowed(gaPickUpObject, subjectType)):
+                looseKeys.append((sid, sidFacts[kInRoom], subjectType))
+        looseKeys.sort()
+        looseKeys = tuple(looseKeys)
+
+        key = (startRoom, heldTypes, tuple(tasks), closedDoors, looseKeys)
+        if self.cache.plans.has_key(key):
+            self.cache.hits += 1
+            steps = self.cache.plans[key]
+        else:
+            self.cache.misses += 1
+            steps = SearchRooms(graph, startRoom, heldTypes, tasks, closedDoors, looseKeys)
+            self.cache.plans[key] = steps
+        self.roomPlansMade += 1
+        self.segments = []
+        self.segmentIndex = 0
+        if steps is None:
+            return False
+        self.segments = self.CreateSegments(steps, startRoom, tasks, otherGoals)
+        return True
+
+    # Cut the steps into one segment per room.
+    def CreateSegments(self, steps, startRoom, tasks, otherGoals):
+        segments = []
+        room = startRoom
+        goalList = []
+        subjects = []
+        for step in steps:
+            if step[0] == abUse:
+                goalList.extend(tasks[step[1]][1])
+                subjects.extend(sid for (sid, key, value) in tasks[step[1]][1])
+            elif step[0] == abPickUp:
+                goalList.append((step[1], kIsBeingCarried, self.agentID))
+                subjects.append(step[1])
+            else:
+                goalList.append((self.agentID, kInRoom, step[2]))
+                segments.append(PlanSegment(room, goalList, subjects))
+                room = step[2]
+                goalList = []
+                subjects = []
+        goalList.extend(otherGoals)
+        if len(goalList) > 0:
+            segments.append(PlanSegment(room, goalList, subjects))
+        return segments
+
+    # Can the segment still be done?  Another agent may have picked up
+    # the item it was going to, or the agent is not where the segment
+    # starts.
+    def IsSegmentValid(self, worldState, segment):
+        facts = worldState.worldState
+        if facts[self.agentID][kInRoom] != segment.room:
+            return False
+        for sid in segment.subjects:
+            if facts[sid].get(kInRoom) != segment.room:
+                return False
+        return True
+
+    def HasSegments(self):
+        return self.segmentIndex < len(self.segments)
+
+    # Plan the actions for the next segment against the world as it is
+    # now.  If that fails, the rooms are planned again once.  Returns
+    # the actions (an empty list if there is no plan).  The tick is
+    # when the actions will start (for the reservations).
+    def RefineNextSegment(self, worldState, tick=0):
+        replanned = False
+        if not self.HasSegments():
+            if not self.PlanRooms(worldState):
+                return []
+            replanned = True
+        facts = worldState.worldState
+        while self.HasSegments():
+            segment = self.segments[self.segmentIndex]
+            goalList = [(sid, key, value) for (sid, key, value) in segment.goalList
+                        if facts[sid].get(key) != value]
+            if len(goalList) == 0:
+                self.segmentIndex += 1
+                continue
+            if not self.IsSegmentValid(worldState, segment):
+                if replanned or not self.PlanRooms(worldState):
+                    return []
+                replanned = True
+                continue
+            planner = Planner(goalList, worldState, self.agentID, verbose=False,
+                              pruneDuplicates=True, sleepSets=True,
+                              reservations=self.reservations, startTick=tick)
+            segment.actions = planner.PlanActionsMixed(self.iterCountLimit)
+            self.segmentsRefined += 1
+            if len(segment.actions) > 0:
+                self.segmentIndex += 1
+                return segment.actions
+            if replanned or not self.PlanRooms(worldState):
+                return []
+            replanned = True
+        return []
+
+    # The whole plan, refining each segment in turn on a copy of the
+    # world.  Used to compare against the flat planner.
+    def PlanActions(self, worldState):
+        worldState = copy.deepcopy(worldState)
+        if not self.PlanRooms(worldState):
+            return []
+        actions = []
+        while self.HasSegments():
+            segmentActions = self.RefineNextSegment(worldState)
+            if len(segmentActions) == 0:
+                return []
+            for agentID, action, actionSubjectID in segmentActions:
+                worldState.ExecuteAction(agentID, action, actionSubjectID)
+            actions.extend(segmentActions)
+        return actions
+
+
+if __name__ == "__main__":
+    import time
+    from GOAP_Spaceship_Sim import WorldState, PrintActions, sidShuttleLaunch, cRoom1, cRoom2
+
+    goalList = [(sidShuttleLaunch, kIsActivated, True)]
+    cache = RoomPlanCache()
+    for idx in xrange(4):
+        room = [cRoom1, cRoom2][idx % 2]
+        agentID = "Agent %d" % (idx + 1)
+        worldState = WorldState()
+        worldState.AddAgent(agentID, room)
+        start = time.time()
+        roomPlanner = RoomPlanner(goalList, agentID, cache)
+        actions = roomPlanner.PlanActions(worldState)
+        elapsed = time.time() - start
+        print "%s from %s: %d segments, %.3f ms" % (agentID, room, len(roomPlanner.segments), elapsed * 1000.0)
+        if idx < 2:
+            for segment in roomPlanner.segments:
+                print " - %s: %s" % (segment.room, segment.goalList)
+            PrintActions(actions)
+    print "Room plan cache: %d hits, %d misses" % (cache.hits, cache.misses)
@@ -0,0 +1,356 @@
+"""
+A fixed time step simulation of the GOAP world with many agents.
+
+The simulation owns ONE WorldState that all the agents act on.  Each
+agent has a list of goals and (once it has planned) a plan.  Every
+tick, each agent does one of:
+
+1. Nothing, if its goals are met.
+2. Plan, if it does not have a valid plan.  The plan is made against
+   the world as it is now.  If the simulation has a PlanScheduler,
+   the agent queues a planning request instead and waits (doing
+   nothing) until the plan comes back, which may take a few ticks.
+3. Execute the next action of its plan through
+   WorldState.ExecuteAction.  The action is checked against the
+   world first; other agents may have changed it (e.g. picked up the
+   card this agent was going to use).  If it is no longer valid, the
+   plan is thrown away and the agent plans again on the next tick.
+
+Agents that could not find a plan wait REPLAN_BACKOFF_TICKS before
+trying again, since the world has to change before the answer will.
+
+With a scheduler, the planning for all the agents is done at the end
+of each tick, within the scheduler's time budget, so a lot of agents
+needing plans at once does not make one tick much longer than the
+others.
+
+If the simulation has a RoomPlanCache, agents plan the rooms first
+and only plan the actions for one room at a time (see RoomPlanner).
+The room planning is not done through a scheduler, so a simulation
+can have a RoomPlanCache or a scheduler, not both.  When the actions
+for a room are done, the agent "needs a plan" again and the next
+room is planned.  If an action turns out not to be valid, the rooms
+are planned again as well.
+
+If the simulation has a ReservationTable, agents claim the subjects
+their plans use up (the red card, the shuttle activator) and the
+other agents plan without them (see SubjectReservations.py).  A plan
+whose claims can not be made (another agent got in first while it was
+being planned) is thrown away and the agent plans again.  The claims
+are released as the actions are done, and when the plan is done or
+thrown away.
+
+If the simulation has an EventLogWriter, every action is logged with
+the changes it made to the world, so the run can be replayed.
+
+If the simulation has a WorldSnapshotWriter, a new generation of the
+world is published to shared memory at the end of every tick, for
+worker processes to read.
+
+The simulation can run in real time (sleeping to keep the tick rate)
+or as fast as possible, which is used to measure throughput in
+agent-ticks per second.
+"""
+
+import argparse
+import time
+
+from PlanScheduler import PlanScheduler
+from RoomPlanner import RoomPlanner, RoomPlanCache
+from SubjectReservations import ReservationTable
+from GOAP_Spaceship_Sim import (WorldState, Planner, PrintActions,
+                                kIsActivated, sidShuttleLaunch, cRoom1, cRoom2)
+
+# The state an agent can be in.
+asNeedsPlan = "Needs Plan"
+asPlanning = "Planning"
+asExecuting = "Executing"
+asNoPlan = "No Plan"
+asDone = "Done"
+
+
+class SimAgent(object):
+    def __init__(self, agentID, goalList):
+        self.agentID = agentID
+        self.goalList = goalList
+        self.plan = []
+        self.planIndex = 0
+        self.status = asNeedsPlan
+        # The tick to try planning again (if no plan was found).
+        self.replanTick = 0
+        # Only used when planning by room.
+        self.roomPlanner = None
+        self.plansMade = 0
+        self.actionsExecuted = 0
+
+
+class Simulation(object):
+    DEFAULT_TICK_RATE = 10
+    REPLAN_BACKOFF_TICKS = 10
+
+    def __init__(self, worldState, tickRate=DEFAULT_TICK_RATE, scheduler=None, snapshotWriter=None,
+                 eventLog=None, roomPlanCache=None, reservations=None):
+        if scheduler is not None and roomPlanCache is not None:
+            raise ValueError("A simulation can not have both a scheduler and a room plan cache "
+                             "(room planning is not done through the scheduler).")
+        self.worldState = worldState
+        self.scheduler = scheduler
+        self.roomPlanCache = roomPlanCache
+        self.reservations = reservations
+        self.snapshotWriter = snapshotWriter
+        self.eventLog = eventLog
+        self.tickRate = tickRate
+        self.tickTime = 1.0 / tickRate
+        self.tick = 0
+        # Agents are kept in the order they were added so runs are
+        # repeatable.
+        self.agents = []
+        self.agentDict = {}
+        # Counters for the whole run.
+        self.plansMade = 0
+        self.plansFailed = 0
+        self.plansInvalidated = 0
+        self.plansUnclaimed = 0
+        self.actionsExecuted = 0
+        self.planningTime = 0.0
+        self.maxTickTime = 0.0
+
+    # Put an agent in the world (in the given room) and give it goals.
+    def AddAgent(self, agentID, room, goalList):
+        self.worldState.AddAgent(agentID, room)
+        agent = SimAgent(agentID, goalList)
+        self.agents.append(agent)
+        self.agentDict[agentID] = agent
+        return agent
+
+    def IsGoalMet(self, goalList):
+        worldState = self.worldState.worldState
+        for sid, key, value in goalList:
+            if not worldState[sid].has_key(key) or worldState[sid][key] != value:
+                return False
+        return True
+
+    # Can the agent do this action in the world as it is now?
+    def IsActionValid(self, agentID, action, actionSubjectID):
+        worldState = self.worldState
+        if not worldState.worldState.has_key(actionSubjectID):
+            return False
+        if (agentID, action, actionSubjectID) not in worldState.GetValidActions(agentID):
+            return False
+        return worldState.CanExecuteAction(agentID, action, actionSubjectID)
+
+    def PlanAgent(self, agent):
+        start = time.time()
+        if self.roomPlanCache is not None:
+            if agent.roomPlanner is None:
+                agent.roomPlanner = RoomPlanner(agent.goalList, agent.agentID, self.roomPlanCache,
+                                                reservations=self.reservations)
+            plan = agent.roomPlanner.RefineNextSegment(self.worldState, self.tick)
+            if len(plan) == 0:
+                agent.roomPlanner = None
+        else:
+            planner = Planner(agent.goalList, self.worldState, agent.agentID, verbose=False,
+                              pruneDuplicates=True, sleepSets=True,
+                              reservations=self.reservations, startTick=self.tick)
+            plan = planner.PlanActionsMixed()
+        self.planningTime += time.time() - start
+        self.SetAgentPlan(agent, plan)
+
+    # Queue the planning for the agent with the scheduler.
+    def RequestAgentPlan(self, agent):
+        agent.status = asPlanning
+        self.scheduler.RequestPlan(agent.agentID, agent.goalList, self.worldState, self.OnPlanFinished,
+                                   reservations=self.reservations, startTick=self.tick)
+
+    # Called by the scheduler when a plan has been found (or not).
+    def OnPlanFinished(self, request, plan):
+        agent = self.agentDict[request.agentID]
+        self.planningTime += request.seconds
+        self.SetAgentPlan(agent, plan)
+
+    def SetAgentPlan(self, agent, plan):
+        agent.plan = plan
+        agent.planIndex = 0
+        agent.plansMade += 1
+        self.plansMade += 1
+        if len(agent.plan) == 0:
+            self.plansFailed += 1
+            self.ReleaseAgent(agent)
+            agent.status = asNoPlan
+            agent.replanTick = self.tick + Simulation.REPLAN_BACKOFF_TICKS
+        elif self.reservations is not None and not self.reservations.ClaimPlan(agent.agentID, plan, self.tick):
+            self.plansUnclaimed += 1
+            agent.status = asNeedsPlan
+            agent.roomPlanner = None
+        else:
+            agent.status = asExecuting
+
+    # Give up the agent's claims (its plan is done or thrown away).
+    def ReleaseAgent(self, agent):
+        if self.reservations is not None:
+            self.reservations.ReleaseAgent(agent.agentID)
+
+    def StepAgent(self, agent):
+        if agent.status == asDone:
+            return
+        if self.IsGoalMet(agent.goalList):
+            agent.status = asDone
+            self.ReleaseAgent(agent)
+            return
+        if agent.status == asNoPlan and self.tick < agent.replanTick:
+            return
+        if agent.status == asPlanning:
+            return
+        if agent.status != asExecuting:
+            # Planning takes up the agent's tick.
+            if self.scheduler is not None:
+                self.RequestAgentPlan(agent)
+            else:
+                self.PlanAgent(agent)
+            return
+        agentID, action, actionSubjectID = agent.plan[agent.planIndex]
+        if not self.IsActionValid(agentID, action, actionSubjectID):
+            self.plansInvalidated += 1
+            agent.status = asNeedsPlan
+            agent.roomPlanner = None
+            self.ReleaseAgent(agent)
+            return
+        if self.eventLog is not None:
+            self.eventLog.ExecuteAction(self.worldState, agentID, action, actionSubjectID)
+        else:
+            self.worldState.ExecuteAction(agentID, action, actionSubjectID)
+        if self.reservations is not None:
+            self.reservations.Release(agentID, actionSubjectID)
+        agent.planIndex += 1
+        agent.actionsExecuted += 1
+        self.actionsExecuted += 1
+        if agent.planIndex >= len(agent.plan):
+            if self.IsGoalMet(agent.goalList):
+                agent.status = asDone
+            else:
+                agent.status = asNeedsPlan
+            self.ReleaseAgent(agent)
+
+    # Advance the world by one tick.
+    def Tick(self):
+        start = time.time()
+        self.tick += 1
+        if self.eventLog is not None:
+            self.eventLog.BeginTick(self.tick, self.worldState)
+        if self.reservations is not None:
+            self.reservations.Expire(self.tick)
+        for agent in self.agents:
+            self.StepAgent(agent)
+        if self.scheduler is not None:
+            self.scheduler.Update()
+        if self.snapshotWriter is not None:
+            self.snapshotWriter.Publish(self.worldState)
+        self.maxTickTime = max(self.maxTickTime, time.time() - start)
+
+    def AllDone(self):
+        for agent in self.agents:
+            if agent.status != asDone:
+                return False
+        return True
+
+    # Run for a number of ticks (or until every agent is done, if
+    # stopWhenDone is set).  In real time, the loop sleeps to keep a
+    # fixed tick rate; if a tick runs long, the following ticks are
+    # run back to back to catch up.  Returns a report of the run.
+    def Run(self, ticks, realTime=False, stopWhenDone=False):
+        startTick = self.tick
+        start = time.time()
+        nextTick = start
+        for idx in xrange(ticks):
+            self.Tick()
+            if stopWhenDone and self.AllDone():
+                break
+            if realTime:
+                nextTick += self.tickTime
+                delay = nextTick - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        elapsed = time.time() - start
+        return self.CreateReport(self.tick - startTick, elapsed)
+
+    def CreateReport(self, ticks, elapsed):
+        agentCount = len(self.agents)
+        if elapsed <= 0:
+            elapsed = 1e-9
+        report = {
+            "Ticks": ticks,
+            "Agents": agentCount,
+            "Seconds": elapsed,
+            "Ticks Per Second": ticks / elapsed,
+            "Agent Ticks Per Second": ticks * agentCount / elapsed,
+            "Plans Made": self.plansMade,
+            "Plans Failed": self.plansFailed,
+            "Plans Invalidated": self.plansInvalidated,
+            "Actions Executed": self.actionsExecuted,
+            "Planning Seconds": self.planningTime,
+            "Max Tick Ms": self.maxTickTime * 1000.0,
+            "Agents Done": len([agent for agent in self.agents if agent.status == asDone]),
+        }
+        if self.scheduler is not None:
+            report.update(self.scheduler.CreateReport())
+        if self.roomPlanCache is not None:
+            report["Room Plan Cache Hits"] = self.roomPlanCache.hits
+            report["Room Plan Cache Misses"] = self.roomPlanCache.misses
+        if self.reservations is not None:
+            report["Plans Unclaimed"] = self.plansUnclaimed
+            report.update(self.reservations.CreateReport())
+        return report
+
+
+def PrintReport(report):
+    print '----------------- SIMULATION REPORT ------------------ '
+    keys = report.keys()
+    keys.sort()
+    for key in keys:
+        value = report[key]
+        if isinstance(value, float):
+            print " - [%-26s] %.3f" % (key, value)
+        else:
+            print " - [%-26s] %s" % (key, value)
+    print '------------------------------------------------------ '
+    print
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the GOAP world with many agents.")
+    parser.add_argument("--agents", type=int, default=10)
+    parser.add_argument("--ticks", type=int, default=100)
+    parser.add_argument("--tick-rate", type=int, default=Simulation.DEFAULT_TICK_RATE)
+    parser.add_argument("--real-time", action="store_true")
+    parser.add_argument("--scheduled", action="store_true",
+                        help="Spread the planning over ticks with a PlanScheduler.")
+    parser.add_argument("--budget-ms", type=float, default=PlanScheduler.DEFAULT_TICK_BUDGET_MS,
+                        help="Planning time per tick (with --scheduled).")
+    parser.add_argument("--rooms", action="store_true",
+                        help="Plan the rooms first, then the actions one room at a time.")
+    parser.add_argument("--reserve", action="store_true",
+                        help="Claim the subjects each plan uses up, so other agents plan without them.")
+    args = parser.parse_args()
+    if args.rooms and args.scheduled:
+        parser.error("--rooms can not be used with --scheduled (room planning does not go through the scheduler)")
+
+    scheduler = None
+    if args.scheduled:
+        scheduler = PlanScheduler(args.budget_ms)
+    roomPlanCache = None
+    if args.rooms:
+        roomPlanCache = RoomPlanCache()
+    reservations = None
+    if args.reserve:
+        reservations = ReservationTable()
+    simulation = Simulation(WorldState(), args.tick_rate, scheduler, roomPlanCache=roomPlanCache,
+                            reservations=reservations)
+    goalList = [(sidShuttleLaunch, kIsActivated, True)]
+    for idx in xrange(args.agents):
+        room = [cRoom1, cRoom2][idx % 2]
+        simulation.AddAgent("Agent %d" % (idx + 1), room, goalList)
+    report = simulation.Run(args.ticks, realTime=args.real_time)
+    PrintReport(report)
+    for agent in simulation.agents[:3]:
+        print "%s (%s):" % (agent.agentID, agent.status)
+        PrintActions(agent.plan)
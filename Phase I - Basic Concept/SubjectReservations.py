@@ -0,0 +1,175 @@
+"""
+A table of the subjects (game objects) agents have claimed for their
+plans, so agents do not all plan to use the same one.
+
+There is one shuttle activator and one red card.  Without claims,
+every agent that needs them plans to use them, one of them gets
+there first and all the others find out when they try the action,
+throw the plan away and plan again.  With a ReservationTable:
+
+1. When an agent gets a plan, it claims the subjects of the plan's
+   exclusive actions (picking something up, launching the shuttle).
+   A claim is for a window of ticks: from now until the tick the
+   action is expected to be done (one action a tick) plus claimSlack
+   ticks for delays.  If another agent already holds an overlapping
+   claim on one of the subjects, none of the claims are made and
+   ClaimPlan returns False.
+2. The planner (Planner(..., reservations=table, startTick=tick))
+   leaves the exclusive actions on subjects claimed by other agents
+   out of GetValidActions, for the tick the action would be done at
+   (the start tick plus the number of steps to the node).  So the
+   agent plans around them, or finds no plan and waits.
+3. Claims are released when the action has been done (Release), when
+   the plan is done or thrown away (ReleaseAgent) and when their
+   window has passed (Expire).
+
+Actions that do not use a subject up (opening doors, powering the
+shuttle) are shared: any number of agents can plan to use them.
+
+NOTE:
+1.  The planner counts one tick per step, and a macro counts as all
+    of its steps (PlannerNode.tick), the same as GetPlanClaims does
+    for the expanded plan.
+2.  Claims are only checked when planning.  The simulation still
+    checks each action when it runs, in case the world changed in a
+    way the claims do not cover.
+"""
+
+from GOAP_Spaceship_Sim import gaPickUpObject, gaActivateShuttle
+
+DEFAULT_CLAIM_SLACK = 10
+
+# The actions that use a subject up, so only one agent can plan on it.
+cExclusiveActions = frozenset([gaPickUpObject, gaActivateShuttle])
+
+
+class SubjectClaim(object):
+    def __init__(self, agentID, actionSubjectID, startTick, endTick):
+        self.agentID = agentID
+        self.actionSubjectID = actionSubjectID
+        self.startTick = startTick
+        self.endTick = endTick
+
+    def Overlaps(self, startTick, endTick):
+        return self.startTick <= endTick and startTick <= self.endTick
+
+
+class ReservationTable(object):
+    def __init__(self, claimSlack=DEFAULT_CLAIM_SLACK, exclusiveActions=cExclusiveActions):
+        self.claimSlack = claimSlack
+        self.exclusiveActions = exclusiveActions
+        # actionSubjectID -> the claims on it.
+        self.claims = {}
+        # agentID -> the subject IDs it has claims on.
+        self.agentClaims = {}
+        # Counters for the whole run.
+        self.claimsMade = 0
+        self.claimsRefused = 0
+        self.claimsReleased = 0
+        self.claimsExpired = 0
+
+    # Is the subject claimed by some other agent at the tick?
+    def IsClaimedByOther(self, agentID, actionSubjectID, tick):
+        for claim in self.claims.get(actionSubjectID, []):
+            if claim.agentID != agentID and claim.startTick <= tick <= claim.endTick:
+                return True
+        return False
+
+    # Does the agent have to leave this action out of its plans?
+    def IsReservedByOther(self, agentID, action, actionSubjectID, tick):
+        if not action in self.exclusiveActions:
+            return False
+        return self.IsClaimedByOther(agentID, actionSubjectID, tick)
+
+    def CanClaim(self, agentID, actionSubjectID, startTick, endTick):
+        for claim in self.claims.get(actionSubjectID, []):
+            if claim.agentID != agentID and claim.Overlaps(startTick, endTick):
+                return False
+        return True
+
+    # Claim the subject for the ticks.  Returns False if another agent
+    # holds an overlapping claim.
+    def Claim(self, agentID, actionSubjectID, startTick, endTick):
+        if not self.CanClaim(agentID, actionSubjectID, startTick, endTick):
+            self.claimsRefused += 1
+            return False
+        self.claims.setdefault(actionSubjectID, []).append(
+            SubjectClaim(agentID, actionSubjectID, startTick, endTick))
+        self.agentClaims.setdefault(agentID, set()).add(actionSubjectID)
+        self.claimsMade += 1
+        return True
+
+    # The claims for a plan that starts at the tick, as
+    # (actionSubjectID, startTick, endTick).
+    def GetPlanClaims(self, plan, tick):
+        result = []
+        for idx, (agentID, action, actionSubjectID) in enumerate(plan):
+            if action in self.exclusiveActions:
+                result.append((actionSubjectID, tick, tick + idx + 1 + self.claimSlack))
+        return result
+
+    # Claim the subjects of a plan, all or nothing.  Any claims the
+    # agent held from an earlier plan are released first.
+    def ClaimPlan(self, agentID, plan, tick):
+        self.ReleaseAgent(agentID)
+        planClaims = self.GetPlanClaims(plan, tick)
+        for actionSubjectID, startTick, endTick in planClaims:
+            if not self.CanClaim(agentID, actionSubjectID, startTick, endTick):
+                self.claimsRefused += 1
+                return False
+        for actionSubjectID, startTick, endTick in planClaims:
+            self.Claim(agentID, actionSubjectID, startTick, endTick)
+        return True
+
+    # Drop the claims on a subject that match.  Returns the number
+    # dropped.
+    def RemoveClaims(self, actionSubjectID, match):
+        claims = self.claims.get(actionSubjectID)
+        if claims is None:
+            return 0
+        kept = []
+        for claim in claims:
+            if not match(claim):
+                kept.append(claim)
+        if len(kept) > 0:
+            self.claims[actionSubjectID] = kept
+        else:
+            del self.claims[actionSubjectID]
+        keptAgents = set(claim.agentID for claim in kept)
+        for claim in claims:
+            agentSubjects = self.agentClaims.get(claim.agentID)
+            if agentSubjects is not None and not claim.agentID in keptAgents:
+                agentSubjects.discard(actionSubjectID)
+                if len(agentSubjects) == 0:
+                    del self.agentClaims[claim.agentID]
+        return len(claims) - len(kept)
+
+    # Release the agent's claims on a subject (e.g. once it has used
+    # it).
+    def Release(self, agentID, actionSubjectID):
+        released = self.RemoveClaims(actionSubjectID, lambda claim: claim.agentID == agentID)
+        self.claimsReleased += released
+        return released > 0
+
+    # Release everything the agent holds (its plan is done or was
+    # thrown away).
+    def ReleaseAgent(self, agentID):
+        for actionSubjectID in list(self.agentClaims.get(agentID, [])):
+            self.Release(agentID, actionSubjectID)
+
+    # Drop the claims whose window ended before the tick.
+    def Expire(self, tick):
+        for actionSubjectID in self.claims.keys():
+            self.claimsExpired += self.RemoveClaims(actionSubjectID, lambda claim: claim.endTick < tick)
+
+    def GetClaimCount(self):
+        return sum(len(claims) for claims in self.claims.itervalues())
+
+    def CreateReport(self):
+        return {
+            "Claims Made": self.claimsMade,
+            "Claims Refused": self.claimsRefused,
+            "Claims Released": self.claimsReleased,
+            "Claims Expired": self.claimsExpired,
+            "Claims Held": self.GetClaimCount(),
+        }
@@ -0,0 +1,345 @@
+"""
+Snapshots of the world state that other processes can read in place.
+
+Handing a WorldState to a worker process means pickling the whole
+dictionary of dictionaries and unpickling it on the other side, for
+every request.  Instead, the simulation publishes the world (after
+each tick) as a snapshot in shared memory, and the workers map it and
+read the facts straight out of it.
+
+A snapshot is written with a FactTable, as columns:
+
+    header           magic, generation, counts and the offset of
+                     each of the following
+    subject starts   int32 [subjects + 1]  (the facts are sorted by
+                     subject, so the facts of subject n are
+                     factKeys[starts[n]:starts[n + 1]])
+    fact keys        int32 [facts]  (index into the keys)
+    fact values      int32 [facts]  (index into the values)
+    value offsets    int64 [values + 1]
+    value data       the unique values, marshalled one after the other
+    names            the subject IDs and keys, marshalled
+
+Each generation is a separate file (in /dev/shm, if there is one).
+A small control file holds the number of the latest generation; it is
+only updated once the new snapshot has been written in full, so a
+reader always sees a whole snapshot.  Readers check the control file
+(Refresh) and map the new snapshot when it changes.
+
+NOTE:
+1.  Python 2 does not have multiprocessing.shared_memory, so the
+    snapshots are memory mapped files.  On Linux, /dev/shm is memory,
+    not disk.
+2.  The last KEEP_GENERATIONS snapshot files are kept so a reader that
+    has just seen a generation number has time to open it.  A reader
+    that has already mapped a snapshot can keep using it after the
+    file is removed.
+3.  Decoded values are cached by the reader and must be treated as
+    immutable, the same as the values of a FactTable.
+"""
+
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy
+
+from FactTable import FactTable
+from GOAP_Spaceship_Sim import (WorldState, Planner, kInRoom, kSubjectType, kIsActivated,
+                                sidShuttleLaunch, cRoom1)
+
+SNAPSHOT_MAGIC = "GOAPSNAP"
+# magic, generation, subjects, keys, facts, values, then the offsets
+# of the six sections.
+SNAPSHOT_HEADER = struct.Struct("<8sQIIII6Q")
+CONTROL_FORMAT = struct.Struct("<Q")
+KEEP_GENERATIONS = 2
+
+
+def GetSnapshotDir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def GetControlFileName(name):
+    return os.path.join(GetSnapshotDir(), "%s.ctl" % name)
+
+
+def GetSnapshotFileName(name, generation):
+    return os.path.join(GetSnapshotDir(), "%s.%d" % (name, generation))
+
+
+def Align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+# Pack the world state dictionary into the snapshot layout (see
+# above).  Returns the bytes.
+def EncodeSnapshot(stateDict, generation):
+    table = FactTable(capacity=max(sum(len(facts) for facts in stateDict.itervalues()), 1))
+    sids = stateDict.keys()
+    sids.sort()
+    for sid in sids:
+        table.InternSubject(sid)
+    table.AddStates((sid, key, value) for sid in sids for key, value in stateDict[sid].iteritems())
+    count = table.count
+    order = numpy.argsort(table.sidCodes[:count], kind="mergesort")
+    sortedSids = table.sidCodes[:count][order]
+    starts = numpy.searchsorted(sortedSids, numpy.arange(len(table.subjects) + 1)).astype(numpy.int32)
+    factKeys = table.keyCodes[:count][order].astype(numpy.int32)
+    # Each different value is only stored once.
+    valueIndex = {}
+    valueData = []
+    factValues = numpy.empty(count, dtype=numpy.int32)
+    for idx, factIdx in enumerate(order):
+        data = marshal.dumps(table.values[factIdx])
+        code = valueIndex.get(data)
+        if code is None:
+            code = len(valueData)
+            valueIndex[data] = code
+            valueData.append(data)
+        factValues[idx] = code
+    valueOffsets = numpy.zeros(len(valueData) + 1, dtype=numpy.int64)
+    valueOffsets[1:] = numpy.cumsum([len(data) for data in valueData])
+    names = marshal.dumps((table.subjects, table.keys))
+
+    sections = [starts.tostring(), factKeys.tostring(), factValues.tostring(),
+                valueOffsets.tostring(), "".join(valueData), names]
+    offsets = []
+    offset = Align(SNAPSHOT_HEADER.size)
+    for section in sections:
+        offsets.append(offset)
+        offset = Align(offset + len(section))
+    buf = bytearray(max(offset, 1))
+    SNAPSHOT_HEADER.pack_into(buf, 0, SNAPSHOT_MAGIC, generation, len(table.subjects),
+                              len(table.keys), count, len(valueData), *offsets)
+    for offset, section in zip(offsets, sections):
+        buf[offset:offset + len(section)] = section
+    return buf
+
+
+class WorldSnapshotWriter(object):
+    def __init__(self, name):
+        self.name = name
+        self.generation = 0
+        controlFileName = GetControlFileName(name)
+        with open(controlFileName, "wb") as controlFile:
+            controlFile.write(CONTROL_FORMAT.pack(0))
+        self.controlFile = open(controlFileName, "r+b")
+        self.control = mmap.mmap(self.controlFile.fileno(), CONTROL_FORMAT.size)
+
+    # Write a new generation for the world state (a WorldState or its
+    # dictionary of dictionaries).  Returns the generation number.
+    def Publish(self, worldState):
+        stateDict = getattr(worldState, "worldState", worldState)
+        generation = self.generation + 1
+        fileName = GetSnapshotFileName(self.name, generation)
+        tempName = fileName + ".tmp"
+        with open(tempName, "wb") as snapshotFile:
+            snapshotFile.write(EncodeSnapshot(stateDict, generation))
+        os.rename(tempName, fileName)
+        # Only now do the readers get to see it.
+        CONTROL_FORMAT.pack_into(self.control, 0, generation)
+        self.generation = generation
+        self.RemoveGeneration(generation - KEEP_GENERATIONS)
+        return generation
+
+    def RemoveGeneration(self, generation):
+        fileName = GetSnapshotFileName(self.name, generation)
+        if generation > 0 and os.path.exists(fileName):
+            os.remove(fileName)
+
+    def Close(self):
+        self.control.close()
+        self.controlFile.close()
+        for generation in xrange(self.generation - KEEP_GENERATIONS + 1, self.generation + 1):
+            self.RemoveGeneration(generation)
+        os.remove(GetControlFileName(self.name))
+
+
+class WorldSnapshotReader(object):
+    def __init__(self, name):
+        self.name = name
+        self.controlFile = open(GetControlFileName(name), "rb")
+        self.control = mmap.mmap(self.controlFile.fileno(), CONTROL_FORMAT.size, access=mmap.ACCESS_READ)
+        self.generation = 0
+        self.data = None
+        self.Refresh()
+
+    def GetLatestGeneration(self):
+        return CONTROL_FORMAT.unpack_from(self.control, 0)[0]
+
+    # Map the latest snapshot, if it is not the one already mapped.
+    # Returns True if a new generation was mapped.
+    def Refresh(self):
+        while True:
+            generation = self.GetLatestGeneration()
+            if generation == self.generation:
+                return False
+            try:
+                self.Map(generation)
+                return True
+            except (IOError, OSError):
+                # Already replaced by a newer one; try again.
+                if generation == self.GetLatestGeneration():
+                    raise
+
+    def Map(self, generation):
+        with open(GetSnapshotFileName(self.name, generation), "rb") as snapshotFile:
+            data = mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_READ)
+        header = SNAPSHOT_HEADER.unpack_from(data, 0)
+        magic, fileGeneration, subjectCount, keyCount, factCount, valueCount = header[:6]
+        startsAt, keysAt, valuesAt, valueOffsetsAt, valueDataAt, namesAt = header[6:]
+        if magic != SNAPSHOT_MAGIC or fileGeneration != generation:
+            raise ValueError("Bad world snapshot %s (generation %d)." % (self.name, generation))
+        # These are views on the shared memory, not copies.
+        self.starts = numpy.frombuffer(data, numpy.int32, subjectCount + 1, startsAt)
+        self.factKeys = numpy.frombuffer(data, numpy.int32, factCount, keysAt)
+        self.factValues = numpy.frombuffer(data, numpy.int32, factCount, valuesAt)
+        self.valueOffsets = numpy.frombuffer(data, numpy.int64, valueCount + 1, valueOffsetsAt)
+        self.valueDataAt = valueDataAt
+        self.subjects, self.keys = marshal.loads(data[namesAt:])
+        self.subjectIndex = dict((sid, code) for code, sid in enumerate(self.subjects))
+        self.keyIndex = dict((key, code) for code, key in enumerate(self.keys))
+        self.valueCache = {}
+        self.stateDict = None
+        self.data = data
+        self.generation = generation
+
+    def GetValue(self, code):
+        value = self.valueCache.get(code, self)
+        if value is self:
+            start = self.valueDataAt + int(self.valueOffsets[code])
+            end = self.valueDataAt + int(self.valueOffsets[code + 1])
+            value = marshal.loads(self.data[start:end])
+            self.valueCache[code] = value
+        return value
+
+    def GetSubjectIDs(self):
+        return list(self.subjects)
+
+    # A single fact, read out of the snapshot.
+    def GetFact(self, sid, key, default=None):
+        code = self.subjectIndex.get(sid)
+        keyCode = self.keyIndex.get(key)
+        if code is None or keyCode is None:
+            return default
+        start = self.starts[code]
+        end = self.starts[code + 1]
+        found = numpy.flatnonzero(self.factKeys[start:end] == keyCode)
+        if len(found) == 0:
+            return default
+        return self.GetValue(self.factValues[start + found[-1]])
+
+    # All the facts for one subject, as a new dictionary.
+    def GetFacts(self, sid):
+        code = self.subjectIndex.get(sid)
+        if code is None:
+            return {}
+        start = self.starts[code]
+        end = self.starts[code + 1]
+        keys = self.keys
+        return dict((keys[keyCode], self.GetValue(valueCode))
+                    for keyCode, valueCode in zip(self.factKeys[start:end].tolist(),
+                                                  self.factValues[start:end].tolist()))
+
+    # A new world state dictionary from the snapshot.  With this, the
+    # reader can be passed to WorldState in place of a FactTable.  The
+    # snapshot is only decoded once per generation; after that, only
+    # the subject dictionaries are copied.
+    def CreateStateDict(self):
+        if self.stateDict is None:
+            self.stateDict = dict((sid, self.GetFacts(sid)) for sid in self.subjects)
+        stateDict = self.stateDict
+        return dict((sid, stateDict[sid].copy()) for sid in stateDict)
+
+    def Close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        self.control.close()
+        self.controlFile.close()
+
+
+#######################################################################
+# Demo: read from the world in worker processes, from a snapshot and
+# from a pickled copy of the world state.
+#######################################################################
+snapshotReader = None
+
+
+def InitSnapshotWorker(name):
+    global snapshotReader
+    snapshotReader = WorldSnapshotReader(name)
+
+
+def ReadFromSnapshot(agentID):
+    snapshotReader.Refresh()
+    return snapshotReader.GetFact(agentID, kInRoom)
+
+
+def ReadFromPickle(args):
+    stateDict, agentID = args
+    return stateDict[agentID][kInRoom]
+
+
+def PlanFromSnapshot(args):
+    agentID, goalList = args
+    snapshotReader.Refresh()
+    planner = Planner(goalList, WorldState(snapshotReader), agentID, verbose=False)
+    return planner.PlanActionsMixed()
+
+
+if __name__ == "__main__":
+    import argparse
+    import multiprocessing
+    import time
+
+    parser = argparse.ArgumentParser(description="Compare reading the world from snapshots and pickles.")
+    parser.add_argument("--padding", type=int, default=20000,
+                        help="Extra subjects to add to the world (to make it large).")
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    worldState = WorldState()
+    for idx in xrange(args.padding):
+        worldState.worldState["Crate %d" % idx] = {kInRoom: "Storage", kSubjectType: "Crate"}
+    agents = []
+    for idx in xrange(args.requests):
+        agentID = "Agent %d" % idx
+        worldState.AddAgent(agentID, cRoom1)
+        agents.append(agentID)
+
+    writer = WorldSnapshotWriter("goap_snapshot_%d" % os.getpid())
+    try:
+        start = time.time()
+        generation = writer.Publish(worldState)
+        print "Published generation %d (%d subjects) in %.3f s" % (
+            generation, len(worldState.worldState), time.time() - start)
+
+        pool = multiprocessing.Pool(args.processes, InitSnapshotWorker, (writer.name,))
+        start = time.time()
+        rooms = pool.map(ReadFromSnapshot, agents)
+        print "Snapshot: %d reads in %.3f s" % (len(rooms), time.time() - start)
+        # Check planning from the snapshot gives the same answer.
+        goalList = [(sidShuttleLaunch, kIsActivated, True)]
+        plans = pool.map(PlanFromSnapshot, [(agentID, goalList) for agentID in agents[:2]])
+        pool.close()
+        pool.join()
+
+        pool = multiprocessing.Pool(args.processes)
+        start = time.time()
+        pickled = pool.map(ReadFromPickle, [(worldState.worldState, agentID) for agentID in agents])
+        print "Pickled:  %d reads in %.3f s" % (len(pickled), time.time() - start)
+        pool.close()
+        pool.join()
+
+        expected = [Planner(goalList, worldState, agentID, verbose=False).PlanActionsMixed()
+                    for agentID in agents[:2]]
+        print "Same reads:", rooms == pickled, " Same plans:", plans == expected
+    finally:
+        writer.Close()
@@ -0,0 +1,193 @@
+"""
+Time MapData.ParseTMXData on generated maps of growing size.
+
+For each size, a map is generated (GenerateMap, with a fixed seed) and
+parsed in a worker process of its own, so the peak memory of one size
+does not hide the next.  The worker saves the profile of each phase
+(MapData.RunPhase: time, change in memory, peak memory, counts) and a
+digest of the outputs.  A size that takes longer than the timeout is
+stopped and reported as such; with the brute force parts of MapData,
+the big sizes are expected to.
+
+The digest is a SHA-1 of the rooms, cells and game objects that
+MapData worked out, in a canonical form: lists sorted and each subject
+ID replaced by the lowest cell of its object, so a version that
+numbers the objects differently still matches.  With --baseline, the
+digests are compared with the ones saved by an earlier run (e.g. of
+an earlier version of MapData) and with --save-baseline they are
+saved.
+
+Usage:
+    python BenchmarkMapData.py [--sizes 32 64 ...] [--encoding csv]
+                               [--timeout S] [--report FILE]
+                               [--baseline FILE] [--save-baseline]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from CreateMapData import MapData
+from GenerateMap import GenerateMap, LAYER_ENCODINGS
+
+DEFAULT_SIZES = [32, 64, 128, 256, 512, 1024]
+DEFAULT_SEED = 1
+DEFAULT_TIMEOUT = 600.0
+POLL_SECONDS = 0.1
+
+
+# A digest of what MapData worked out from the map.
+def CalculateOutputDigest(mapData):
+    firstCells = {}
+    for goType, goList in mapData.gameObjectDict.iteritems():
+        for go in goList:
+            firstCells[go["SubjectID"]] = min(go["Cells"])
+    rooms = {}
+    for room, roomInfo in mapData.roomInfoDict.iteritems():
+        rooms[room] = [roomInfo.get("Bounds"), sorted(roomInfo.get("Cells", []))]
+    cells = []
+    for index in sorted(mapData.cellInfoDict):
+        cellInfo = mapData.cellInfoDict[index]
+        objects = sorted((goType, firstCells[subjectID]) for goType, subjectID in cellInfo["Objects"])
+        cells.append([index, cellInfo["Cell"], cellInfo["Room"], objects])
+    objects = {}
+    for goType, goList in mapData.gameObjectDict.iteritems():
+        objects[goType] = sorted([go["Room"], sorted(go["Cells"])] for go in goList)
+    return hashlib.sha1(json.dumps([rooms, cells, objects], sort_keys=True)).hexdigest()
+
+
+# Parse one map and write the profile and digest to resultName.  Run
+# in a worker process.
+def ParseWorker(fileName, resultName):
+    mapData = MapData()
+    ok = mapData.ParseTMXData(fileName, dumpInfo=False)
+    result = mapData.GetProfileReport()
+    result["Result"] = ok
+    result["Digest"] = CalculateOutputDigest(mapData) if ok else None
+    with open(resultName, "w") as resultFile:
+        json.dump(result, resultFile)
+    return ok
+
+
+# Parse the map in a worker process.  Returns the worker's result, or
+# None if it failed or ran out of time.
+def RunWorker(fileName, timeout):
+    resultName = fileName + ".result.json"
+    worker = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", fileName, resultName])
+    start = time.time()
+    while worker.poll() is None:
+        if time.time() - start > timeout:
+            worker.kill()
+            worker.wait()
+            return None
+        time.sleep(POLL_SECONDS)
+    if worker.returncode != 0 or not os.path.exists(resultName):
+        return None
+    with open(resultName) as resultFile:
+        return json.load(resultFile)
+
+
+def RunBenchmark(sizes, workDir, seed=DEFAULT_SEED, encoding="csv", timeout=DEFAULT_TIMEOUT):
+    results = []
+    for size in sizes:
+        fileName = os.path.join(workDir, "Synthetic %d.tmx" % size)
+        start = time.time()
+        GenerateMap(fileName, size, size, seed, encoding)
+        generateSeconds = time.time() - start
+        start = time.time()
+        worker = RunWorker(fileName, timeout)
+        entry = {
+            "Size": size,
+            "Cells": size * size,
+            "File Bytes": os.path.getsize(fileName),
+            "Generate Seconds": generateSeconds,
+            "Wall Seconds": time.time() - start,
+            "Timed Out": worker is None,
+        }
+        if worker is not None:
+            entry.update(worker)
+        results.append(entry)
+        PrintResult(entry)
+    return results
+
+
+def PrintResult(entry):
+    print "%dx%d (%d cells, %d KB file):" % (entry["Size"], entry["Size"], entry["Cells"],
+                                             entry["File Bytes"] / 1024)
+    if entry["Timed Out"]:
+        print "  timed out or failed after %.1f s" % entry["Wall Seconds"]
+        return
+    for phase in entry["Phases"]:
+        print "  %-30s %10.1f ms %9d KB peak" % (phase["Phase"], phase["Seconds"] * 1000.0,
+                                                 phase["Peak Memory KB"])
+    print "  %-30s %10.1f ms  digest %s" % ("Total", entry["Seconds"] * 1000.0, entry["Digest"])
+
+
+# Compare the digests with a baseline.  Returns True if none of them
+# are different (sizes that are only in one of the two are skipped).
+def CompareDigests(results, baseline):
+    same = True
+    for entry in results:
+        expected = baseline.get(str(entry["Size"]))
+        digest = entry.get("Digest")
+        if expected is None or digest is None:
+            status = "not compared"
+        elif expected == digest:
+            status = "same"
+        else:
+            status = "DIFFERENT"
+            same = False
+        print "  %5d: %s" % (entry["Size"], status)
+    return same
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time MapData on generated maps of growing size.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--encoding", choices=LAYER_ENCODINGS, default="csv")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="Seconds to give each size before stopping it.")
+    parser.add_argument("--work-dir", default=None, help="Keep the generated maps here.")
+    parser.add_argument("--report", default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", default=None, help="JSON file of output digests by size.")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Save the digests to the baseline file (instead of comparing).")
+    parser.add_argument("--worker", nargs=2, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        sys.exit(0 if ParseWorker(*args.worker) else 1)
+
+    workDir = args.work_dir
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix="mapbench")
+    elif not os.path.exists(workDir):
+        os.makedirs(workDir)
+    try:
+        results = RunBenchmark(args.sizes, workDir, args.seed, args.encoding, args.timeout)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(workDir)
+    if args.report is not None:
+        with open(args.report, "w") as reportFile:
+            json.dump(results, reportFile, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        digests = dict((str(entry["Size"]), entry.get("Digest")) for entry in results
+                       if entry.get("Digest") is not None)
+        if args.save_baseline:
+            with open(args.baseline, "w") as baselineFile:
+                json.dump(digests, baselineFile, indent=2, sort_keys=True)
+            print "Saved %d digests to %s" % (len(digests), args.baseline)
+        else:
+            with open(args.baseline) as baselineFile:
+                baseline = json.load(baselineFile)
+            print "Outputs compared with %s:" % args.baseline
+            if not CompareDigests(results, baseline):
+                sys.exit(1)
@@ -0,0 +1,343 @@
+"""
+This python script rebuilds all the maps in a directory.
+
+Each map goes through a chain of stages, where the output of one
+stage is the input of the next:
+
+1. PyxelEdit file (.pyxel)  ->  Tiled map (.tmx) + tileset image
+   (PyxelArchiveToTiled, with CSV layer data)
+   or
+   PyxelEdit XML export + tileset image  ->  Tiled map (.tmx)
+   (StreamPyxelEditToTiled, with CSV layer data)
+2. Tiled map (.tmx)  ->  compiled map data (.mapdata.json)
+   (MapData.ParseTMXData + MapData.SaveMapData)
+3. Tiled map (.tmx)  ->  preview image (.preview.png) and minimap
+   (.minimap.png), with the rooms drawn on them
+   (RenderMap.RenderTMX)
+
+The rooms (objectgroups) and tile properties are added to the .tmx
+by hand in Tiled, so the .tmx in the source directory is the master
+copy once it exists.  Stage 1 only converts a PyxelEdit map that has
+no .tmx yet, and writes it (and its tileset image) to the output
+directory; it never replaces a file that is already there in the
+source directory.  To convert the PyxelEdit files again over the
+.tmx files in the source directory, pass --regenerate.  The rooms
+and tile properties are then copied over from the old file so they
+are not lost.
+
+Stages 2 and 3 need the "Rooms" objectgroup, so a map that does not
+have one yet (such as a freshly converted PyxelEdit map) only gets a
+warning, and those stages are reported as "no rooms" rather than
+failed.
+
+A map is any "<name>.pyxel", any "<name>.xml" with a "<name>.png"
+tileset next to it, or any "<name>.tmx" on its own.  If there is
+both a .pyxel file and an XML export, the .pyxel file is used.  A
+stage is skipped if all its outputs are newer than all its inputs,
+which include the external tilesets (.tsx) and tileset images the
+.tmx uses.  The maps do not depend on each other, so each map's
+chain is run in its own worker process.
+
+Usage:
+    python BuildMaps.py [sourceDir] [--output DIR] [--jobs N] [--force]
+                              [--regenerate]
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+import traceback
+
+from lxml import etree
+
+from CreateMapData import MapData
+from PyxelEditToTiled import PyxelArchiveToTiled, StreamPyxelEditToTiled
+from RenderMap import RenderTMX
+from TilesetCache import GetTilesetCache
+
+PYXEL_EXT = ".pyxel"
+PYXEL_XML_EXT = ".xml"
+TILESET_EXT = ".png"
+TMX_EXT = ".tmx"
+MAP_DATA_EXT = ".mapdata.json"
+PREVIEW_EXT = ".preview.png"
+MINIMAP_EXT = ".minimap.png"
+
+STAGE_PYXEL = "Pyxel -> TMX"
+STAGE_TMX = "Pyxel XML -> TMX"
+STAGE_MAP_DATA = "TMX -> Map Data"
+STAGE_PREVIEW = "TMX -> Preview"
+STAGES = [STAGE_PYXEL, STAGE_TMX, STAGE_MAP_DATA, STAGE_PREVIEW]
+
+# Results for each stage
+RESULT_BUILT = "built"
+RESULT_SKIPPED = "skipped"
+RESULT_FAILED = "failed"
+RESULT_NO_ROOMS = "no rooms"
+RESULTS = [RESULT_BUILT, RESULT_SKIPPED, RESULT_NO_ROOMS, RESULT_FAILED]
+
+# The stages that need the rooms drawn in Tiled.
+ROOM_STAGES = [STAGE_MAP_DATA, STAGE_PREVIEW]
+ROOMS_GROUP = "Rooms"
+
+
+# An output is up to date if it exists and is at least as new as
+# every one of the inputs.  A missing input is never up to date (the
+# stage will report the problem when it runs).
+def IsUpToDate(inputs, outputs):
+    for fileName in inputs + outputs:
+        if not os.path.exists(fileName):
+            return False
+    newestInput = max(os.path.getmtime(fileName) for fileName in inputs)
+    oldestOutput = min(os.path.getmtime(fileName) for fileName in outputs)
+    return oldestOutput >= newestInput
+
+
+# Does the .tmx have the "Rooms" objectgroup?  Every element is
+# cleared once it has been read, so the layer data is not kept in
+# memory.
+def HasRooms(tmxFileName):
+    for event, element in etree.iterparse(tmxFileName):
+        if element.tag == "objectgroup" and element.attrib.get('name') == ROOMS_GROUP:
+            return True
+        element.clear()
+    return False
+
+
+# The files a .tmx reads its tilesets from: the external .tsx files
+# and the tileset images.  The tilesets come before the layers, so
+# the parse stops at the first layer.  Only the files that exist are
+# listed; a missing one is reported by the stage itself.
+def GetTilesetFiles(tmxFileName):
+    mapDir = os.path.dirname(tmxFileName)
+    fileNames = []
+    for event, element in etree.iterparse(tmxFileName, tag=("tileset", "layer")):
+        if element.tag == "layer":
+            break
+        source = element.attrib.get('source')
+        if source is not None:
+            if not os.path.exists(os.path.join(mapDir, source)):
+                continue
+            fileNames.append(os.path.join(mapDir, source))
+        info, tilesetDir = GetTilesetCache().GetTileset(element, mapDir)
+        if info.imageSource is not None and os.path.exists(os.path.join(tilesetDir, info.imageSource)):
+            fileNames.append(os.path.join(tilesetDir, info.imageSource))
+        element.clear()
+    return fileNames
+
+
+# Run a conversion that (re)writes a .tmx file, keeping anything that
+# was added to the old file in Tiled.
+def RebuildTMX(tmxFileName, convert):
+    # Hold on to anything that was added to the map in Tiled.
+    tiledEdits = []
+    if os.path.exists(tmxFileName):
+        oldRoot = etree.parse(tmxFileName).getroot()
+        tiledEdits = oldRoot.findall("tileset/tile") + oldRoot.findall("objectgroup")
+    if not convert():
+        return False
+    if len(tiledEdits) > 0:
+        tree = etree.parse(tmxFileName)
+        root = tree.getroot()
+        tileset = root.find("tileset")
+        for element in tiledEdits:
+            if element.tag == "tile":
+                tileset.append(element)
+            else:
+                root.append(element)
+        tree.write(tmxFileName, encoding="UTF-8", xml_declaration=True, pretty_print=True)
+    return True
+
+
+def BuildPyxel(inputs, outputs):
+    tmxFileName, tilesetFileName = outputs
+    return RebuildTMX(tmxFileName, lambda: PyxelArchiveToTiled(
+        inputs[0], tmxFileName, tilesetFileName, overwrite=True))
+
+
+def BuildTMX(inputs, outputs):
+    xmlFileName, tilesetFileName = inputs
+    tmxFileName = outputs[0]
+    return RebuildTMX(tmxFileName, lambda: StreamPyxelEditToTiled(
+        xmlFileName, tilesetFileName, tmxFileName, overwrite=True))
+
+
+def BuildMapData(inputs, outputs):
+    mapData = MapData()
+    if not mapData.ParseTMXData(inputs[0], dumpInfo=False):
+        return False
+    return mapData.SaveMapData(outputs[0])
+
+
+def BuildPreview(inputs, outputs):
+    previewFileName, minimapFileName = outputs
+    return RenderTMX(inputs[0], previewFileName, minimapFileName, rooms=True)
+
+
+STAGE_BUILDERS = {
+    STAGE_PYXEL: BuildPyxel,
+    STAGE_TMX: BuildTMX,
+    STAGE_MAP_DATA: BuildMapData,
+    STAGE_PREVIEW: BuildPreview,
+}
+
+
+# Work out the stages for every map in the source directory.  Each
+# map gets a list of (stage, inputs, outputs), in the order they
+# have to run.  A .tmx (or tileset image) in the source directory
+# may have been edited by hand, so a PyxelEdit map is only converted
+# when it has no .tmx yet, and the new files go to outputDir.  Only
+# with regenerate is the .tmx in the source directory rebuilt.
+def CreateBuildGraph(sourceDir, outputDir, regenerate=False):
+    sameDir = os.path.realpath(sourceDir) == os.path.realpath(outputDir)
+    generateDir = sourceDir if regenerate else outputDir
+    sources = {}
+    for fileName in glob.glob(os.path.join(sourceDir, "*" + PYXEL_XML_EXT)):
+        rootName = os.path.splitext(os.path.basename(fileName))[0]
+        tilesetFileName = os.path.join(sourceDir, rootName + TILESET_EXT)
+        if os.path.exists(tilesetFileName):
+            tmxFileName = os.path.join(generateDir, rootName + TMX_EXT)
+            sources[rootName] = (STAGE_TMX, [fileName, tilesetFileName], [tmxFileName])
+    for fileName in glob.glob(os.path.join(sourceDir, "*" + PYXEL_EXT)):
+        rootName = os.path.splitext(os.path.basename(fileName))[0]
+        tilesetFileName = os.path.join(generateDir, rootName + TILESET_EXT)
+        tmxFileName = os.path.join(generateDir, rootName + TMX_EXT)
+        sources[rootName] = (STAGE_PYXEL, [fileName], [tmxFileName, tilesetFileName])
+    maps = {}
+    for fileName in glob.glob(os.path.join(sourceDir, "*" + TMX_EXT)):
+        rootName = os.path.splitext(os.path.basename(fileName))[0]
+        maps[rootName] = []
+    for rootName, (stage, inputs, outputs) in sources.iteritems():
+        if rootName in maps and not regenerate:
+            # The map is already in Tiled; use the .tmx as it is.
+            continue
+        if sameDir and not regenerate:
+            existing = [fileName for fileName in outputs if os.path.exists(fileName)]
+            if len(existing) > 0:
+                print "WARNING: Map %s not converted, it would overwrite %s (use --regenerate)." % (
+                    rootName, ", ".join(existing))
+                continue
+        maps[rootName] = [(stage, inputs, outputs)]
+    for rootName in maps:
+        if len(maps[rootName]) > 0:
+            tmxFileName = maps[rootName][0][2][0]
+        else:
+            tmxFileName = os.path.join(sourceDir, rootName + TMX_EXT)
+        mapDataFileName = os.path.join(outputDir, rootName + MAP_DATA_EXT)
+        # A .tmx that is not converted yet can only have the tileset
+        # image of its PyxelEdit map.
+        inputs = [tmxFileName]
+        if os.path.exists(tmxFileName):
+            inputs += GetTilesetFiles(tmxFileName)
+        tilesetFileName = os.path.join(os.path.dirname(tmxFileName), rootName + TILESET_EXT)
+        if os.path.exists(tilesetFileName) and os.path.abspath(tilesetFileName) not in map(os.path.abspath, inputs):
+            inputs.append(tilesetFileName)
+        maps[rootName].append((STAGE_MAP_DATA, inputs, [mapDataFileName]))
+        maps[rootName].append((STAGE_PREVIEW, inputs,
+                               [os.path.join(outputDir, rootName + PREVIEW_EXT),
+                                os.path.join(outputDir, rootName + MINIMAP_EXT)]))
+    return maps
+
+
+# Run all the stages for one map.  This runs in a worker process, so
+# it only takes and returns simple (picklable) data.  The timing for
+# each stage is returned as (rootName, stage, result, seconds).  Once
+# a stage fails, the stages after it are not run.  The stages that
+# need rooms are not run for a map without them.
+def BuildMap(args):
+    rootName, stages, force = args
+    results = []
+    failed = False
+    # Only looked at (once) when a stage that needs the rooms has to run.
+    hasRooms = None
+    for stage, inputs, outputs in stages:
+        if failed:
+            results.append((rootName, stage, RESULT_FAILED, 0.0))
+            continue
+        start = time.time()
+        if not force and IsUpToDate(inputs, outputs):
+            results.append((rootName, stage, RESULT_SKIPPED, time.time() - start))
+            continue
+        if stage in ROOM_STAGES and os.path.exists(inputs[0]):
+            if hasRooms is None:
+                hasRooms = HasRooms(inputs[0])
+            if not hasRooms:
+                print "WARNING: Map %s has no %s objectgroup, stage [%s] not run." % (rootName, ROOMS_GROUP, stage)
+                results.append((rootName, stage, RESULT_NO_ROOMS, time.time() - start))
+                continue
+        try:
+            built = STAGE_BUILDERS[stage](inputs, outputs)
+        except Exception:
+            traceback.print_exc()
+            built = False
+        elapsed = time.time() - start
+        if built:
+            results.append((rootName, stage, RESULT_BUILT, elapsed))
+        else:
+            print "Map %s: stage [%s] failed." % (rootName, stage)
+            results.append((rootName, stage, RESULT_FAILED, elapsed))
+            failed = True
+    return results
+
+
+def BuildMaps(sourceDir, outputDir=None, jobs=None, force=False, regenerate=False):
+    if outputDir is None:
+        outputDir = sourceDir
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    maps = CreateBuildGraph(sourceDir, outputDir, regenerate)
+    rootNames = maps.keys()
+    rootNames.sort()
+    work = [(rootName, maps[rootName], force) for rootName in rootNames]
+    start = time.time()
+    if jobs == 1 or len(work) <= 1:
+        mapResults = [BuildMap(args) for args in work]
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            mapResults = pool.map(BuildMap, work, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+    results = [result for mapResult in mapResults for result in mapResult]
+    PrintBuildReport(results, elapsed)
+    return results
+
+
+def PrintBuildReport(results, elapsed):
+    print '----------------- BUILD REPORT ------------------ '
+    for rootName, stage, result, seconds in results:
+        print "%-30s %-18s %-8s %8.3f s" % (rootName, stage, result, seconds)
+    print
+    for stage in STAGES:
+        stageResults = [(result, seconds) for rootName, s, result, seconds in results if s == stage]
+        counts = dict((result, 0) for result in RESULTS)
+        for result, seconds in stageResults:
+            counts[result] += 1
+        print "%-18s built %3d  skipped %3d  no rooms %3d  failed %3d  total %8.3f s" % (
+            stage, counts[RESULT_BUILT], counts[RESULT_SKIPPED], counts[RESULT_NO_ROOMS],
+            counts[RESULT_FAILED], sum(seconds for result, seconds in stageResults))
+    print "Wall time: %.3f s" % elapsed
+    print '------------------------------------------------- '
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild all the maps in a directory.")
+    parser.add_argument("sourceDir", nargs="?", default=".",
+                        help="Directory with the PyxelEdit exports, tilesets and .tmx files.")
+    parser.add_argument("--output", default=None,
+                        help="Directory for the compiled map data (default: sourceDir).")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of worker processes (default: one per CPU).")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild every stage, even if it is up to date.")
+    parser.add_argument("--regenerate", action="store_true",
+                        help="Convert the PyxelEdit maps again over the .tmx files in sourceDir, "
+                             "keeping the rooms and tile properties added in Tiled.")
+    args = parser.parse_args()
+    results = BuildMaps(args.sourceDir, args.output, args.jobs, args.force, args.regenerate)
+    if len([result for result in results if result[2] == RESULT_FAILED]) > 0:
+        raise SystemExit(1)
@@ -0,0 +1,593 @@
+"""
+Chunked, on demand loading of maps that are too big to expand all
+at once.
+
+MapData expands every tile of every layer into layerDict and every
+floor cell into cellInfoDict up front.  For a station sized map those
+dictionaries do not fit in memory.  ChunkedMapData splits the map into
+square regions of regionSize x regionSize cells and only expands the
+regions that are used:
+
+1. OpenTMX compiles the .tmx file once, reading it as a stream (the
+   XML for a layer is thrown away as soon as it has been read).  Each
+   expected layer is written to the cache directory as a (height,
+   width) array of gids in a .npy file.  The map information, the
+   tileset and the room bounds go in index.json.  Maps saved by Tiled
+   as "infinite" store their layers as <chunk> elements; each chunk
+   is put into the arrays at its x, y, moved so the top left of the
+   used area is cell 0, 0.  The compiled files are used again for as
+   long as the .tmx file does not change.
+2. GetRegion expands one region from its slice of the layer arrays
+   (which are memory mapped, so only that slice is read) into the
+   same structures MapData has: layerDict, cellInfoDict and
+   gameObjectDict, for the cells of the region only.
+3. The expanded regions are kept in least recently used order.  When
+   their estimated size goes over memoryBudgetKB, the least recently
+   used are dropped.  They are expanded again if they are used again.
+
+NOTE:
+1.  Game objects are found by clustering the object tiles of the
+    region and OBJECT_MARGIN cells around it.  A cluster that reaches
+    further out is followed one cell at a time, so an object that
+    crosses the edge of a region is found whole from both sides.  The
+    subject ID of an object is the lowest cell index it covers, so it
+    is the same from either region (but not the ID MapData gives it).
+    An object is listed in the gameObjectDict of the region with its
+    lowest cell.
+2.  The size of a region is an estimate from the number of tiles and
+    cells in it (TILE_BYTES and CELL_BYTES), not a measurement.
+3.  Layers stored as one <tile> element per gid are read whole, so
+    big maps should be saved as CSV or base64.
+4.  Cell coordinates of infinite maps are moved by (originX,
+    originY) from Tiled's coordinates, and the room bounds with them.
+5.  The map is compiled again if an external (.tsx) tileset it uses
+    changes, as well as when the .tmx file does.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import time
+
+import numpy
+from lxml import etree
+
+from CreateMapData import MapData
+
+DEFAULT_REGION_SIZE = 64
+DEFAULT_MEMORY_BUDGET_KB = 256 * 1024
+OBJECT_MARGIN = 8
+# The estimated memory used by one expanded tile (a CalcNodeData tuple
+# in a layer dictionary) and one cell (its cellInfoDict entry).
+TILE_BYTES = 500
+CELL_BYTES = 700
+CACHE_VERSION = 2
+
+
+class MapRegion(object):
+    def __init__(self, regionX, regionY, cellBounds):
+        self.regionX = regionX
+        self.regionY = regionY
+        # (cellX1, cellY1, cellX2, cellY2), the end not included.
+        self.cellBounds = cellBounds
+        self.layerDict = {}
+        self.cellInfoDict = {}
+        self.gameObjectDict = {}
+        self.sizeKB = 0
+
+    def ContainsCell(self, cellX, cellY):
+        cellX1, cellY1, cellX2, cellY2 = self.cellBounds
+        return cellX1 <= cellX < cellX2 and cellY1 <= cellY < cellY2
+
+
+class ChunkedMapData(MapData):
+    def __init__(self, regionSize=DEFAULT_REGION_SIZE, memoryBudgetKB=DEFAULT_MEMORY_BUDGET_KB):
+        MapData.__init__(self)
+        self.regionSize = regionSize
+        self.memoryBudgetKB = memoryBudgetKB
+
+    def SetDefaults(self):
+        MapData.SetDefaults(self)
+        self.cacheDir = None
+        # The top left cell of the map in Tiled's coordinates (only
+        # not 0, 0 for infinite maps).
+        self.originX = 0
+        self.originY = 0
+        # The rooms in the order they were in the file.
+        self.roomNames = []
+        # Layer name -> memory mapped (height, width) array of gids.
+        self.layerGIDs = {}
+        # (regionX, regionY) -> MapRegion, least recently used first.
+        self.regions = collections.OrderedDict()
+        self.loadedKB = 0
+        # Counters.
+        self.regionHits = 0
+        self.regionLoads = 0
+        self.regionEvictions = 0
+        self.peakLoadedKB = 0
+
+    @staticmethod
+    def GetDefaultCacheDir(fileName):
+        return os.path.splitext(fileName)[0] + ".chunks"
+
+    # Read the map attributes.  For an infinite map, the width and
+    # height are those of the area covered by the chunks of all the
+    # layers and the origin is its top left.
+    def ScanTMX(self, fileName):
+        infinite = False
+        bounds = None
+        for event, element in etree.iterparse(fileName, events=("start", "end")):
+            if event == "start" and element.tag == "map":
+                infinite = element.attrib.get('infinite') == "1"
+                self.tileWidth = int(element.attrib['tilewidth'])
+                self.tileHeight = int(element.attrib['tileheight'])
+                self.mapWidth = int(element.attrib['width'])
+                self.mapHeight = int(element.attrib['height'])
+                if not infinite:
+                    break
+            elif event == "end" and element.tag == "chunk":
+                x = int(element.attrib['x'])
+                y = int(element.attrib['y'])
+                x2 = x + int(element.attrib['width'])
+                y2 = y + int(element.attrib['height'])
+                if bounds is None:
+                    bounds = (x, y, x2, y2)
+                else:
+                    bounds = (min(bounds[0], x), min(bounds[1], y), max(bounds[2], x2), max(bounds[3], y2))
+                element.clear()
+        if infinite:
+            if bounds is None:
+                print "Infinite map %s has no chunks." % fileName
+                return None
+            self.originX, self.originY = bounds[0], bounds[1]
+            self.mapWidth = bounds[2] - bounds[0]
+            self.mapHeight = bounds[3] - bounds[1]
+        return infinite
+
+    # Write one layer's gids into its array.
+    def CompileLayer(self, layer, infinite, array):
+        name = layer.attrib['name']
+        data = layer.find("data")
+        encoding = data.attrib.get('encoding')
+        compression = data.attrib.get('compression')
+        if infinite:
+            for chunk in data.findall("chunk"):
+                x = int(chunk.attrib['x']) - self.originX
+                y = int(chunk.attrib['y']) - self.originY
+                width = int(chunk.attrib['width'])
+                height = int(chunk.attrib['height'])
+                gids = self.ReadEncodedGIDs(chunk, encoding, compression, asArray=True)
+                if gids is None or len(gids) != width * height:
+                    print "Layer %s has a bad chunk at (%s, %s)." % (name, chunk.attrib['x'], chunk.attrib['y'])
+                    return False
+                array[y:y + height, x:x + width] = gids.reshape(height, width)
+            return True
+        width = int(layer.attrib['width'])
+        height = int(layer.attrib['height'])
+        if width != self.mapWidth or height != self.mapHeight:
+            print "Layer %s has incorrect dimensions; expected [%d x %d], found [%d x %d]." % (
+                name, self.mapWidth, self.mapHeight, width, height
+            )
+            return False
+        gids = self.ReadEncodedGIDs(data, encoding, compression, asArray=True)
+        if gids is None or len(gids) != width * height:
+            print "Layer %s tile count does not match expected [%d]." % (name, width * height)
+            return False
+        array[:, :] = gids.reshape(height, width)
+        return True
+
+    # Compile the .tmx file into the cache directory.
+    def CompileTMX(self, fileName, cacheDir):
+        infinite = self.ScanTMX(fileName)
+        if infinite is None:
+            return False
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        # The tilesets and object groups are small, so they are kept
+        # in a tree of their own for ExtractTilesetInformation and
+        # ExtractRoomBoundsInformation.
+        header = etree.Element("map")
+        layersFound = set()
+        for event, element in etree.iterparse(fileName, events=("end",)):
+            if element.tag in ("tileset", "objectgroup"):
+                header.append(etree.fromstring(etree.tostring(element)))
+            elif element.tag == "layer":
+                name = element.attrib['name']
+                if name not in MapData.EXPECTED_LAYERS:
+                    print "Layer [%s] not used in processing." % name
+                else:
+                    array = numpy.lib.format.open_memmap(os.path.join(cacheDir, name + ".npy"), mode="w+",
+                                                         dtype=numpy.uint32,
+                                                         shape=(self.mapHeight, self.mapWidth))
+                    compiled = self.CompileLayer(element, infinite, array)
+                    array.flush()
+                    del array
+                    if not compiled:
+                        print "Unable to continue..."
+                        return False
+                    layersFound.add(name)
+            else:
+                continue
+            # Drop the XML read so far.
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        for layerName in MapData.EXPECTED_LAYERS:
+            if layerName not in layersFound:
+                print "Unable to find layer %s in map data." % layerName
+                print "Unable to continue..."
+                return False
+        self.tree = etree.ElementTree(header)
+        if not self.ExtractTilesetInformation() or not self.ExtractRoomBoundsInformation():
+            return False
+        # External tilesets are checked by IsCompiled, like the map.
+        mapDir = os.path.dirname(os.path.abspath(fileName))
+        tilesetSources = [os.path.join(mapDir, tileset.attrib['source'])
+                          for tileset in header.findall("tileset") if tileset.attrib.has_key('source')]
+        self.tree = None
+        # Move the rooms with the cells.
+        offsetX = self.originX * self.tileWidth
+        offsetY = self.originY * self.tileHeight
+        for roomInfo in self.roomInfoDict.itervalues():
+            (x1, y1), (x2, y2) = roomInfo['Bounds']
+            roomInfo['Bounds'] = ((x1 - offsetX, y1 - offsetY), (x2 - offsetX, y2 - offsetY))
+        index = {
+            "version": CACHE_VERSION,
+            "source": self.GetSourceStamp(fileName),
+            "tilesetSources": [[source, self.GetSourceStamp(source)] for source in tilesetSources],
+            "map": {
+                "tileWidth": self.tileWidth,
+                "tileHeight": self.tileHeight,
+                "mapWidth": self.mapWidth,
+                "mapHeight": self.mapHeight,
+                "originX": self.originX,
+                "originY": self.originY,
+            },
+            "tiles": [[gid, objectType, localID] for gid, (objectType, localID) in sorted(self.tileDict.iteritems())],
+            "rooms": [[room, self.roomInfoDict[room]['Bounds']] for room in self.roomInfoDict],
+        }
+        tempName = os.path.join(cacheDir, "index.json.tmp")
+        with open(tempName, "w") as indexFile:
+            json.dump(index, indexFile)
+        os.rename(tempName, os.path.join(cacheDir, "index.json"))
+        return True
+
+    @staticmethod
+    def GetSourceStamp(fileName):
+        stat = os.stat(fileName)
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    def IsCompiled(self, fileName, cacheDir):
+        indexName = os.path.join(cacheDir, "index.json")
+        if not os.path.exists(indexName):
+            return False
+        with open(indexName) as indexFile:
+            index = json.load(indexFile)
+        if index.get("version") != CACHE_VERSION or index.get("source") != self.GetSourceStamp(fileName):
+            return False
+        for source, stamp in index["tilesetSources"]:
+            if not os.path.exists(source) or self.GetSourceStamp(source) != stamp:
+                return False
+        for layerName in MapData.EXPECTED_LAYERS:
+            if not os.path.exists(os.path.join(cacheDir, layerName + ".npy")):
+                return False
+        return True
+
+    # Read the index and map the layer arrays.
+    def LoadCompiled(self, cacheDir):
+        with open(os.path.join(cacheDir, "index.json")) as indexFile:
+            index = json.load(indexFile)
+        mapInfo = index["map"]
+        self.tileWidth = mapInfo["tileWidth"]
+        self.tileHeight = mapInfo["tileHeight"]
+        self.mapWidth = mapInfo["mapWidth"]
+        self.mapHeight = mapInfo["mapHeight"]
+        self.originX = mapInfo["originX"]
+        self.originY = mapInfo["originY"]
+        self.tileDict = dict((gid, (str(objectType), localID)) for gid, objectType, localID in index["tiles"])
+        self.CreateObjectTypeLookup()
+        # Kept in the order they were in the file, like MapData.
+        self.roomInfoDict = {}
+        self.roomNames = []
+        for room, ((x1, y1), (x2, y2)) in index["rooms"]:
+            self.roomInfoDict[str(room)] = {'Bounds': ((x1, y1), (x2, y2))}
+            self.roomNames.append(str(room))
+        for layerName in MapData.EXPECTED_LAYERS:
+            self.layerGIDs[layerName] = numpy.load(os.path.join(cacheDir, layerName + ".npy"), mmap_mode="r")
+        self.cacheDir = cacheDir
+        return True
+
+    # Get the map ready to use, compiling it first if it has not been
+    # (or has changed since).
+    def OpenTMX(self, fileName, cacheDir=None):
+        if not os.path.exists(fileName):
+            print "File %s does not exist!!!" % fileName
+            return False
+        self.SetDefaults()
+        self.fileName = fileName
+        if cacheDir is None:
+            cacheDir = ChunkedMapData.GetDefaultCacheDir(fileName)
+        if not self.IsCompiled(fileName, cacheDir):
+            if not self.RunPhase("CompileTMX", lambda: self.CompileTMX(fileName, cacheDir)):
+                return False
+        return self.RunPhase("LoadCompiled", lambda: self.LoadCompiled(cacheDir))
+
+    def GetRegionCounts(self):
+        regionSize = self.regionSize
+        return ((self.mapWidth + regionSize - 1) // regionSize, (self.mapHeight + regionSize - 1) // regionSize)
+
+    # The expanded region, from the loaded ones if it is there.
+    def GetRegion(self, regionX, regionY):
+        key = (regionX, regionY)
+        region = self.regions.pop(key, None)
+        if region is not None:
+            self.regionHits += 1
+            self.regions[key] = region
+            return region
+        region = self.CompileRegion(regionX, regionY)
+        self.regions[key] = region
+        self.loadedKB += region.sizeKB
+        self.regionLoads += 1
+        self.EvictRegions()
+        self.peakLoadedKB = max(self.peakLoadedKB, self.loadedKB)
+        return region
+
+    # Drop the least recently used regions until the rest fit in the
+    # budget.  The region used last is always kept.
+    def EvictRegions(self):
+        while self.loadedKB > self.memoryBudgetKB and len(self.regions) > 1:
+            key, region = self.regions.popitem(last=False)
+            self.loadedKB -= region.sizeKB
+            self.regionEvictions += 1
+
+    def GetRegionForCell(self, cellX, cellY):
+        if cellX < 0 or cellY < 0 or cellX >= self.mapWidth or cellY >= self.mapHeight:
+            return None
+        return self.GetRegion(cellX // self.regionSize, cellY // self.regionSize)
+
+    # The cellInfoDict entry for a cell (None if it is not a floor
+    # cell).
+    def GetCellInfo(self, cellX, cellY):
+        region = self.GetRegionForCell(cellX, cellY)
+        if region is None:
+            return None
+        return region.cellInfoDict.get(self.CalculateIndex(cellX, cellY))
+
+    # The CalcNodeData tuple for the cell in a layer (None if the cell
+    # is empty in that layer).
+    def GetLayerTile(self, layerName, cellX, cellY):
+        region = self.GetRegionForCell(cellX, cellY)
+        if region is None:
+            return None
+        return region.layerDict[layerName].get(self.CalculateIndex(cellX, cellY))
+
+    # The game objects with their lowest cell in the rectangle of
+    # cells (the end not included), as goType -> list of objects.
+    def GetGameObjectsInRect(self, cellX1, cellY1, cellX2, cellY2):
+        regionSize = self.regionSize
+        result = {}
+        for regionY in xrange(max(cellY1, 0) // regionSize, (min(cellY2, self.mapHeight) - 1) // regionSize + 1):
+            for regionX in xrange(max(cellX1, 0) // regionSize, (min(cellX2, self.mapWidth) - 1) // regionSize + 1):
+                region = self.GetRegion(regionX, regionY)
+                for goType, goList in region.gameObjectDict.iteritems():
+                    for go in goList:
+                        cellX = go["SubjectID"] % self.mapWidth
+                        cellY = go["SubjectID"] / self.mapWidth
+                        if cellX1 <= cellX < cellX2 and cellY1 <= cellY < cellY2:
+                            result.setdefault(goType, []).append(go)
+        return result
+
+    def CompileRegion(self, regionX, regionY):
+        cellX1 = regionX * self.regionSize
+        cellY1 = regionY * self.regionSize
+        cellX2 = min(cellX1 + self.regionSize, self.mapWidth)
+        cellY2 = min(cellY1 + self.regionSize, self.mapHeight)
+        region = MapRegion(regionX, regionY, (cellX1, cellY1, cellX2, cellY2))
+        for layerName in MapData.EXPECTED_LAYERS:
+            region.layerDict[layerName] = self.ExpandLayerTiles(layerName, cellX1, cellY1, cellX2, cellY2)
+        self.CalculateRegionCells(region)
+        self.CalculateRegionObjects(region)
+        tiles = sum(len(tileData) for tileData in region.layerDict.itervalues())
+        region.sizeKB = (tiles * TILE_BYTES + len(region.cellInfoDict) * CELL_BYTES) / 1024 + 1
+        return region
+
+    # The layer dictionary (as in MapData.layerDict) for a rectangle
+    # of cells.
+    def ExpandLayerTiles(self, layerName, cellX1, cellY1, cellX2, cellY2):
+        gids = numpy.asarray(self.layerGIDs[layerName][cellY1:cellY2, cellX1:cellX2])
+        rows, cols = numpy.nonzero(gids)
+        tileData = {}
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            index = (cellY1 + row) * self.mapWidth + cellX1 + col
+            tileData[index] = self.CalcNodeData(index, int(gids[row, col]))
+        return tileData
+
+    # The room a cell is in, checking the rooms in the same order as
+    # MapData.CalculateCellsInRooms.
+    def GetCellRoom(self, cellX, cellY, roomNames=None):
+        if roomNames is None:
+            roomNames = self.roomNames
+        topLeft = (cellX * self.tileWidth, cellY * self.tileHeight)
+        botRight = (topLeft[0] + self.tileWidth, topLeft[1] + self.tileHeight)
+        for room in roomNames:
+            rTopLeft, rBotRight = self.roomInfoDict[room]['Bounds']
+            if self.Overlaps(topLeft, botRight, rTopLeft, rBotRight):
+                return room
+        return "HALLWAY"
+
+    def CalculateRegionCells(self, region):
+        cellX1, cellY1, cellX2, cellY2 = region.cellBounds
+        topLeft = (cellX1 * self.tileWidth, cellY1 * self.tileHeight)
+        botRight = (cellX2 * self.tileWidth, cellY2 * self.tileHeight)
+        # Only the rooms that overlap the region need to be checked.
+        roomNames = [room for room in self.roomNames
+                     if self.Overlaps(topLeft, botRight, *self.roomInfoDict[room]['Bounds'])]
+        for index, tileID, cellX, cellY, topLeft, botRight, flipX, flipY, flipD in region.layerDict['Floor'].itervalues():
+            region.cellInfoDict[index] = {"Cell": (cellX, cellY),
+                                          "Room": self.GetCellRoom(cellX, cellY, roomNames),
+                                          "Objects": []}
+
+    def CalculateRegionObjects(self, region):
+        cellX1, cellY1, cellX2, cellY2 = region.cellBounds
+        marginX1 = max(cellX1 - OBJECT_MARGIN, 0)
+        marginY1 = max(cellY1 - OBJECT_MARGIN, 0)
+        marginX2 = min(cellX2 + OBJECT_MARGIN, self.mapWidth)
+        marginY2 = min(cellY2 + OBJECT_MARGIN, self.mapHeight)
+        gids = numpy.asarray(self.layerGIDs["Objects"][marginY1:marginY2, marginX1:marginX2])
+        typeCodes = self.GetObjectTypeCodes(gids)
+        rows, cols = numpy.nonzero(typeCodes)
+        objectTypes = {}
+        for row, col, code in zip(rows.tolist(), cols.tolist(), typeCodes[rows, cols].tolist()):
+            objectTypes[(marginX1 + col, marginY1 + row)] = self.objectTypeNames[code]
+        # The object type at a cell (None for none).  An object can
+        # reach past the margin; the cells out there are read one at
+        # a time as the clustering gets to them.
+        def GetObjectType(cellX, cellY):
+            if marginX1 <= cellX < marginX2 and marginY1 <= cellY < marginY2:
+                return objectTypes.get((cellX, cellY))
+            if (cellX, cellY) not in objectTypes:
+                objectTypes[(cellX, cellY)] = self.ReadObjectType(cellX, cellY)
+            return objectTypes[(cellX, cellY)]
+        goDict = {}
+        for goType in MapData.EXPECTED_GAME_OBJECTS:
+            goDict[goType] = []
+        clustered = set()
+        for cell in sorted(objectTypes, key=lambda cell: (cell[1], cell[0])):
+            if cell in clustered:
+                continue
+            objectType = objectTypes[cell]
+            if objectType is None:
+                continue
+            cluster = [cell]
+            clustered.add(cell)
+            queue = collections.deque([cell])
+            while len(queue) > 0:
+                cellX, cellY = queue.popleft()
+                for adj in ((cellX, cellY - 1), (cellX + 1, cellY), (cellX, cellY + 1), (cellX - 1, cellY)):
+                    if not (0 <= adj[0] < self.mapWidth and 0 <= adj[1] < self.mapHeight):
+                        continue
+                    if adj not in clustered and GetObjectType(*adj) == objectType:
+                        clustered.add(adj)
+                        cluster.append(adj)
+                        queue.append(adj)
+            if not any(region.ContainsCell(cellX, cellY) for cellX, cellY in cluster):
+                continue
+            goCells = sorted(self.CalculateIndex(cellX, cellY) for cellX, cellY in cluster)
+            subjectID = goCells[0]
+            for cellX, cellY in cluster:
+                cellInfo = region.cellInfoDict.get(self.CalculateIndex(cellX, cellY))
+                if cellInfo is not None:
+                    cellInfo["Objects"].append((objectType, subjectID))
+            firstX = subjectID % self.mapWidth
+            firstY = subjectID / self.mapWidth
+            if region.ContainsCell(firstX, firstY):
+                goDict.setdefault(objectType, []).append({"Room": self.GetCellRoom(firstX, firstY),
+                                                          "Cells": goCells, "SubjectID": subjectID})
+        region.gameObjectDict = goDict
+
+    # The object type of one cell of the Objects layer (None for none).
+    def ReadObjectType(self, cellX, cellY):
+        code = self.GetObjectTypeCodes(numpy.asarray(self.layerGIDs["Objects"][cellY:cellY + 1, cellX:cellX + 1]))
+        code = int(code.flat[0])
+        if code == 0:
+            return None
+        return self.objectTypeNames[code]
+
+    def GetLoadReport(self):
+        regionsX, regionsY = self.GetRegionCounts()
+        return {
+            "Regions": regionsX * regionsY,
+            "Regions Loaded": len(self.regions),
+            "Region Loads": self.regionLoads,
+            "Region Hits": self.regionHits,
+            "Region Evictions": self.regionEvictions,
+            "Loaded KB": self.loadedKB,
+            "Peak Loaded KB": self.peakLoadedKB,
+        }
+
+    def DumpLoadInfo(self):
+        print '----------------- REGION INFO ------------------ '
+        report = self.GetLoadReport()
+        for key in sorted(report):
+            print " - [%-18s] %s" % (key, report[key])
+        print '------------------------------------------------ '
+        print
+
+
+# Compare every region with the whole map expanded by MapData.
+# Returns a list of the differences.
+def CompareWithMapData(chunkedMap, mapData):
+    differences = []
+    regionsX, regionsY = chunkedMap.GetRegionCounts()
+    layerDict = dict((layerName, {}) for layerName in MapData.EXPECTED_LAYERS)
+    cellInfoDict = {}
+    objects = set()
+    for regionY in xrange(regionsY):
+        for regionX in xrange(regionsX):
+            region = chunkedMap.GetRegion(regionX, regionY)
+            for layerName in MapData.EXPECTED_LAYERS:
+                layerDict[layerName].update(region.layerDict[layerName])
+            cellInfoDict.update(region.cellInfoDict)
+            for goType, goList in region.gameObjectDict.iteritems():
+                for go in goList:
+                    objects.add((goType, go["Room"], tuple(go["Cells"])))
+    for layerName in MapData.EXPECTED_LAYERS:
+        if layerDict[layerName] != mapData.layerDict[layerName]:
+            differences.append("Layer %s" % layerName)
+    for index, cellInfo in mapData.cellInfoDict.iteritems():
+        other = cellInfoDict.get(index)
+        if other is None or other["Cell"] != cellInfo["Cell"] or other["Room"] != cellInfo["Room"]:
+            differences.append("Cell %d" % index)
+    if len(cellInfoDict) != len(mapData.cellInfoDict):
+        differences.append("Cell count %d != %d" % (len(cellInfoDict), len(mapData.cellInfoDict)))
+    expected = set()
+    for goType, goList in mapData.gameObjectDict.iteritems():
+        for go in goList:
+            expected.add((goType, go["Room"], tuple(sorted(go["Cells"]))))
+    if objects != expected:
+        differences.append("Game objects (%d != %d)" % (len(objects), len(expected)))
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Open a map in regions and walk agents around it.")
+    parser.add_argument("fileName", nargs="?", default="Spaceship 3.tmx")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--region-size", type=int, default=DEFAULT_REGION_SIZE)
+    parser.add_argument("--budget-kb", type=int, default=DEFAULT_MEMORY_BUDGET_KB)
+    parser.add_argument("--walkers", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true",
+                        help="Compare the regions with the map expanded by MapData (small maps only).")
+    args = parser.parse_args()
+
+    chunkedMap = ChunkedMapData(args.region_size, args.budget_kb)
+    if not chunkedMap.OpenTMX(args.fileName, args.cache_dir):
+        raise SystemExit(1)
+    chunkedMap.DumpProfileInfo()
+    print "Map is %d x %d cells in %d x %d regions." % ((chunkedMap.mapWidth, chunkedMap.mapHeight) +
+                                                        chunkedMap.GetRegionCounts())
+    # Each walker looks up the cell it is on, then moves a few cells
+    # in a random direction, so the regions are used the way agents
+    # moving about the map would use them.
+    rng = random.Random(args.seed)
+    walkers = [[rng.randrange(chunkedMap.mapWidth), rng.randrange(chunkedMap.mapHeight)]
+               for idx in xrange(args.walkers)]
+    start = time.time()
+    floorCells = 0
+    for step in xrange(args.steps):
+        walker = walkers[step % len(walkers)]
+        if chunkedMap.GetCellInfo(walker[0], walker[1]) is not None:
+            floorCells += 1
+        walker[0] = min(max(walker[0] + rng.randint(-4, 4), 0), chunkedMap.mapWidth - 1)
+        walker[1] = min(max(walker[1] + rng.randint(-4, 4), 0), chunkedMap.mapHeight - 1)
+    print "%d lookups (%d on floor cells) in %.3f s" % (args.steps, floorCells, time.time() - start)
+    chunkedMap.DumpLoadInfo()
+    if args.check:
+        mapData = MapData()
+        mapData.ParseTMXData(args.fileName, dumpInfo=False)
+        differences = CompareWithMapData(chunkedMap, mapData)
+        print "Same as MapData" if len(differences) == 0 else "Different: %s" % ", ".join(differences)
@@ -14,14 +14,42 @@ NOTE:
 2.  The origin in Tiled is the TOP LEFT.  Internally, the data is
     stored with the Tiled origin.  When it is emitted, it is converted
     to the target format.
+3.  Each phase of ParseTMXData is timed and the change in memory
+    (resident set size), the peak memory of the process so far and the
+    number of items it produced are recorded.  GetProfileReport
+    returns these numbers and SaveProfileReport writes them as JSON.
+    Python 2 does not have tracemalloc, so the memory is for the whole
+    process, not just the objects allocated by the phase.
+4.  The tilesets (embedded or external .tsx files) are read through
+    the shared TilesetCache, so a tileset used by many maps is only
+    parsed once.  All the tile properties are kept in tileProperties
+    and gidTypeCodes is a dense array of the OBJECT_TYPE of every gid
+    (as an index into objectTypeNames), for the layer stages.
 """
 
+import argparse
+import base64
+import gzip
+import json
 import os
+import sys
+import time
+import zlib
+from StringIO import StringIO
 
+import numpy
 from lxml import etree
 from PIL import Image
 
+from TilesetCache import GetTilesetCache, OBJECT_TYPE_PROPERTY
 
+# The memory helpers live with the planner statistics in the Phase I
+# folder.
+PHASE_I_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Phase I - Basic Concept")
+if PHASE_I_DIR not in sys.path:
+    sys.path.append(PHASE_I_DIR)
+
+from PlannerStats import GetMemoryUsageKB, GetPeakMemoryKB
 
 
 class MapData(object):
@@ -29,6 +57,8 @@ class MapData(object):
     FLIPPED_HORIZONTALLY_FLAG = 0x80000000
     FLIPPED_VERTICALLY_FLAG = 0x40000000
     FLIPPED_DIAGONALLY_FLAG = 0x20000000
+    # The gid with the flip flags taken off.
+    GID_MASK = 0x1FFFFFFF
     EXPECTED_LAYERS = ["Floor",
                        "Walls",
                        "Objects",
@@ -83,9 +113,21 @@ class MapData(object):
         # The XML Tree used to hold the original file
         # data.  Set to None by default.
         self.tree = None
+        # The .tmx file (external tilesets are relative to it).
+        self.fileName = None
+        # The tilesets of the map, as (firstGID, TilesetInfo, the
+        # directory the tileset is in).
+        self.tilesets = []
         # A dictionary of the tileset used for the map,
         # keyed by the tileID
         self.tileDict = {}
+        # All the properties of the tiles that have them, keyed by
+        # the tileID.
+        self.tileProperties = {}
+        # The OBJECT_TYPE of every tileID, as an index into
+        # objectTypeNames (0, None, for no type).
+        self.objectTypeNames = [None]
+        self.gidTypeCodes = numpy.zeros(1, dtype=numpy.int16)
         # A dictionary containing a tuple of the index, cellX, and
         # cellY for each cell that in the room.
         self.roomCell = {}
@@ -111,8 +153,74 @@ class MapData(object):
         # reference for later.
         self.gameObjectDict = {}
 
+        # The timing, memory and counts for each phase of the last
+        # call to ParseTMXData.
+        self.profile = []
+
+    # Run one phase of ParseTMXData and record how long it took, the
+    # change in memory and what it produced.
+    def RunPhase(self, name, phase):
+        memoryBefore = GetMemoryUsageKB()
+        start = time.time()
+        result = phase()
+        elapsed = time.time() - start
+        self.profile.append({
+            "Phase": name,
+            "Seconds": elapsed,
+            "Memory KB": GetMemoryUsageKB() - memoryBefore,
+            "Peak Memory KB": GetPeakMemoryKB(),
+            "Counts": self.GetPhaseCounts(name) if result else {},
+            "Result": bool(result),
+        })
+        return result
+
+    # The number of items produced by a phase.  These are cheap to
+    # work out; walking the whole tree would cost as much as a phase.
+    def GetPhaseCounts(self, name):
+        if name == "ParseXML":
+            return {"Bytes": os.path.getsize(self.fileName),
+                    "Layers": len(self.tree.getroot().findall("layer"))}
+        elif name == "ExtractMapInfo":
+            return {"Cells": self.mapWidth * self.mapHeight}
+        elif name == "ExtractTilesetInformation":
+            return {"Tile Types": len(self.tileDict)}
+        elif name == "ExtractRoomBoundsInformation":
+            return {"Rooms": len(self.roomInfoDict)}
+        elif name == "ExtractLayerInformation":
+            return {"Layers": len(self.layerDict),
+                    "Tiles": sum(len(tileData) for tileData in self.layerDict.itervalues())}
+        elif name == "CalculateCellsInRooms":
+            return {"Rooms": len(self.roomCells),
+                    "Cells": len(self.cellInfoDict)}
+        elif name == "CalculateGameObjects":
+            return {"Clusters": sum(len(goList) for goList in self.gameObjectDict.itervalues()),
+                    "Object Types": len([goType for goType in self.gameObjectDict if len(self.gameObjectDict[goType]) > 0])}
+        return {}
+
+    def GetProfileReport(self):
+        return {
+            "Phases": self.profile,
+            "Seconds": sum(phase["Seconds"] for phase in self.profile),
+            "Memory KB": GetMemoryUsageKB(),
+        }
+
+    def SaveProfileReport(self, fileName):
+        with open(fileName, "w") as outFile:
+            json.dump(self.GetProfileReport(), outFile, indent=2, sort_keys=True)
+        return True
+
+    def DumpProfileInfo(self):
+        print '----------------- PROFILE INFO ------------------ '
+        for phase in self.profile:
+            counts = ", ".join("%s %d" % (key, phase["Counts"][key]) for key in sorted(phase["Counts"]))
+            print "%-30s %9.3f ms %8d KB  %s" % (phase["Phase"], phase["Seconds"] * 1000.0,
+                                                 phase["Memory KB"], counts)
+        print "%-30s %9.3f ms" % ("Total", sum(phase["Seconds"] for phase in self.profile) * 1000.0)
+        print '------------------------------------------------- '
+        print
+
     def CalcNodeData(self, index, gid):
-        tileID = gid & 0x00FFFFFF
+        tileID = gid & MapData.GID_MASK
         flipX = (gid & MapData.FLIPPED_HORIZONTALLY_FLAG) > 0
         flipY = (gid & MapData.FLIPPED_VERTICALLY_FLAG) > 0
         flipD = (gid & MapData.FLIPPED_DIAGONALLY_FLAG) > 0
@@ -196,6 +304,38 @@ class MapData(object):
         self.roomInfoDict = roomInfoDict
         return True
 
+    # Get the list of gids from a layer's <data> element.  Tiled can
+    # store these as one <tile> element per gid, as CSV text or as
+    # base64 encoded (and possibly compressed) little-endian integers.
+    def ReadLayerGIDs(self, data):
+        return self.ReadEncodedGIDs(data, data.attrib.get('encoding'), data.attrib.get('compression'))
+
+    # The same for any element holding gids (a <data> or, in an
+    # infinite map, a <chunk> in it), with the encoding of the <data>.
+    # With asArray, the gids are returned as a numpy array, which
+    # takes far less memory for big layers.
+    def ReadEncodedGIDs(self, element, encoding, compression, asArray=False):
+        if encoding is None:
+            gids = [int(tile.attrib["gid"]) for tile in element.findall("tile")]
+            return numpy.array(gids, dtype=numpy.uint32) if asArray else gids
+        if encoding == "csv":
+            if asArray:
+                return numpy.array(element.text.replace("\n", "").strip().strip(",").split(","), dtype=numpy.uint32)
+            return [int(gid) for gid in element.text.replace("\n", "").split(",") if gid.strip() != ""]
+        if encoding == "base64":
+            raw = base64.b64decode(element.text.strip())
+            if compression == "zlib":
+                raw = zlib.decompress(raw)
+            elif compression == "gzip":
+                raw = gzip.GzipFile(fileobj=StringIO(raw)).read()
+            elif compression is not None:
+                print "Layer compression %s is not supported." % compression
+                return None
+            gids = numpy.frombuffer(raw, dtype="<u4")
+            return gids if asArray else gids.tolist()
+        print "Layer encoding %s is not supported." % encoding
+        return None
+
     def ExtractLayerInformation(self):
         # There are certain layers that are
         # specifically searched for.  If a necessary
@@ -207,7 +347,7 @@ class MapData(object):
         for layer in layers:
             name = layer.attrib['name']
             if name not in MapData.EXPECTED_LAYERS:
-                print "Layer [%s] not used in processing."
+                print "Layer [%s] not used in processing." % name
                 continue
             # Found one we care about.
             width = int(layer.attrib['width'])
@@ -218,16 +358,19 @@ class MapData(object):
                 )
                 print "Unable to continue..."
                 return False
-            tiles = layer[0].findall("tile")
-            if len(tiles) != self.mapWidth*self.mapHeight:
+            gids = self.ReadLayerGIDs(layer.find("data"))
+            if gids is None:
+                print "Unable to continue..."
+                return False
+            if len(gids) != self.mapWidth*self.mapHeight:
                 print "Layer %s tile count [%d] does not match expected [%d]."%(
-                    name,len(tiles),self.mapWidth*self.mapHeight
+                    name,len(gids),self.mapWidth*self.mapHeight
                 )
                 print "Unable to continue..."
                 return False
             tileData = {}
-            for idx in xrange(len(tiles)):
-                gid = int(tiles[idx].attrib["gid"])
+            for idx in xrange(len(gids)):
+                gid = gids[idx]
                 if gid > 0:
                     tileData[idx] = self.CalcNodeData(idx, gid)
             layerDict[name] = tileData
@@ -259,6 +402,7 @@ class MapData(object):
         # A dictionary of the tile IDs and the type of
         # OBJECT_TYPE they map to.
         tileDict = {}
+        tileProperties = {}
         # Bring in the tileset data.
         root = self.tree.getroot()
         tilesets = root.findall("tileset")
@@ -266,27 +410,42 @@ class MapData(object):
             print "Tileset count = ", len(tilesets)
             print "Unable to continue..."
             return False
+        baseDir = os.path.dirname(os.path.abspath(self.fileName)) if self.fileName else os.getcwd()
+        self.tilesets = []
         for tileset in tilesets:
             firstGID = int(tileset.attrib['firstgid'])
-            tiles = tileset.findall("tile")
+            info, tilesetDir = GetTilesetCache().GetTileset(tileset, baseDir)
+            if info is None:
+                print "Unable to continue..."
+                return False
+            self.tilesets.append((firstGID, info, tilesetDir))
             # Get the data associated with each tile.
-            for element in tiles:
-                # Get the local (in the tilset) ID for the tile.
-                tileID = int(element.attrib['id'])
+            for tileID, properties in info.properties.iteritems():
                 tileGID = tileID + firstGID
+                tileProperties[tileGID] = properties
                 # Get the OBJECT_TYPE for the tile
-                properties = element.findall("properties")
-                if len(properties) != 1:
-                    continue
-                property = properties[0].findall("property")
-                if len(property) != 1:
-                    continue
-                if property[0].attrib['name'] == "OBJECT_TYPE":
-                    objectType = property[0].attrib['value']
-                    tileDict[tileGID] = (objectType,tileID)
-            self.tileDict = tileDict
+                if properties.has_key(OBJECT_TYPE_PROPERTY):
+                    tileDict[tileGID] = (properties[OBJECT_TYPE_PROPERTY], tileID)
+        self.tileDict = tileDict
+        self.tileProperties = tileProperties
+        self.CreateObjectTypeLookup()
         return True
 
+    # Build objectTypeNames and gidTypeCodes from tileDict.
+    def CreateObjectTypeLookup(self):
+        self.objectTypeNames = [None] + sorted(set(objectType for objectType, localID in self.tileDict.itervalues()))
+        typeCodes = dict((objectType, code) for code, objectType in enumerate(self.objectTypeNames))
+        self.gidTypeCodes = numpy.zeros(max(self.tileDict.keys() + [0]) + 1, dtype=numpy.int16)
+        for gid, (objectType, localID) in self.tileDict.iteritems():
+            self.gidTypeCodes[gid] = typeCodes[objectType]
+
+    # The OBJECT_TYPE codes (see gidTypeCodes) of an array of gids.
+    # The flip flags are ignored and unknown gids are 0.
+    def GetObjectTypeCodes(self, gids):
+        tileIDs = numpy.asarray(gids, dtype=numpy.uint32) & MapData.GID_MASK
+        tileIDs[tileIDs >= len(self.gidTypeCodes)] = 0
+        return self.gidTypeCodes[tileIDs]
+
     def DumpTilesetInfo(self):
         tileDict = self.tileDict
         keys = tileDict.keys()
@@ -399,12 +558,17 @@ class MapData(object):
     def CalculateGameObjects(self):
         # Determine all the objects in the game.  Assign the
         # user markers for all of them.
-        tempDict = {}
-        for cellIdx in self.layerDict["Objects"]:
-            idx,tileID,cellX,cellY,topLeft,botRight,flipX,flipY,flipD = self.layerDict["Objects"][cellIdx]
-            # Lookup the OBJECT_TYPE from the tile information.
-            objectType,localID = self.tileDict[tileID]
-            tempDict[cellIdx] = objectType
+        objectLayer = self.layerDict["Objects"]
+        cellIdxs = objectLayer.keys()
+        tileIDs = [objectLayer[cellIdx][1] for cellIdx in cellIdxs]
+        # Lookup the OBJECT_TYPE from the tile information.
+        typeCodes = self.GetObjectTypeCodes(tileIDs).tolist()
+        if 0 in typeCodes:
+            tileID = tileIDs[typeCodes.index(0)]
+            print "Tile %d in the Objects layer has no OBJECT_TYPE." % tileID
+            print "Unable to continue..."
+            return False
+        tempDict = dict(zip(cellIdxs, [self.objectTypeNames[code] for code in typeCodes]))
         # Now we have a dictionary indexed by cells with each of the object types as the
         # data.  What we want to do is "cluster" these by object type.
         objects = self.ClusterObjectTypes(tempDict)
@@ -483,31 +647,86 @@ class MapData(object):
         print '----------------------------------------------------- '
         print
 
+    # Write the computed map data (not the raw XML) out as JSON so
+    # it can be loaded without parsing the .tmx file again.
+    def SaveMapData(self, fileName):
+        data = {
+            "Map": {
+                "tileWidth": self.tileWidth,
+                "tileHeight": self.tileHeight,
+                "mapWidth": self.mapWidth,
+                "mapHeight": self.mapHeight,
+                "subjectID": self.subjectID,
+            },
+            "Rooms": self.roomInfoDict,
+            "Cells": self.cellInfoDict,
+            "GameObjects": self.gameObjectDict,
+        }
+        with open(fileName, "w") as outFile:
+            json.dump(data, outFile, sort_keys=True)
+        return True
+
+    # Read back the data written by SaveMapData.  JSON turns the
+    # integer cell keys into strings and tuples into lists, so these
+    # are converted back.
+    def LoadMapData(self, fileName):
+        if not os.path.exists(fileName):
+            print "File %s does not exist!!!" % fileName
+            return False
+        self.SetDefaults()
+        with open(fileName, "r") as inFile:
+            data = json.load(inFile)
+        mapInfo = data["Map"]
+        self.tileWidth = mapInfo["tileWidth"]
+        self.tileHeight = mapInfo["tileHeight"]
+        self.mapWidth = mapInfo["mapWidth"]
+        self.mapHeight = mapInfo["mapHeight"]
+        self.subjectID = mapInfo["subjectID"]
+        for room, roomInfo in data["Rooms"].iteritems():
+            if roomInfo.has_key("Bounds"):
+                (x1, y1), (x2, y2) = roomInfo["Bounds"]
+                roomInfo["Bounds"] = ((x1, y1), (x2, y2))
+            self.roomInfoDict[str(room)] = roomInfo
+        for index, cellInfo in data["Cells"].iteritems():
+            cellInfo["Cell"] = tuple(cellInfo["Cell"])
+            cellInfo["Objects"] = [(str(goType), subjectID) for goType, subjectID in cellInfo["Objects"]]
+            cellInfo["Room"] = str(cellInfo["Room"])
+            self.cellInfoDict[int(index)] = cellInfo
+        for goType, goList in data["GameObjects"].iteritems():
+            for go in goList:
+                go["Room"] = str(go["Room"])
+            self.gameObjectDict[str(goType)] = goList
+        return True
+
     # This function drives all the data extraction.
-    def ParseTMXData(self, fileName):
+    def ParseTMXData(self, fileName, dumpInfo=True):
         # Is the filename valid?
         if not os.path.exists(fileName):
             print "File %s does not exist!!!" % fileName
             return False
         # Wipe out existing information
         self.SetDefaults()
+        self.fileName = fileName
         # Get the XML data from the .tmx file.
-        self.tree = etree.parse(fileName)
+        def ParseXML():
+            self.tree = etree.parse(fileName)
+            return True
+        self.RunPhase("ParseXML", ParseXML)
 
         # The first several operations extract the
         # data into internal structures.  This is
         # really "raw" data but in a different format.
         # No reall processing or validation, yet.
-        if not self.ExtractMapInfo():
+        if not self.RunPhase("ExtractMapInfo", self.ExtractMapInfo):
             return False
         # Pull out the tileset
-        if not self.ExtractTilesetInformation():
+        if not self.RunPhase("ExtractTilesetInformation", self.ExtractTilesetInformation):
             return False
 
-        if not self.ExtractRoomBoundsInformation():
+        if not self.RunPhase("ExtractRoomBoundsInformation", self.ExtractRoomBoundsInformation):
             return False
 
-        if not self.ExtractLayerInformation():
+        if not self.RunPhase("ExtractLayerInformation", self.ExtractLayerInformation):
             return False
 
         # Now that we have all the information, we
@@ -515,23 +734,35 @@ class MapData(object):
         # really want.
 
         # Calculate which cells are in each room.
-        if not self.CalculateCellsInRooms():
+        if not self.RunPhase("CalculateCellsInRooms", self.CalculateCellsInRooms):
             return False
 
         # Calculate the basic game object information.
-        if not self.CalculateGameObjects():
+        if not self.RunPhase("CalculateGameObjects", self.CalculateGameObjects):
             return False
 
-        self.DumpMapInfo()
-        #self.DumpTilesetInfo()
-        #self.DumpLayerInfo()
-        #self.DumpRoomCellsInfo()
-        self.DumpCellInfo()
-        self.DumpRoomInfo()
-        self.DumpGameObjectInfo()
+        if dumpInfo:
+            self.DumpMapInfo()
+            #self.DumpTilesetInfo()
+            #self.DumpLayerInfo()
+            #self.DumpRoomCellsInfo()
+            self.DumpCellInfo()
+            self.DumpRoomInfo()
+            self.DumpGameObjectInfo()
 
         return True
 
 
-mapData = MapData()
-mapData.ParseTMXData("Spaceship 3.tmx")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the map data from a .tmx file.")
+    parser.add_argument("fileName", nargs="?", default="Spaceship 3.tmx")
+    parser.add_argument("--no-dump", action="store_true",
+                        help="Do not print the extracted data.")
+    parser.add_argument("--profile", default=None,
+                        help="Write the time, memory and counts for each phase to this JSON file.")
+    args = parser.parse_args()
+    mapData = MapData()
+    mapData.ParseTMXData(args.fileName, dumpInfo=not args.no_dump)
+    mapData.DumpProfileInfo()
+    if args.profile is not None:
+        mapData.SaveProfileReport(args.profile)
@@ -1,5 +1,10 @@
 from PIL import Image
+from multiprocessing.pool import ThreadPool
 import glob, os, math
+import hashlib, json
+import numpy
+from numpy.lib.stride_tricks import as_strided
+from TextureAtlas import CreateAtlas
 
 OFFSET_X = 0
 OFFSET_Y = 0
@@ -12,34 +17,129 @@ FORMAT = r"TILE_%03d.png"
 GLOB_FORMAT = "TILE_*.png"
 FILE_NAME = r"RPG_ICONS_TOP_64x64.png"
 FILE_NAME_OUT = r"OUTPUT_FILE.png"
+MANIFEST_OUT = r"OUTPUT_FILE.plist"
 IMAGE_OUT_DIR = r"Images"
+# Keeps track of the tile files written to IMAGE_OUT_DIR (by the hash
+# of their pixels) so unchanged tiles are not written again.
+TILE_MANIFEST = r"tiles.json"
+# Number of threads used to write tile files.
+WRITE_THREADS = 8
 
 def NextPowerOfTwo(value):
     return int(math.pow(2,math.ceil(math.log(value,2))))
 
-def ExtractTiles(fileName,offsetX,offsetY,gapX,gapY,sizeX,sizeY):
+# Load the sheet once and return every tile as a view into it.  The
+# result has the shape (tilesHigh, tilesWide, sizeY, sizeX, ...) and
+# no pixel data is copied, unless the last row/column of tiles runs
+# off the edge of the sheet.  Then the sheet is padded (once) with
+# zeros, the same as cropping outside the image does.  Also returns
+# the image the sheet came from (for the mode and palette).
+def ExtractTileArrays(fileName,offsetX,offsetY,gapX,gapY,sizeX,sizeY):
     im = Image.open(fileName)
-    result = []
-    xSize,ySize = im.size
-    xPixel = offsetX
-    yPixel = offsetY
-    while (yPixel < ySize):
-        xPixel = offsetX
-        while(xPixel < xSize):
-            cropTuple = (xPixel,yPixel,xPixel+SIZE_X,yPixel+SIZE_Y)
-            part = im.crop(cropTuple)
-            result.append(part)
-            xPixel = xPixel + (GAP_X + SIZE_X)
-        yPixel = yPixel + (GAP_Y + SIZE_Y)
-    return result
+    if im.mode == "1":
+        im = im.convert("L")
+    sheet = numpy.asarray(im)
+    ySize,xSize = sheet.shape[:2]
+    stepX = gapX + sizeX
+    stepY = gapY + sizeY
+    tilesWide = max(0, int(math.ceil((xSize - offsetX) * 1.0 / stepX)))
+    tilesHigh = max(0, int(math.ceil((ySize - offsetY) * 1.0 / stepY)))
+    neededX = offsetX + (tilesWide - 1) * stepX + sizeX
+    neededY = offsetY + (tilesHigh - 1) * stepY + sizeY
+    if tilesWide > 0 and tilesHigh > 0 and (neededX > xSize or neededY > ySize):
+        padding = [(0, max(0, neededY - ySize)), (0, max(0, neededX - xSize))]
+        padding += [(0, 0)] * (sheet.ndim - 2)
+        sheet = numpy.pad(sheet, padding, mode="constant")
+    sheet = sheet[offsetY:, offsetX:]
+    strides = sheet.strides
+    shape = (tilesHigh, tilesWide, sizeY, sizeX) + sheet.shape[2:]
+    tileStrides = (strides[0] * stepY, strides[1] * stepX) + strides
+    tiles = as_strided(sheet, shape=shape, strides=tileStrides)
+    tiles.flags.writeable = False
+    return tiles, im
+
+# Turn a tile array back into an image with the same mode (and
+# palette) as the sheet it came from.
+def TileArrayToImage(tile, sheetImage):
+    image = Image.fromarray(numpy.ascontiguousarray(tile), sheetImage.mode)
+    if sheetImage.mode == "P":
+        image.putpalette(sheetImage.getpalette())
+    return image
+
+def ExtractTiles(fileName,offsetX,offsetY,gapX,gapY,sizeX,sizeY):
+    tiles, im = ExtractTileArrays(fileName,offsetX,offsetY,gapX,gapY,sizeX,sizeY)
+    tilesHigh, tilesWide = tiles.shape[:2]
+    return [TileArrayToImage(tiles[row, col], im)
+            for row in xrange(tilesHigh) for col in xrange(tilesWide)]
+
+# A hash of the pixels in a tile.  The same pixels give the same hash
+# whether the tile is a PIL image or a tile array.
+def TileHash(image, sheetImage=None):
+    if isinstance(image, Image.Image):
+        mode, size, data = image.mode, image.size, image.tobytes()
+    else:
+        mode, size = sheetImage.mode, (image.shape[1], image.shape[0])
+        data = numpy.ascontiguousarray(image).tobytes()
+    return hashlib.sha1("%s%s%s" % (mode, size, data)).hexdigest()
+
+def LoadTileManifest():
+    manifestName = os.path.join(IMAGE_OUT_DIR,TILE_MANIFEST)
+    if not os.path.exists(manifestName):
+        return {"hashes":{}, "tiles":[]}
+    with open(manifestName,"r") as manifestFile:
+        return json.load(manifestFile)
 
-def CreateTileFiles(imageList,format,imageFormat):
-    imageIdx = 0
+# The images can either be PIL images or tile arrays (in which case
+# sheetImage is the image they were extracted from).
+#
+# Tiles with the same pixels share one file (named after the first of
+# them).  A file is only written if it is new or its pixels changed
+# since the last run (according to the tile manifest), and files that
+# are no longer used are removed.  The files are encoded and written
+# by a pool of threads.
+#
+# Returns the file name for every tile and whether anything changed.
+def CreateTileFiles(imageList,format,imageFormat,sheetImage=None):
     if not os.path.exists(IMAGE_OUT_DIR):
         os.mkdir(IMAGE_OUT_DIR)
-    for image in imageList:
-        imageIdx = imageIdx + 1
-        image.save(os.path.join(IMAGE_OUT_DIR,format%imageIdx),imageFormat)
+    oldManifest = LoadTileManifest()
+    oldFiles = dict((fileName, tileHash) for tileHash, fileName in oldManifest["hashes"].iteritems())
+    hashes = {}
+    tileFiles = []
+    toWrite = []
+    for imageIdx, image in enumerate(imageList):
+        tileHash = TileHash(image, sheetImage)
+        if tileHash not in hashes:
+            fileName = format%(imageIdx + 1)
+            hashes[tileHash] = fileName
+            if (oldFiles.get(fileName) != tileHash or
+                    not os.path.exists(os.path.join(IMAGE_OUT_DIR,fileName))):
+                toWrite.append((fileName, image))
+        tileFiles.append(hashes[tileHash])
+    # Remove the files that are not used any more.
+    usedFiles = set(hashes.itervalues())
+    removed = [fileName for fileName in oldFiles if fileName not in usedFiles]
+    for fileName in removed:
+        if os.path.exists(os.path.join(IMAGE_OUT_DIR,fileName)):
+            os.remove(os.path.join(IMAGE_OUT_DIR,fileName))
+    def SaveTile(args):
+        fileName, image = args
+        if not isinstance(image, Image.Image):
+            image = TileArrayToImage(image, sheetImage)
+        image.save(os.path.join(IMAGE_OUT_DIR,fileName),imageFormat)
+    pool = ThreadPool(WRITE_THREADS)
+    try:
+        pool.map(SaveTile, toWrite)
+    finally:
+        pool.close()
+        pool.join()
+    changed = len(toWrite) > 0 or len(removed) > 0 or tileFiles != oldManifest["tiles"]
+    print "Tiles = %d, files = %d, written = %d, removed = %d" % (
+        len(tileFiles), len(hashes), len(toWrite), len(removed))
+    if changed:
+        with open(os.path.join(IMAGE_OUT_DIR,TILE_MANIFEST),"w") as manifestFile:
+            json.dump({"hashes":hashes, "tiles":tileFiles}, manifestFile, indent=1, sort_keys=True)
+    return tileFiles, changed
 
 def CreateImageList(format):
     result = []
@@ -72,9 +172,19 @@ def CreateTileSet(imageList, fileName, imageFormat):
     print "Saving image file: ",fileName
     im.save(fileName,imageFormat)
 
-tiles = ExtractTiles(FILE_NAME,OFFSET_X,OFFSET_Y,GAP_X,GAP_Y,SIZE_X,SIZE_Y)
-#CreateTileFiles(tiles,FORMAT,IMAGE_FORMAT)
-#CreateTileSet(tiles,"Crunched.png",IMAGE_FORMAT)
-#tiles = CreateImageList(FORMAT)
-CreateTileSet(tiles,FILE_NAME_OUT,IMAGE_FORMAT)
-CreateTileFiles(tiles,FORMAT,IMAGE_FORMAT)
\ No newline at end of file
+if __name__ == "__main__":
+    # The tiles stay views into the sheet; only the ones that are
+    # written (or go into the atlas) are turned into images.
+    tileArrays, sheetImage = ExtractTileArrays(FILE_NAME,OFFSET_X,OFFSET_Y,GAP_X,GAP_Y,SIZE_X,SIZE_Y)
+    tiles = [tileArrays[row, col] for row in xrange(tileArrays.shape[0]) for col in xrange(tileArrays.shape[1])]
+    #CreateTileFiles(tiles,FORMAT,IMAGE_FORMAT)
+    #CreateTileSet(tiles,"Crunched.png",IMAGE_FORMAT)
+    #tiles = CreateImageList(FORMAT)
+    #CreateTileSet(tiles,FILE_NAME_OUT,IMAGE_FORMAT)
+    tileFiles, changed = CreateTileFiles(tiles,FORMAT,IMAGE_FORMAT,sheetImage)
+    # The atlas only needs to be rebuilt if a tile changed.
+    if changed or not os.path.exists(FILE_NAME_OUT) or not os.path.exists(MANIFEST_OUT):
+        images = [TileArrayToImage(tile, sheetImage) for tile in tiles]
+        CreateAtlas(images,[FORMAT%(idx+1) for idx in xrange(len(tiles))],FILE_NAME_OUT,MANIFEST_OUT,IMAGE_FORMAT)
+    else:
+        print "No tiles changed, not rebuilding %s." % FILE_NAME_OUT
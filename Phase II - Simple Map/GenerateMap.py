@@ -0,0 +1,278 @@
+"""
+Generate synthetic Tiled maps of any size, for testing and timing
+MapData on maps much bigger than the ones drawn by hand.
+
+The map is made from a template map (Spaceship 3.tmx by default): its
+tileset (with the tile properties) is copied into the new map, and
+the gids for each kind of tile are taken from it.  For a seed and a
+size, the same map is always generated:
+
+1. The map is cut into blocks of blockSize x blockSize cells, leaving
+   a one cell border.  Each block has one room, a rectangle of walls
+   of a random size and position in the block, with at least two
+   cells of hallway between it and the edge of the block.  Every cell
+   of the map (except the border) is floor.
+2. Each room has a door in one of its walls (not a corner), with a
+   door activator inside the room next to it.
+3. Game objects are put inside the rooms: rectangles of 1 x 1 to 2 x 2
+   cells of one type, each with a use marker next to it and its cells
+   blocked.  The types are dealt out so that every type in
+   MapData.EXPECTED_GAME_OBJECTS is used at least once (the rooms are
+   made big enough to hold them), and objects of the same type never
+   touch.
+4. The rooms are written to the "Rooms" objectgroup, half a tile
+   inside their walls, so the hallway next to the walls is not part
+   of the room.
+
+The layers can be written as CSV, base64 (optionally zlib
+compressed) or one <tile> element per gid ("xml").
+
+NOTE:
+1.  Every cell is floor, so MapData has as much work to do as the
+    map can give it.  That is the point; these maps are for timing.
+"""
+
+import argparse
+import collections
+import math
+import os
+import random
+from xml.sax.saxutils import quoteattr
+
+import numpy
+from lxml import etree
+
+from CreateMapData import MapData
+from PyxelEditToTiled import WriteTiledLayer, WriteTiledMapFooter
+
+DEFAULT_TEMPLATE = "Spaceship 3.tmx"
+DEFAULT_BLOCK_SIZE = 16
+MIN_ROOM_SIZE = 8
+LAYER_ENCODINGS = ["csv", "base64", "xml"]
+# The OBJECT_TYPE of the tiles used for each layer.  The walls do not
+# have a type, so the tile used most for walls in the template is
+# used.
+LAYER_TILE_TYPES = {
+    "Floor": "FLOOR",
+    "Doors": "DOOR",
+    "Door_Activators": "DOOR_ACTIVATOR_BLUE",
+    "Use_Markers": "USE_MARKER_1",
+    "Blocked": "BLOCKED_MARKER",
+}
+OBJECT_SIZES = [(1, 1), (2, 1), (1, 2), (2, 2)]
+PLACE_ATTEMPTS = 20
+
+
+# The tiles of the template map: (the tileset element, the gids for
+# each OBJECT_TYPE, the gid to use for walls).
+def ReadTemplate(templateName):
+    mapData = MapData()
+    if not mapData.ParseTMXData(templateName, dumpInfo=False):
+        return None
+    tileset = mapData.tree.getroot().find("tileset")
+    typeGIDs = collections.defaultdict(list)
+    for gid in sorted(mapData.tileDict):
+        typeGIDs[mapData.tileDict[gid][0]].append(gid)
+    wallCounts = collections.Counter(tileData[1] for tileData in mapData.layerDict["Walls"].itervalues())
+    wallGID = wallCounts.most_common(1)[0][0]
+    return tileset, typeGIDs, wallGID, mapData.tileWidth, mapData.tileHeight
+
+
+class MapGenerator(object):
+    def __init__(self, width, height, seed=0, templateName=DEFAULT_TEMPLATE, blockSize=DEFAULT_BLOCK_SIZE):
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.templateName = templateName
+        self.blockSize = blockSize
+        self.rng = random.Random(seed)
+        template = ReadTemplate(templateName)
+        if template is None:
+            raise ValueError("Unable to read template map %s." % templateName)
+        self.tileset, self.typeGIDs, self.wallGID, self.tileWidth, self.tileHeight = template
+        # Layer name -> (height, width) array of gids.
+        self.layers = dict((layerName, numpy.zeros((height, width), dtype=numpy.uint32))
+                           for layerName in MapData.EXPECTED_LAYERS)
+        # (name, (x, y, width, height)) in pixels.
+        self.rooms = []
+        # The object types still to place at least once.
+        self.typesToPlace = list(MapData.EXPECTED_GAME_OBJECTS)
+        self.rng.shuffle(self.typesToPlace)
+        self.objectCount = 0
+        # (cellX, cellY) -> the type of the object on it.
+        self.objectTypes = {}
+
+    def GetTileGID(self, layerName):
+        return self.typeGIDs[LAYER_TILE_TYPES[layerName]][0]
+
+    def Generate(self):
+        self.layers["Floor"][1:-1, 1:-1] = self.GetTileGID("Floor")
+        blockSize = self.blockSize
+        blocksX = max((self.width - 2) // blockSize, 0)
+        blocksY = max((self.height - 2) // blockSize, 0)
+        roomCount = blocksX * blocksY
+        for blockY in xrange(blocksY):
+            for blockX in xrange(blocksX):
+                roomsLeft = roomCount - len(self.rooms)
+                self.AddRoom(1 + blockX * blockSize, 1 + blockY * blockSize, roomsLeft)
+        if len(self.typesToPlace) > 0:
+            print "No space for game objects %s." % ", ".join(sorted(self.typesToPlace))
+        return True
+
+    # Add the room for the block with its top left at (x, y).
+    def AddRoom(self, x, y, roomsLeft):
+        rng = self.rng
+        maxSize = self.blockSize - 4
+        # Big enough for the object types still to place (a cell for
+        # each object and one for its marker).
+        needed = -(-len(self.typesToPlace) // roomsLeft)
+        minSize = max(MIN_ROOM_SIZE, int(math.ceil(math.sqrt(2 * needed + 1))) + 2)
+        minSize = min(minSize, maxSize)
+        roomWidth = rng.randint(minSize, maxSize)
+        roomHeight = rng.randint(minSize, maxSize)
+        x1 = x + 2 + rng.randint(0, maxSize - roomWidth)
+        y1 = y + 2 + rng.randint(0, maxSize - roomHeight)
+        x2 = x1 + roomWidth - 1
+        y2 = y1 + roomHeight - 1
+        walls = self.layers["Walls"]
+        walls[y1, x1:x2 + 1] = self.wallGID
+        walls[y2, x1:x2 + 1] = self.wallGID
+        walls[y1:y2 + 1, x1] = self.wallGID
+        walls[y1:y2 + 1, x2] = self.wallGID
+        # The door, on a random side, and its activator inside.
+        side = rng.randint(0, 3)
+        if side in (0, 2):
+            doorX = rng.randint(x1 + 1, x2 - 1)
+            doorY = y1 if side == 0 else y2
+            activator = (doorX + 1 if doorX + 1 < x2 else doorX - 1, doorY + 1 if side == 0 else doorY - 1)
+        else:
+            doorY = rng.randint(y1 + 1, y2 - 1)
+            doorX = x2 if side == 1 else x1
+            activator = (doorX - 1 if side == 1 else doorX + 1, doorY + 1 if doorY + 1 < y2 else doorY - 1)
+        walls[doorY, doorX] = 0
+        doorGIDs = self.typeGIDs["DOOR"]
+        self.layers["Doors"][doorY, doorX] = doorGIDs[rng.randrange(len(doorGIDs))]
+        self.layers["Door_Activators"][activator[1], activator[0]] = self.GetTileGID("Door_Activators")
+        # Fill the room with objects.
+        free = set((cellX, cellY) for cellY in xrange(y1 + 1, y2) for cellX in xrange(x1 + 1, x2))
+        free.discard(activator)
+        objectCount = max(rng.randint(1, 3), -(-len(self.typesToPlace) // roomsLeft))
+        roomTypes = []
+        for idx in xrange(objectCount):
+            if len(self.typesToPlace) > 0:
+                roomTypes.append(self.typesToPlace.pop())
+            else:
+                roomTypes.append(rng.choice(MapData.EXPECTED_GAME_OBJECTS))
+        for objectType in roomTypes:
+            if not self.AddObject(objectType, free):
+                self.typesToPlace.append(objectType)
+        name = "ROOM_%d" % (len(self.rooms) + 1)
+        halfWidth = self.tileWidth / 2
+        halfHeight = self.tileHeight / 2
+        self.rooms.append((name, (x1 * self.tileWidth + halfWidth, y1 * self.tileHeight + halfHeight,
+                                  (roomWidth - 1) * self.tileWidth, (roomHeight - 1) * self.tileHeight)))
+
+    # Put an object in the free cells of a room, with a use marker next
+    # to it.  Objects of different types can touch; objects of the same
+    # type can not, or MapData would see them as one object.
+    def AddObject(self, objectType, free):
+        rng = self.rng
+        if len(free) < 2:
+            return False
+        freeCells = sorted(free)
+        for attempt in xrange(PLACE_ATTEMPTS):
+            if attempt < PLACE_ATTEMPTS // 2:
+                objectWidth, objectHeight = OBJECT_SIZES[rng.randrange(len(OBJECT_SIZES))]
+            else:
+                objectWidth, objectHeight = (1, 1)
+            cellX, cellY = freeCells[rng.randrange(len(freeCells))]
+            cells = [(cellX + dx, cellY + dy) for dy in xrange(objectHeight) for dx in xrange(objectWidth)]
+            if not all(cell in free for cell in cells):
+                continue
+            around = set((cx + dx, cy + dy) for cx, cy in cells for dx, dy in ((0, -1), (1, 0), (0, 1), (-1, 0)))
+            around.difference_update(cells)
+            if any(self.objectTypes.get(cell) == objectType for cell in around):
+                continue
+            markers = [cell for cell in sorted(around) if cell in free]
+            if len(markers) == 0:
+                continue
+            gids = self.typeGIDs[objectType]
+            for cell in cells:
+                cx, cy = cell
+                self.layers["Objects"][cy, cx] = gids[rng.randrange(len(gids))]
+                self.layers["Blocked"][cy, cx] = self.GetTileGID("Blocked")
+                self.objectTypes[cell] = objectType
+                free.discard(cell)
+            marker = markers[rng.randrange(len(markers))]
+            self.layers["Use_Markers"][marker[1], marker[0]] = self.GetTileGID("Use_Markers")
+            free.discard(marker)
+            self.objectCount += 1
+            return True
+        return False
+
+    def Save(self, fileName, encoding="csv", compression=None):
+        if encoding not in LAYER_ENCODINGS:
+            print "Unknown layer encoding %s, expected one of %s." % (encoding, LAYER_ENCODINGS)
+            return False
+        tileset = etree.fromstring(etree.tostring(self.tileset))
+        # Tiled expects the image (or .tsx file) path relative to the
+        # map file.
+        templateDir = os.path.dirname(os.path.abspath(self.templateName))
+        mapDir = os.path.dirname(os.path.abspath(fileName))
+        element = tileset if tileset.attrib.has_key('source') else tileset.find("image")
+        if element is not None:
+            source = os.path.join(templateDir, element.attrib['source'])
+            element.attrib['source'] = os.path.relpath(source, mapDir)
+        tileset.tail = "\n"
+        with open(fileName, "w") as outFile:
+            outFile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            outFile.write('<map version="1.0" orientation="orthogonal" renderorder="left-up" '
+                          'width="%d" height="%d" tilewidth="%d" tileheight="%d">\n' %
+                          (self.width, self.height, self.tileWidth, self.tileHeight))
+            outFile.write(" " + etree.tostring(tileset))
+            for layerName in MapData.EXPECTED_LAYERS:
+                gids = self.layers[layerName].ravel()
+                if encoding == "xml":
+                    outFile.write(' <layer name=%s width="%d" height="%d">\n  <data>\n' %
+                                  (quoteattr(layerName), self.width, self.height))
+                    for row in xrange(self.height):
+                        outFile.write("".join('   <tile gid="%d"/>\n' % gid
+                                              for gid in gids[row * self.width:(row + 1) * self.width].tolist()))
+                    outFile.write('  </data>\n </layer>\n')
+                else:
+                    WriteTiledLayer(outFile, layerName, gids, self.width, self.height, encoding, compression)
+            outFile.write(' <objectgroup name="Rooms">\n')
+            for name, (x, y, width, height) in self.rooms:
+                outFile.write('  <object x="%d" y="%d" width="%d" height="%d">\n' % (x, y, width, height))
+                outFile.write('   <properties>\n    <property name="ROOM" value=%s/>\n   </properties>\n' %
+                              quoteattr(name))
+                outFile.write('  </object>\n')
+            outFile.write(' </objectgroup>\n')
+            WriteTiledMapFooter(outFile)
+        return True
+
+
+def GenerateMap(fileName, width, height, seed=0, encoding="csv", compression=None,
+                templateName=DEFAULT_TEMPLATE, blockSize=DEFAULT_BLOCK_SIZE):
+    generator = MapGenerator(width, height, seed, templateName, blockSize)
+    generator.Generate()
+    return generator.Save(fileName, encoding, compression)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Tiled map.")
+    parser.add_argument("fileName")
+    parser.add_argument("--width", type=int, default=128)
+    parser.add_argument("--height", type=int, default=None, help="Defaults to the width.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--encoding", choices=LAYER_ENCODINGS, default="csv")
+    parser.add_argument("--compression", choices=["zlib"], default=None)
+    parser.add_argument("--template", default=DEFAULT_TEMPLATE)
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    generator = MapGenerator(args.width, args.height or args.width, args.seed, args.template, args.block_size)
+    generator.Generate()
+    generator.Save(args.fileName, args.encoding, args.compression)
+    print "Wrote %s: %d x %d cells, %d rooms, %d game objects." % (
+        args.fileName, generator.width, generator.height, len(generator.rooms), generator.objectCount)
@@ -0,0 +1,227 @@
+"""
+This python script turns the data extracted by MapData into the
+facts used by the GOAP planner (Phase I).
+
+The rooms, game objects, doors and door activators of the map are
+loaded into a FactTable in bulk, one key at a time for all the
+subjects that have it.  The table is then frozen and used as the
+base state for every WorldState (and so every agent) on the map.
+
+Doors and activators are not clustered by MapData, so they are
+worked out here:
+
+1. A door (portal) is a pair of neighboring door tiles of the same
+   type that sit in two different rooms.  Vertical pairs are taken
+   first, then horizontal pairs from the tiles that are left over.
+   Door tiles that do not connect two rooms (e.g. the shuttle door
+   to the outside) are ignored.
+2. Each door activator tile is an activator.  Its target is the
+   closest door.  Any door with a red activator is a red access
+   door.
+"""
+
+import os
+import sys
+
+import numpy
+
+from CreateMapData import MapData
+
+# The planner lives in the Phase I folder.
+PHASE_I_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Phase I - Basic Concept")
+if PHASE_I_DIR not in sys.path:
+    sys.path.append(PHASE_I_DIR)
+
+from FactTable import FactTable
+from GOAP_Spaceship_Sim import (WorldState, Planner, PrintActions,
+                                kInRoom, kIsPowered, kIsClosed, kIsActivated,
+                                kRoomPortal, kActivatorTarget, kSubjectType,
+                                kPowerSource,
+                                goDoor, goDoorAct, goRedDoor, goRedDoorAct,
+                                goRedDoorKey, goShuttleGen, goShuttleAct)
+
+# The OBJECT_TYPE values (from the tileset) that have a meaning to the
+# planner.  Anything not listed here keeps the OBJECT_TYPE as its
+# subject type.
+MAP_OBJECT_TYPES = {
+    "SHUTTLE": goShuttleAct,
+    "SHUTTLE_GEN": goShuttleGen,
+    "DOOR_ACTIVATOR_BLUE": goDoorAct,
+    "DOOR_ACTIVATOR_RED": goRedDoorAct,
+}
+DOOR_TYPES = ["DOOR", "SECRET_DOOR"]
+RED_ACTIVATOR_TYPE = "DOOR_ACTIVATOR_RED"
+
+
+# The subject ID used for an object on the map.
+def MapSubjectID(objectType, subjectID):
+    return "%s %d" % (objectType, subjectID)
+
+
+# Build an array over all the cells of the map with the OBJECT_TYPE
+# (as an index into typeList) of the tiles in a layer.  Cells with no
+# tile (or a type not in the list) are 0, so the codes start at 1.
+def CalculateLayerTypeGrid(mapData, layerName, typeList):
+    grid = numpy.zeros(mapData.mapWidth * mapData.mapHeight, dtype=numpy.int16)
+    layer = mapData.layerDict[layerName]
+    if len(layer) == 0:
+        return grid
+    typeCodes = dict((objectType, code + 1) for code, objectType in enumerate(typeList))
+    # MapData's type codes -> the codes for typeList.
+    listCodes = numpy.array([typeCodes.get(objectType, 0) for objectType in mapData.objectTypeNames],
+                            dtype=numpy.int16)
+    cells = numpy.fromiter(layer.iterkeys(), dtype=numpy.int32, count=len(layer))
+    tileIDs = numpy.fromiter((tileData[1] for tileData in layer.itervalues()), dtype=numpy.uint32, count=len(layer))
+    grid[cells] = listCodes[mapData.GetObjectTypeCodes(tileIDs)]
+    return grid
+
+
+# Build an array over all the cells of the map with the index of the
+# room (in roomNames) each cell is in, or -1 if it is not in a room.
+def CalculateRoomGrid(mapData, roomNames):
+    grid = numpy.empty(mapData.mapWidth * mapData.mapHeight, dtype=numpy.int32)
+    grid.fill(-1)
+    for code, room in enumerate(roomNames):
+        cells = mapData.roomInfoDict[room].get("Cells", [])
+        grid[numpy.asarray(cells, dtype=numpy.int32)] = code
+    return grid
+
+
+# Find the doors between rooms.  Returns a list of the two cells of
+# each door, the (room, room) portal and the door type.
+def CalculateDoorPortals(mapData, roomNames):
+    width = mapData.mapWidth
+    roomGrid = CalculateRoomGrid(mapData, roomNames)
+    doorGrid = CalculateLayerTypeGrid(mapData, "Doors", DOOR_TYPES)
+    doorCells = numpy.flatnonzero(doorGrid)
+    used = numpy.zeros(len(doorGrid), dtype=bool)
+    pairs = []
+    # Vertical pairs first (the cell below), then horizontal pairs
+    # (the cell to the right) that do not reuse a cell.
+    for offset, valid in ((width, doorCells + width < len(doorGrid)),
+                          (1, doorCells % width < width - 1)):
+        first = doorCells[valid]
+        second = first + offset
+        match = ((doorGrid[second] == doorGrid[first]) &
+                 (roomGrid[first] >= 0) & (roomGrid[second] >= 0) &
+                 (roomGrid[first] != roomGrid[second]) &
+                 ~used[first] & ~used[second])
+        first = first[match]
+        second = second[match]
+        used[first] = True
+        used[second] = True
+        pairs.extend(zip(first.tolist(), second.tolist()))
+    pairs.sort()
+    result = []
+    for first, second in pairs:
+        portal = (roomNames[roomGrid[first]], roomNames[roomGrid[second]])
+        result.append(((first, second), portal, DOOR_TYPES[doorGrid[first] - 1]))
+    return result
+
+
+# Find the door activators and the door (index into the doors list)
+# each one opens.  Returns a list of (cell, activator type, door).
+def CalculateDoorActivators(mapData, doors):
+    width = mapData.mapWidth
+    activatorTypes = [objectType for objectType in MAP_OBJECT_TYPES if objectType.startswith("DOOR_ACTIVATOR")]
+    activatorTypes.sort()
+    activatorGrid = CalculateLayerTypeGrid(mapData, "Door_Activators", activatorTypes)
+    activatorCells = numpy.flatnonzero(activatorGrid)
+    if len(doors) == 0 or len(activatorCells) == 0:
+        return []
+    # Manhattan distance from every activator to both cells of every
+    # door.  The closest door cell wins.
+    doorCells = numpy.array([cells for cells, portal, doorType in doors], dtype=numpy.int32).ravel()
+    dx = numpy.abs((activatorCells % width)[:, None] - (doorCells % width)[None, :])
+    dy = numpy.abs((activatorCells // width)[:, None] - (doorCells // width)[None, :])
+    targets = numpy.argmin(dx + dy, axis=1) // 2
+    return zip(activatorCells.tolist(),
+               [activatorTypes[code - 1] for code in activatorGrid[activatorCells]],
+               targets.tolist())
+
+
+# Load everything the planner needs to know about the map into a
+# frozen FactTable.  Extra (subjectID, key, value) facts, e.g. for
+# items that are not part of the map, can be passed in as well.
+def CreateMapFactTable(mapData, extraStates=None):
+    roomNames = mapData.roomInfoDict.keys()
+    roomNames.sort()
+    doors = CalculateDoorPortals(mapData, roomNames)
+    activators = CalculateDoorActivators(mapData, doors)
+
+    objectCount = sum(len(goList) for goList in mapData.gameObjectDict.itervalues())
+    table = FactTable(capacity=2 * objectCount + 3 * len(doors) + 3 * len(activators) + 16)
+
+    # Game objects (from the Objects layer).
+    sids = []
+    rooms = []
+    subjectTypes = []
+    generators = []
+    roomGenerators = {}
+    shuttles = []
+    goTypes = mapData.gameObjectDict.keys()
+    goTypes.sort()
+    for goType in goTypes:
+        for go in mapData.gameObjectDict[goType]:
+            sid = MapSubjectID(goType, go["SubjectID"])
+            sids.append(sid)
+            rooms.append(go["Room"])
+            subjectTypes.append(MAP_OBJECT_TYPES.get(goType, goType))
+            if goType == "SHUTTLE_GEN":
+                generators.append(sid)
+                roomGenerators.setdefault(go["Room"], sid)
+            elif goType == "SHUTTLE":
+                shuttles.append((sid, go["Room"]))
+    table.AddFacts(sids, kInRoom, rooms)
+    table.AddFacts(sids, kSubjectType, subjectTypes)
+    # Each shuttle is powered by the generator in its room (or any
+    # generator if there is not one in the room).
+    table.AddConstantFacts(generators, kIsPowered, False)
+    if len(generators) > 0:
+        table.AddConstantFacts([sid for sid, room in shuttles], kIsActivated, False)
+        table.AddFacts([sid for sid, room in shuttles], kPowerSource,
+                       [roomGenerators.get(room, generators[0]) for sid, room in shuttles])
+
+    # Door activators.  Subject IDs carry on from the ones used by
+    # MapData for the game objects.
+    firstID = mapData.subjectID + 1
+    doorIDs = [MapSubjectID(doorType, firstID + idx) for idx, (cells, portal, doorType) in enumerate(doors)]
+    firstID += len(doors)
+    activatorIDs = [MapSubjectID(actType, firstID + idx) for idx, (cell, actType, door) in enumerate(activators)]
+    table.AddFacts(activatorIDs, kInRoom, [mapData.cellInfoDict[cell]["Room"] for cell, actType, door in activators])
+    table.AddFacts(activatorIDs, kSubjectType, [MAP_OBJECT_TYPES[actType] for cell, actType, door in activators])
+    table.AddFacts(activatorIDs, kActivatorTarget, [doorIDs[door] for cell, actType, door in activators])
+
+    # Doors.
+    redDoors = set(door for cell, actType, door in activators if actType == RED_ACTIVATOR_TYPE)
+    table.AddFacts(doorIDs, kRoomPortal, [portal for cells, portal, doorType in doors])
+    table.AddConstantFacts(doorIDs, kIsClosed, True)
+    table.AddFacts(doorIDs, kSubjectType, [goRedDoor if idx in redDoors else goDoor for idx in xrange(len(doors))])
+
+    if extraStates is not None:
+        table.AddStates(extraStates)
+    return table.Freeze()
+
+
+if __name__ == "__main__":
+    import time
+    mapData = MapData()
+    mapData.ParseTMXData("Spaceship 3.tmx")
+    # There is no red card on the map (yet), so leave one in the
+    # cargo bay.
+    extraStates = [
+        ("Red Card", kInRoom, "CARGO_BAY"),
+        ("Red Card", kSubjectType, goRedDoorKey),
+    ]
+    start = time.time()
+    factTable = CreateMapFactTable(mapData, extraStates)
+    elapsed = time.time() - start
+    print "Loaded %d facts for %d subjects in %.3f ms." % (
+        factTable.GetFactCount(), factTable.GetSubjectCount(), elapsed * 1000.0)
+    worldState = WorldState(factTable)
+    worldState.AddAgent("Agent", "CARGO_BAY")
+    worldState.Dump()
+    shuttles = [sid for sid in worldState.worldState if worldState.worldState[sid][kSubjectType] == goShuttleAct]
+    planner = Planner([(shuttles[0], kIsActivated, True)], worldState, "Agent",
+                      pruneDuplicates=True, sleepSets=True)
+    PrintActions(planner.PlanActionsMixed())
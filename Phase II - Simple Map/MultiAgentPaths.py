@@ -0,0 +1,494 @@
+"""
+This python script finds collision free paths for a crew of agents
+walking the tile grid of a map at the same time.
+
+Agents that each find their own path run into each other in the
+corridors and doorways and then have to find a new path, over and
+over.  Here the paths are found together:
+
+1. The grid is built from the MapData layers.  A cell can be walked
+   on if it is on the Floor (or Doors) layer and is not a wall (a
+   door in a wall is fine) or Blocked.  Agents move one cell north,
+   east, south or west per time step, or wait.
+2. Two agents can not be in the same cell at the same time, or swap
+   cells in one step.  A door (the pair of door cells found by
+   MapWorldState.CalculateDoorPortals, or a single door cell) can
+   only hold one agent at a time, whichever of its cells it is in.
+3. Conflict-Based Search (CBS) finds the paths with the lowest total
+   cost.  Each agent's path is found on its own with a space-time A*
+   (FindPath) that obeys a list of constraints.  The paths are
+   checked for the first conflict.  If there is one, the search
+   splits into two: one where the first agent may not be there (at
+   that time) and one where the second may not.  The cheapest split
+   is looked at next.
+4. CBS gets slow as the crew gets big.  Over cbsAgentLimit agents, or
+   if CBS runs out of nodes or time, prioritized planning is used
+   instead.  The agents take turns (longest trip first), each one
+   avoiding the cells (and doors) reserved by the ones before it.
+   This is fast but can fail (or give longer paths) where CBS would
+   not.
+
+A path is a list of cells, one per time step (from time 0).  An agent
+stays on the last cell of its path once it gets there.
+
+Usage:
+    python MultiAgentPaths.py --agents 2,4,8 --sizes 32,64,128
+
+NOTE:
+1.  Enhanced CBS (ECBS) is not used.  The prioritized fallback keeps
+    the worst case time down, which matters more for the game than
+    how close to optimal the paths are.
+2.  The Spaceship 3 map has a small, broken up walkable area, so the
+    benchmark picks the starts and goals in its largest connected
+    area.  The synthetic maps are rooms on a grid joined by one cell
+    doors.  No agent starts or ends on a door cell.
+3.  On Spaceship 3, CBS does not finish for 6 and 8 agents even
+    with 1 s (1300 to 1800 nodes), and the paths come from the
+    prioritized fallback.  With the default 50 ms limit these runs
+    take under 60 ms instead of just over 1 s.  The cost is the odd
+    crew CBS would have solved a little later: one 4 agent trial
+    took 224 ms (302 nodes) for a total cost of 31, and now gets a
+    prioritized cost of 33.  Use --cbs-time to compare.
+"""
+
+import argparse
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+
+import numpy
+
+from CreateMapData import MapData
+
+DEFAULT_CBS_AGENT_LIMIT = 12
+DEFAULT_CBS_NODE_LIMIT = 2000
+# CBS is given a few tens of ms; past that it rarely finishes, and
+# the prioritized fallback should not be kept waiting (see NOTE 3).
+DEFAULT_CBS_TIME_LIMIT = 0.05
+
+# The kinds of conflicts (and constraints).
+cfVertex = "Vertex"
+cfEdge = "Edge"
+cfDoor = "Door"
+
+
+class GridMap(object):
+    def __init__(self, width, height, walkable, doorGroups):
+        self.width = width
+        self.height = height
+        self.walkable = walkable
+        # The door each cell is part of (-1 for none) and the cells in
+        # each door.
+        self.doorOf = numpy.empty(width * height, dtype=numpy.int32)
+        self.doorOf.fill(-1)
+        self.doorCells = []
+        for cells in doorGroups:
+            cells = [cell for cell in cells if walkable[cell]]
+            if len(cells) == 0:
+                continue
+            self.doorOf[cells] = len(self.doorCells)
+            self.doorCells.append(cells)
+        self.neighbours = {}
+        # goal -> distances (in steps) from every cell, -1 if the
+        # goal can not be reached.
+        self.distances = {}
+
+    def GetNeighbours(self, cell):
+        result = self.neighbours.get(cell)
+        if result is None:
+            width = self.width
+            cellX = cell % width
+            result = []
+            if cell >= width:
+                result.append(cell - width)
+            if cellX < width - 1:
+                result.append(cell + 1)
+            if cell + width < width * self.height:
+                result.append(cell + width)
+            if cellX > 0:
+                result.append(cell - 1)
+            result = tuple(other for other in result if self.walkable[other])
+            self.neighbours[cell] = result
+        return result
+
+    # Breadth first search out from the goal.  Used as the (exact)
+    # heuristic for FindPath.
+    def GetDistances(self, goal):
+        distances = self.distances.get(goal)
+        if distances is None:
+            distances = numpy.empty(self.width * self.height, dtype=numpy.int32)
+            distances.fill(-1)
+            distances[goal] = 0
+            queue = deque([goal])
+            while len(queue) > 0:
+                cell = queue.popleft()
+                distance = distances[cell] + 1
+                for other in self.GetNeighbours(cell):
+                    if distances[other] < 0:
+                        distances[other] = distance
+                        queue.append(other)
+            self.distances[goal] = distances
+        return distances
+
+    # The cells in the same door as the cell (or just the cell).
+    def GetDoorCells(self, cell):
+        door = self.doorOf[cell]
+        if door < 0:
+            return (cell,)
+        return self.doorCells[door]
+
+    # The cells that can be reached from the cell.
+    def GetConnectedCells(self, cell):
+        return numpy.flatnonzero(self.GetDistances(cell) >= 0)
+
+
+# Build the grid from the layers of a parsed map.
+def CreateGridFromMapData(mapData):
+    from MapWorldState import CalculateDoorPortals
+    cellCount = mapData.mapWidth * mapData.mapHeight
+
+    def LayerMask(layerName):
+        mask = numpy.zeros(cellCount, dtype=bool)
+        mask[numpy.fromiter(mapData.layerDict[layerName].iterkeys(), dtype=numpy.int32)] = True
+        return mask
+
+    doors = LayerMask("Doors")
+    walkable = (LayerMask("Floor") | doors) & ~(LayerMask("Walls") & ~doors) & ~LayerMask("Blocked")
+    roomNames = mapData.roomInfoDict.keys()
+    roomNames.sort()
+    doorGroups = [list(cells) for cells, portal, doorType in CalculateDoorPortals(mapData, roomNames)]
+    paired = set(cell for cells in doorGroups for cell in cells)
+    doorGroups.extend([cell] for cell in numpy.flatnonzero(doors).tolist() if cell not in paired)
+    return GridMap(mapData.mapWidth, mapData.mapHeight, walkable, doorGroups)
+
+
+# A synthetic map: roomsX x roomsY square rooms with one cell walls
+# between them and a one cell door in each wall between two rooms.
+def CreateRoomGrid(roomsX, roomsY, roomSize, seed=1):
+    rand = random.Random(seed)
+    step = roomSize + 1
+    width = roomsX * step + 1
+    height = roomsY * step + 1
+    walkable = numpy.ones((height, width), dtype=bool)
+    walkable[::step, :] = False
+    walkable[:, ::step] = False
+    doorGroups = []
+    for roomY in xrange(roomsY):
+        for roomX in xrange(roomsX):
+            left = roomX * step
+            top = roomY * step
+            if roomX < roomsX - 1:
+                cell = (top + rand.randint(1, roomSize)) * width + left + step
+                doorGroups.append([cell])
+            if roomY < roomsY - 1:
+                cell = (top + step) * width + left + rand.randint(1, roomSize)
+                doorGroups.append([cell])
+    walkable = walkable.ravel()
+    for cells in doorGroups:
+        walkable[cells] = True
+    return GridMap(width, height, walkable, doorGroups)
+
+
+# The cells (and moves) an agent may not use.  Used for the
+# constraints of one agent in CBS and for the cells taken by the
+# agents that went first in prioritized planning.
+class Reservations(object):
+    def __init__(self):
+        self.cells = set()
+        # Blocked moves (from, to, time of arrival).
+        self.moves = set()
+        # cell -> time from which it is taken for good.
+        self.parked = {}
+        # cell -> the last time it is blocked.
+        self.lastTimes = {}
+        self.maxTime = 0
+
+    def BlockCell(self, cell, t):
+        self.cells.add((cell, t))
+        if t > self.lastTimes.get(cell, -1):
+            self.lastTimes[cell] = t
+        self.maxTime = max(self.maxTime, t)
+
+    def BlockMove(self, fromCell, toCell, t):
+        self.moves.add((fromCell, toCell, t))
+        self.maxTime = max(self.maxTime, t)
+
+    def Park(self, cell, t):
+        self.parked[cell] = min(t, self.parked.get(cell, t))
+        self.maxTime = max(self.maxTime, t)
+
+    def IsCellBlocked(self, cell, t):
+        if (cell, t) in self.cells:
+            return True
+        parkTime = self.parked.get(cell)
+        return parkTime is not None and t >= parkTime
+
+    def GetLastBlockedTime(self, cell):
+        return self.lastTimes.get(cell, -1)
+
+    # Reserve a path (for the agents that plan after it).  A door is
+    # reserved as a whole.
+    def ReservePath(self, grid, path):
+        for t, cell in enumerate(path):
+            for doorCell in grid.GetDoorCells(cell):
+                self.BlockCell(doorCell, t)
+            if t > 0 and path[t - 1] != cell:
+                # No swapping places.
+                self.BlockMove(cell, path[t - 1], t)
+        for doorCell in grid.GetDoorCells(path[-1]):
+            self.Park(doorCell, len(path) - 1)
+
+
+# Space-time A* from the start to the goal, avoiding the reservations.
+# Returns the path, or None if there is not one.
+def FindPath(grid, start, goal, reservations=None, maxTime=None):
+    if reservations is None:
+        reservations = Reservations()
+    distances = grid.GetDistances(goal)
+    if distances[start] < 0 or reservations.parked.has_key(goal):
+        return None
+    if reservations.IsCellBlocked(start, 0):
+        return None
+    # The agent can only stop at the goal once nobody else needs it.
+    holdTime = reservations.GetLastBlockedTime(goal)
+    if maxTime is None:
+        maxTime = max(holdTime, reservations.maxTime) + distances[start] + grid.width + grid.height
+    counter = itertools.count()
+    openList = [(distances[start], 0, next(counter), start)]
+    cameFrom = {(start, 0): None}
+    while len(openList) > 0:
+        f, t, seq, cell = heapq.heappop(openList)
+        if cell == goal and t > holdTime:
+            path = []
+            state = (cell, t)
+            while state is not None:
+                path.append(state[0])
+                state = cameFrom[state]
+            path.reverse()
+            return path
+        if t >= maxTime:
+            continue
+        nextT = t + 1
+        for other in grid.GetNeighbours(cell) + (cell,):
+            state = (other, nextT)
+            if state in cameFrom:
+                continue
+            if reservations.IsCellBlocked(other, nextT) or (cell, other, nextT) in reservations.moves:
+                continue
+            cameFrom[state] = (cell, t)
+            heapq.heappush(openList, (nextT + distances[other], nextT, next(counter), other))
+    return None
+
+
+def GetPathCell(path, t):
+    if t < len(path):
+        return path[t]
+    return path[-1]
+
+
+# Find the conflicts between the paths, earliest first.  Each one is
+# (kind, agent1, agent2, time, data) where data is the cell (vertex),
+# the door (door) or the (from, to) move of agent1 (edge).  Stops
+# after limit conflicts (if given).
+def FindConflicts(grid, paths, limit=None):
+    conflicts = []
+    maxLength = max(len(path) for path in paths)
+    doorOf = grid.doorOf
+    for t in xrange(maxLength):
+        cellAgents = {}
+        doorAgents = {}
+        for agent, path in enumerate(paths):
+            cell = GetPathCell(path, t)
+            if cellAgents.has_key(cell):
+                conflicts.append((cfVertex, cellAgents[cell], agent, t, cell))
+            else:
+                cellAgents[cell] = agent
+                door = doorOf[cell]
+                if door >= 0:
+                    if doorAgents.has_key(door):
+                        conflicts.append((cfDoor, doorAgents[door], agent, t, door))
+                    else:
+                        doorAgents[door] = agent
+            if limit is not None and len(conflicts) >= limit:
+                return conflicts
+        if t == 0:
+            continue
+        for agent, path in enumerate(paths):
+            fromCell = GetPathCell(path, t - 1)
+            toCell = GetPathCell(path, t)
+            if fromCell == toCell:
+                continue
+            other = cellAgents.get(fromCell)
+            if other is not None and other > agent and GetPathCell(paths[other], t - 1) == toCell:
+                conflicts.append((cfEdge, agent, other, t, (fromCell, toCell)))
+                if limit is not None and len(conflicts) >= limit:
+                    return conflicts
+    return conflicts
+
+
+def GetPathCost(path):
+    return len(path) - 1
+
+
+class CBSNode(object):
+    def __init__(self, constraints, paths):
+        # agent -> tuple of (kind, time, data) constraints.
+        self.constraints = constraints
+        self.paths = paths
+        self.cost = sum(GetPathCost(path) for path in paths)
+
+
+def CreateReservations(grid, constraints):
+    reservations = Reservations()
+    for kind, t, data in constraints:
+        if kind == cfVertex:
+            reservations.BlockCell(data, t)
+        elif kind == cfDoor:
+            for cell in grid.doorCells[data]:
+                reservations.BlockCell(cell, t)
+        else:
+            reservations.BlockMove(data[0], data[1], t)
+    return reservations
+
+
+# Conflict-Based Search.  Returns (paths, nodes expanded); paths is
+# None if no solution was found within the limits.
+def PlanCBS(grid, starts, goals, maxNodes=DEFAULT_CBS_NODE_LIMIT, timeLimit=DEFAULT_CBS_TIME_LIMIT):
+    start = time.time()
+    paths = []
+    for agent in xrange(len(starts)):
+        path = FindPath(grid, starts[agent], goals[agent])
+        if path is None:
+            return None, 0
+        paths.append(path)
+    counter = itertools.count()
+    root = CBSNode({}, paths)
+    openList = [(root.cost, next(counter), root)]
+    expanded = 0
+    while len(openList) > 0:
+        if expanded >= maxNodes or time.time() - start > timeLimit:
+            break
+        cost, seq, node = heapq.heappop(openList)
+        expanded += 1
+        conflicts = FindConflicts(grid, node.paths, 1)
+        if len(conflicts) == 0:
+            return node.paths, expanded
+        kind, agent1, agent2, t, data = conflicts[0]
+        if kind == cfEdge:
+            splits = [(agent1, (cfEdge, t, data)), (agent2, (cfEdge, t, (data[1], data[0])))]
+        else:
+            splits = [(agent1, (kind, t, data)), (agent2, (kind, t, data))]
+        for agent, constraint in splits:
+            agentConstraints = node.constraints.get(agent, ()) + (constraint,)
+            path = FindPath(grid, starts[agent], goals[agent], CreateReservations(grid, agentConstraints))
+            if path is None:
+                continue
+            constraints = dict(node.constraints)
+            constraints[agent] = agentConstraints
+            childPaths = list(node.paths)
+            childPaths[agent] = path
+            child = CBSNode(constraints, childPaths)
+            heapq.heappush(openList, (child.cost, next(counter), child))
+    return None, expanded
+
+
+# Plan the agents one at a time, longest trip first, each avoiding
+# the ones before it.  Returns the paths or None.
+def PlanPrioritized(grid, starts, goals):
+    order = range(len(starts))
+    order.sort(key=lambda agent: -grid.GetDistances(goals[agent])[starts[agent]])
+    reservations = Reservations()
+    paths = [None] * len(starts)
+    for agent in order:
+        path = FindPath(grid, starts[agent], goals[agent], reservations)
+        if path is None:
+            return None
+        reservations.ReservePath(grid, path)
+        paths[agent] = path
+    return paths
+
+
+# Find collision free paths for all the agents.  Returns (paths,
+# method, CBS nodes expanded); paths is None if neither method found
+# a solution.
+def SolvePaths(grid, starts, goals, cbsAgentLimit=DEFAULT_CBS_AGENT_LIMIT,
+               maxCbsNodes=DEFAULT_CBS_NODE_LIMIT, cbsTimeLimit=DEFAULT_CBS_TIME_LIMIT):
+    cbsNodes = 0
+    if len(starts) <= cbsAgentLimit:
+        paths, cbsNodes = PlanCBS(grid, starts, goals, maxCbsNodes, cbsTimeLimit)
+        if paths is not None:
+            return paths, "CBS", cbsNodes
+    paths = PlanPrioritized(grid, starts, goals)
+    if paths is not None:
+        return paths, "Prioritized", cbsNodes
+    return None, None, cbsNodes
+
+
+# Pick distinct starts and distinct goals in the largest connected area.
+# Goals are never door cells (an agent parked in a door blocks it).
+def PickStartsAndGoals(grid, agentCount, seed=1):
+    rand = random.Random(seed)
+    cells = numpy.flatnonzero(grid.walkable).tolist()
+    best = []
+    seen = set()
+    for cell in cells:
+        if cell in seen:
+            continue
+        connected = grid.GetConnectedCells(cell).tolist()
+        seen.update(connected)
+        if len(connected) > len(best):
+            best = connected
+    # Nobody starts or ends in a doorway.
+    roomCells = [cell for cell in best if grid.doorOf[cell] < 0]
+    agentCount = min(agentCount, len(roomCells) // 2)
+    starts = rand.sample(roomCells, agentCount)
+    goals = rand.sample(roomCells, agentCount)
+    return starts, goals
+
+
+def RunBenchmark(name, grid, agentCounts, seed, trials, cbsTimeLimit=DEFAULT_CBS_TIME_LIMIT):
+    for agentCount in agentCounts:
+        for trial in xrange(trials):
+            starts, goals = PickStartsAndGoals(grid, agentCount, seed + trial)
+            # The paths each agent would take on its own.
+            independent = [FindPath(grid, starts[agent], goals[agent]) for agent in xrange(len(starts))]
+            independentConflicts = len(FindConflicts(grid, independent))
+            start = time.time()
+            paths, method, cbsNodes = SolvePaths(grid, starts, goals, cbsTimeLimit=cbsTimeLimit)
+            elapsed = time.time() - start
+            if paths is None:
+                print "%-20s %6d %12s %9.1f ms %8s %8s %9d %10d %9s" % (
+                    name, len(starts), "FAILED", elapsed * 1000.0, "-", "-", cbsNodes, independentConflicts, "-")
+                continue
+            print "%-20s %6d %12s %9.1f ms %8d %8d %9d %10d %9d" % (
+                name, len(starts), method, elapsed * 1000.0, sum(GetPathCost(path) for path in paths),
+                max(GetPathCost(path) for path in paths), cbsNodes, independentConflicts,
+                len(FindConflicts(grid, paths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark multi-agent path planning.")
+    parser.add_argument("--map", default="Spaceship 3.tmx")
+    parser.add_argument("--map-agents", default="2,4,6,8")
+    parser.add_argument("--agents", default="4,8,16,32,64")
+    parser.add_argument("--sizes", default="32,64,128",
+                        help="Widths of the synthetic maps (rooms of 7x7 cells).")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trials", type=int, default=1)
+    parser.add_argument("--cbs-time", type=float, default=DEFAULT_CBS_TIME_LIMIT,
+                        help="Seconds CBS may take before prioritized planning is used.")
+    args = parser.parse_args()
+
+    print "%-20s %6s %12s %12s %8s %8s %9s %10s %9s" % (
+        "Map", "Agents", "Method", "Time", "Cost", "Makespan", "CBS Nodes", "Solo Confl", "Conflicts")
+    mapData = MapData()
+    if mapData.ParseTMXData(args.map, dumpInfo=False):
+        RunBenchmark(args.map, CreateGridFromMapData(mapData),
+                     [int(count) for count in args.map_agents.split(",")], args.seed, args.trials, args.cbs_time)
+    for size in [int(size) for size in args.sizes.split(",")]:
+        rooms = max(1, size // 8)
+        grid = CreateRoomGrid(rooms, rooms, 7, args.seed)
+        RunBenchmark("Rooms %dx%d" % (grid.width, grid.height), grid,
+                     [int(count) for count in args.agents.split(",")], args.seed, args.trials, args.cbs_time)
@@ -1,7 +1,15 @@
 __author__ = 'james'
 
+import base64
+import json
+import math
 import os
+import zipfile
+import zlib
+from StringIO import StringIO
+from xml.sax.saxutils import quoteattr
 
+import numpy
 from lxml import etree
 from PIL import Image
 
@@ -11,44 +19,70 @@ INPUT_XML_FILE = "%s.xml"%ROOT_FILE
 INPUT_TILESET_FILE = "%s.png" % ROOT_FILE
 OUTPUT_XML_FILE = "%s.tmx" % ROOT_FILE
 
+# Constants used in Tiled to indicate flip/rotation
+FLIPPED_HORIZONTALLY_FLAG = 0x80000000
+FLIPPED_VERTICALLY_FLAG = 0x40000000
+FLIPPED_DIAGONALLY_FLAG = 0x20000000
+
+# There are 4 rot values and two flipX values (True,False),
+# leading to 8 combinations.  For each combination, these are
+# the flags that have to be added on.  The table is indexed by
+# rot + 4 * flipX.
+ROTATION_FLAGS = numpy.array([
+    # Not flipX
+    0,
+    FLIPPED_HORIZONTALLY_FLAG + FLIPPED_DIAGONALLY_FLAG,
+    FLIPPED_HORIZONTALLY_FLAG + FLIPPED_VERTICALLY_FLAG,
+    FLIPPED_VERTICALLY_FLAG + FLIPPED_DIAGONALLY_FLAG,
+    # FlipX
+    FLIPPED_HORIZONTALLY_FLAG,
+    FLIPPED_HORIZONTALLY_FLAG + FLIPPED_VERTICALLY_FLAG + FLIPPED_DIAGONALLY_FLAG,
+    FLIPPED_VERTICALLY_FLAG,
+    FLIPPED_DIAGONALLY_FLAG,
+], dtype=numpy.uint32)
+
+# Layer data encodings supported by the fast (streaming) conversion.
+LAYER_ENCODINGS = ["csv", "base64"]
+
 # Updates the gid for a tile based on the rotation
 # and flipX flag passed in from the PyxelEdit element.
 def UpdateGIDForRotation(gid, rot, flipX):
-    # Constants used in Tiled to indicate flip/rotation
-    FLIPPED_HORIZONTALLY_FLAG = 0x80000000
-    FLIPPED_VERTICALLY_FLAG = 0x40000000
-    FLIPPED_DIAGONALLY_FLAG = 0x20000000
-    # There are 4 rot values and two flipX values (True,False),
-    # leading to 8 combinations.  For each combination, we have
-    # to add on the flags that are appropriate.
-    if not flipX:
-        if rot == "0":
-            # Nothing to do
-            pass
-        elif rot == "1":
-            gid += (FLIPPED_HORIZONTALLY_FLAG + FLIPPED_DIAGONALLY_FLAG)
-        elif rot == "2":
-            gid += (FLIPPED_HORIZONTALLY_FLAG + FLIPPED_VERTICALLY_FLAG)
-        elif rot == "3":
-            gid += (FLIPPED_VERTICALLY_FLAG + FLIPPED_DIAGONALLY_FLAG)
-    else:   # FlipX
-        if rot == "0":
-            gid += (FLIPPED_HORIZONTALLY_FLAG)
-        elif rot == "1":
-            gid += (FLIPPED_HORIZONTALLY_FLAG + FLIPPED_VERTICALLY_FLAG + FLIPPED_DIAGONALLY_FLAG)
-        elif rot == "2":
-            gid += (FLIPPED_VERTICALLY_FLAG)
-        elif rot == "3":
-            gid += (FLIPPED_DIAGONALLY_FLAG)
+    if rot not in ("0", "1", "2", "3"):
+        return gid
     # Return the modified value.
-    return gid
+    return gid + int(ROTATION_FLAGS[int(rot) + 4 * int(flipX)])
+
+# Updates a whole array of PyxelEdit tiles at once.  The tile values
+# are the PyxelEdit tile index (-1 for no tile), rots and flipXs are
+# arrays of the same size.  Returns the Tiled gids as uint32.  As in
+# UpdateGIDForRotation, a tile with a rot outside 0-3 gets no flags.
+def CalculateGIDs(tiles, rots, flipXs):
+    tiles = numpy.asarray(tiles, dtype=numpy.int64)
+    rots = numpy.asarray(rots, dtype=numpy.intp)
+    lookup = rots + 4 * (numpy.asarray(flipXs) != 0)
+    lookup[(rots < 0) | (rots > 3)] = 0
+    gids = (tiles + 1).astype(numpy.uint32) | ROTATION_FLAGS[lookup]
+    gids[tiles < 0] = 0
+    return gids
+
+# Turn a layer of gids into the text for a Tiled <data> element.
+def EncodeLayerData(gids, width, encoding, compression=None):
+    if encoding == "csv":
+        rows = gids.reshape(-1, width)
+        return "\n" + ",\n".join(",".join(map(str, row)) for row in rows.tolist()) + "\n"
+    data = gids.astype("<u4").tostring()
+    if compression == "zlib":
+        data = zlib.compress(data)
+    return base64.b64encode(data)
 
-def PyxelEditToTiled(inFileName, tileSetName, outFileName):
+def PyxelEditToTiled(inFileName, tileSetName, outFileName, overwrite=False):
     # IF THE OUTPUT FILE ALREADY EXISTS, DO NOT OVERWRITE IT!!
-    if os.path.exists(outFileName):
+    # (Unless we were told to, e.g. by a build that knows the
+    # output is out of date.)
+    if os.path.exists(outFileName) and not overwrite:
         print "File %s already exists...NOT OVERWRITING!"%outFileName
         print "NOTHING DONE!!!"
-        return
+        return False
     # Read in the tileset information
     imgFile = Image.open(tileSetName)
     imgWidth, imgHeight = map(str, imgFile.size)
@@ -74,12 +108,13 @@ def PyxelEditToTiled(inFileName, tileSetName, outFileName):
     # Build the tileset
     tileset = etree.SubElement(outRoot, "tileset")
     tileset.attrib["firstgid"] = "1"
-    tileset.attrib["name"] = os.path.splitext(tileSetName)[0]
+    tileset.attrib["name"] = os.path.splitext(os.path.basename(tileSetName))[0]
     tileset.attrib["tilewidth"] = tileWidth
     tileset.attrib["tileheight"] = tileHeight
     # Add the image information for the tileset
     imgElem =etree.SubElement(tileset, "image")
-    imgElem.attrib["source"] = tileSetName
+    # Tiled expects the image path relative to the map file.
+    imgElem.attrib["source"] = os.path.relpath(tileSetName, os.path.dirname(os.path.abspath(outFileName)))
     imgElem.attrib["width"] = imgWidth
     imgElem.attrib["height"] = imgHeight
 
@@ -103,8 +138,182 @@ def PyxelEditToTiled(inFileName, tileSetName, outFileName):
 
     outTree = etree.ElementTree(outRoot)
     outTree.write(outFileName, encoding="UTF-8", xml_declaration=True, pretty_print=True)
+    return True
+
+# Write the start of a Tiled map (the map and tileset elements).
+def WriteTiledMapHeader(outFile, outFileName, tilesWide, tilesHigh, tileWidth, tileHeight,
+                        tileSetName, imgWidth, imgHeight):
+    # Tiled expects the image path relative to the map file.
+    tileSetSource = os.path.relpath(tileSetName, os.path.dirname(os.path.abspath(outFileName)))
+    outFile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    outFile.write('<map version="1.0" orientation="orthogonal" renderorder="left-up" '
+                  'width="%s" height="%s" tilewidth="%s" tileheight="%s">\n' %
+                  (tilesWide, tilesHigh, tileWidth, tileHeight))
+    outFile.write(' <tileset firstgid="1" name=%s tilewidth="%s" tileheight="%s">\n' %
+                  (quoteattr(os.path.splitext(os.path.basename(tileSetName))[0]),
+                   tileWidth, tileHeight))
+    outFile.write('  <image source=%s width="%d" height="%d"/>\n' %
+                  (quoteattr(tileSetSource), imgWidth, imgHeight))
+    outFile.write(' </tileset>\n')
+
+# Write one layer of gids to a Tiled map.
+def WriteTiledLayer(outFile, name, gids, tilesWide, tilesHigh, encoding, compression=None):
+    dataAttribs = ' encoding="%s"' % encoding
+    if encoding == "base64" and compression is not None:
+        dataAttribs += ' compression="%s"' % compression
+    outFile.write(' <layer name=%s width="%s" height="%s">\n' %
+                  (quoteattr(name), tilesWide, tilesHigh))
+    outFile.write('  <data%s>' % dataAttribs)
+    outFile.write(EncodeLayerData(gids, int(tilesWide), encoding, compression))
+    outFile.write('</data>\n')
+    outFile.write(' </layer>\n')
+
+def WriteTiledMapFooter(outFile):
+    outFile.write('</map>\n')
+
+# A faster version of PyxelEditToTiled.  Instead of building the
+# output as an XML tree with one element per tile, the PyxelEdit file
+# is read one layer at a time, the flags for all the tiles in the
+# layer are worked out at once and the layer is written out as CSV or
+# base64 data (optionally zlib compressed) before moving on to the
+# next one.
+def StreamPyxelEditToTiled(inFileName, tileSetName, outFileName, overwrite=False,
+                           encoding="csv", compression=None):
+    if encoding not in LAYER_ENCODINGS:
+        print "Unknown layer encoding %s, expected one of %s." % (encoding, LAYER_ENCODINGS)
+        return False
+    if os.path.exists(outFileName) and not overwrite:
+        print "File %s already exists...NOT OVERWRITING!"%outFileName
+        print "NOTHING DONE!!!"
+        return False
+    # Read in the tileset information (PIL only reads the header)
+    imgFile = Image.open(tileSetName)
+    imgWidth, imgHeight = imgFile.size
+
+    outFile = open(outFileName, "w")
+    try:
+        tilesWide = None
+        for event, element in etree.iterparse(inFileName, events=("start", "end")):
+            if event == "start":
+                if tilesWide is None and element.tag == "tilemap":
+                    # The root node.  Write out the map and tileset.
+                    tilesWide = element.attrib["tileswide"]
+                    tilesHigh = element.attrib["tileshigh"]
+                    tileWidth = element.attrib["tilewidth"]
+                    tileHeight = element.attrib["tileheight"]
+                    WriteTiledMapHeader(outFile, outFileName, tilesWide, tilesHigh, tileWidth, tileHeight,
+                                        tileSetName, imgWidth, imgHeight)
+                continue
+            if element.tag != "layer":
+                continue
+            # A whole layer has been read.  Convert it and then throw
+            # it away.
+            tiles = []
+            rots = []
+            flipXs = []
+            for tile_element in element:
+                attrib = tile_element.attrib
+                tiles.append(attrib["tile"])
+                rots.append(attrib.get("rot", "0"))
+                flipXs.append(attrib.get("flipX") == "true")
+            gids = CalculateGIDs(numpy.array(tiles, dtype=numpy.int64),
+                                 numpy.array(rots, dtype=numpy.intp),
+                                 flipXs)
+            WriteTiledLayer(outFile, element.attrib["name"], gids, tilesWide, tilesHigh, encoding, compression)
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        WriteTiledMapFooter(outFile)
+    finally:
+        outFile.close()
+    return True
+
+# A .pyxel file is a zip archive.  It holds a "docData.json" file
+# with the canvas, layers and tileset sizes, plus one PNG per tile
+# ("tile0.png", ...) and one per layer.  This reads what is needed to
+# build a Tiled map straight from the archive:
+#
+# - The canvas and tile sizes.
+# - The gids for every layer, bottom layer first (PyxelEdit numbers
+#   the top layer 0, Tiled draws the first layer at the bottom).
+# - The tileset image, put back together from the tile PNGs.
+def ReadPyxelArchive(inFileName):
+    archive = zipfile.ZipFile(inFileName, "r")
+    try:
+        docData = json.loads(archive.read("docData.json"))
+        canvas = docData["canvas"]
+        tileWidth = canvas["tileWidth"]
+        tileHeight = canvas["tileHeight"]
+        tilesWide = canvas["width"] // tileWidth
+        tilesHigh = canvas["height"] // tileHeight
+        layerCount = canvas["numLayers"]
+        layers = []
+        for layerIdx in reversed(xrange(layerCount)):
+            layer = canvas["layers"][str(layerIdx)]
+            tileRefs = layer["tileRefs"]
+            tiles = numpy.empty(tilesWide * tilesHigh, dtype=numpy.int64)
+            tiles.fill(-1)
+            rots = numpy.zeros(tilesWide * tilesHigh, dtype=numpy.intp)
+            flipXs = numpy.zeros(tilesWide * tilesHigh, dtype=bool)
+            if len(tileRefs) > 0:
+                cells = numpy.array([int(cell) for cell in tileRefs], dtype=numpy.intp)
+                refs = tileRefs.values()
+                tiles[cells] = [ref["index"] for ref in refs]
+                rots[cells] = [ref.get("rot", 0) for ref in refs]
+                flipXs[cells] = [ref.get("flipX", False) for ref in refs]
+            layers.append((layer["name"], CalculateGIDs(tiles, rots, flipXs)))
+
+        tileset = docData["tileset"]
+        tileCount = tileset["numTiles"]
+        tilesetWide = tileset["tilesWide"]
+        tilesetHigh = int(math.ceil(tileCount * 1.0 / tilesetWide))
+        tilesetImage = Image.new("RGBA", (tilesetWide * tileWidth, tilesetHigh * tileHeight), (0, 0, 0, 0))
+        for tileIdx in xrange(tileCount):
+            tileImage = Image.open(StringIO(archive.read("tile%d.png" % tileIdx)))
+            tilesetImage.paste(tileImage, ((tileIdx % tilesetWide) * tileWidth,
+                                           (tileIdx // tilesetWide) * tileHeight))
+    finally:
+        archive.close()
+    return {
+        "tilesWide": tilesWide,
+        "tilesHigh": tilesHigh,
+        "tileWidth": tileWidth,
+        "tileHeight": tileHeight,
+        "layers": layers,
+        "tileset": tilesetImage,
+    }
+
+# Convert a .pyxel file straight to a Tiled map, without exporting
+# it to XML first.  The tileset image is written out next to the map
+# (or to tileSetName) since Tiled needs it as a separate file.
+def PyxelArchiveToTiled(inFileName, outFileName, tileSetName=None, overwrite=False,
+                        encoding="csv", compression=None):
+    if encoding not in LAYER_ENCODINGS:
+        print "Unknown layer encoding %s, expected one of %s." % (encoding, LAYER_ENCODINGS)
+        return False
+    if os.path.exists(outFileName) and not overwrite:
+        print "File %s already exists...NOT OVERWRITING!"%outFileName
+        print "NOTHING DONE!!!"
+        return False
+    if tileSetName is None:
+        tileSetName = os.path.splitext(outFileName)[0] + ".png"
+    pyxel = ReadPyxelArchive(inFileName)
+    tilesetImage = pyxel["tileset"]
+    tilesetImage.save(tileSetName, "PNG")
+    imgWidth, imgHeight = tilesetImage.size
 
+    outFile = open(outFileName, "w")
+    try:
+        WriteTiledMapHeader(outFile, outFileName, pyxel["tilesWide"], pyxel["tilesHigh"],
+                            pyxel["tileWidth"], pyxel["tileHeight"], tileSetName, imgWidth, imgHeight)
+        for name, gids in pyxel["layers"]:
+            WriteTiledLayer(outFile, name, gids, pyxel["tilesWide"], pyxel["tilesHigh"], encoding, compression)
+        WriteTiledMapFooter(outFile)
+    finally:
+        outFile.close()
+    return True
 
 
-PyxelEditToTiled(INPUT_XML_FILE, INPUT_TILESET_FILE, OUTPUT_XML_FILE)
+if __name__ == "__main__":
+    PyxelEditToTiled(INPUT_XML_FILE, INPUT_TILESET_FILE, OUTPUT_XML_FILE)
 
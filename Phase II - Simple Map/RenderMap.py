@@ -0,0 +1,568 @@
+"""
+This python script renders a map to an image: a full size preview of
+the ship (like "Spaceship 3 Image.png", which was made by hand) or a
+small minimap, with the rooms and game objects drawn over it if
+wanted.
+
+Pasting each tile with PIL (like ExtractSubimages.CreateTileSet) makes
+a Python call per tile per layer, which is far too slow for the big
+maps.  Instead, the whole layer is done with numpy:
+
+1. The tileset images are cut into one array of tiles, indexed by gid
+   (gid 0, "no tile", is a transparent tile) and scaled down to the
+   size the tiles are drawn at.  Each tile is marked as empty, opaque
+   or needing to be blended, from its alpha.
+2. The gids of the layers (ChunkedMapData.layerGIDs, or rebuilt from
+   MapData.layerDict) are put side by side, giving the stack of tiles
+   in each cell.  A map repeats the same few stacks (floor, floor and
+   a wall, ...) over and over, so only the distinct stacks are drawn.
+3. A stack is drawn by using its gids as an index into the tiles,
+   which gathers the pixels of all the stacks for a layer in one
+   operation.  Opaque tiles (like the floor) are copied and only the
+   rest are blended ("over"), in floating point.
+4. The flip flags are the top three bits of the gid.  The tiles are
+   flipped once for each of the (at most 8) combinations of flags the
+   map uses and each cell gathers from the flipped set it needs.
+5. The drawn stacks are gathered again, into the cells of the image.
+   The layers are drawn in the order of MapData.EXPECTED_LAYERS.
+
+This is done for a band of map rows at a time (CHUNK_BYTES of pixels)
+so the memory used, other than the image, does not grow with the map.
+
+NOTE:
+1.  Tiled flips the tile on the diagonal first (swapping x and y),
+    then horizontally and then vertically.  Diagonal flips only make
+    sense for square tiles.
+2.  A minimap is drawn with small tiles (down to one pixel per tile,
+    the average color of the tile).  If the map is still too big,
+    the image is resized down after that.
+3.  The object overlay colors each cell of the Objects layer by its
+    OBJECT_TYPE, so it works for ChunkedMapData without building the
+    game objects.
+
+Usage:
+    python RenderMap.py [map.tmx] [--output FILE] [--minimap FILE]
+                        [--minimap-size N] [--scale S] [--max-size N]
+                        [--rooms] [--objects] [--layers ...] [--compare]
+                        [--reference FILE]
+"""
+
+import argparse
+import colorsys
+import os
+import time
+
+import numpy
+from lxml import etree
+from PIL import Image, ImageDraw
+
+from CreateMapData import MapData
+from TilesetCache import GetTilesetCache
+
+# How a tile is drawn: not at all, copied over what is below it or
+# blended with it.
+TILE_EMPTY = 0
+TILE_OPAQUE = 1
+TILE_BLENDED = 2
+# The flip flags, shifted down to the bottom three bits.
+FLIP_HORIZONTAL = 0x4
+FLIP_VERTICAL = 0x2
+FLIP_DIAGONAL = 0x1
+FLIP_SHIFT = 29
+# The most memory (in bytes) the pixels gathered at a time may take.
+CHUNK_BYTES = 64 * 1024 * 1024
+# Below this many pixels a tile (e.g. for a minimap), finding the
+# distinct stacks is more work than drawing every cell.
+DISTINCT_STACK_PIXELS = 16
+DEFAULT_MINIMAP_SIZE = 256
+# The largest preview (in pixels, either way) that is drawn at full
+# size.  Bigger maps are drawn with smaller tiles.
+DEFAULT_MAX_PREVIEW_SIZE = 4096
+DEFAULT_BACKGROUND = (0, 0, 0, 0)
+ROOM_FILL = (64, 160, 255, 40)
+ROOM_OUTLINE = (64, 160, 255, 255)
+ROOM_LABEL = (16, 48, 112, 255)
+OBJECT_ALPHA = 110
+# The layers that are drawn by default.  Use_Markers and Blocked are
+# for the game, not to be seen.
+PREVIEW_LAYERS = ["Floor", "Walls", "Objects", "Doors", "Door_Activators"]
+
+
+# Read the <tileset> elements of a .tmx file, stopping at the first
+# layer so the (big) layer data is not parsed.  The tilesets (embedded
+# or .tsx files) come from the shared TilesetCache.  Each is returned
+# as a dictionary, with the image file name made relative to the
+# file the tileset is in.
+def ReadTilesets(fileName):
+    tilesets = []
+    mapDir = os.path.dirname(os.path.abspath(fileName))
+    for event, element in etree.iterparse(fileName, events=("end",)):
+        if element.tag == "layer":
+            break
+        if element.tag != "tileset":
+            continue
+        info, tilesetDir = GetTilesetCache().GetTileset(element, mapDir)
+        if info is None:
+            continue
+        if info.imageSource is None:
+            print "Tileset %s has no image; not drawn." % info.name
+            continue
+        tilesets.append({
+            "firstGID": int(element.attrib['firstgid']),
+            "name": info.name,
+            "tileWidth": info.tileWidth,
+            "tileHeight": info.tileHeight,
+            "margin": info.margin,
+            "spacing": info.spacing,
+            "imageFileName": os.path.join(tilesetDir, info.imageSource),
+        })
+    return tilesets
+
+
+# Cut a tileset image into an array of tiles, shape (count, tileHeight,
+# tileWidth, 4), in the order Tiled numbers them.
+def LoadTilesetTiles(tileset):
+    sheet = numpy.asarray(Image.open(tileset["imageFileName"]).convert("RGBA"))
+    tileWidth, tileHeight = tileset["tileWidth"], tileset["tileHeight"]
+    margin, spacing = tileset["margin"], tileset["spacing"]
+    columns = (sheet.shape[1] - 2 * margin + spacing) // (tileWidth + spacing)
+    rows = (sheet.shape[0] - 2 * margin + spacing) // (tileHeight + spacing)
+    ys = margin + numpy.arange(rows)[:, None] * (tileHeight + spacing) + numpy.arange(tileHeight)[None, :]
+    xs = margin + numpy.arange(columns)[:, None] * (tileWidth + spacing) + numpy.arange(tileWidth)[None, :]
+    tiles = sheet[ys[:, None, :, None], xs[None, :, None, :]]
+    return tiles.reshape(rows * columns, tileHeight, tileWidth, 4)
+
+
+# Scale tiles to the size they are drawn at.  When the size divides
+# the tile size, the pixels are averaged in blocks (with the colors
+# weighted by alpha, so transparent pixels do not darken the result);
+# otherwise each tile is resized with PIL.
+def ScaleTiles(tiles, tileWidth, tileHeight):
+    count, height, width = tiles.shape[:3]
+    if (width, height) == (tileWidth, tileHeight):
+        return tiles
+    if width % tileWidth != 0 or height % tileHeight != 0:
+        scaled = numpy.empty((count, tileHeight, tileWidth, 4), dtype=numpy.uint8)
+        for idx in xrange(count):
+            tile = Image.fromarray(numpy.ascontiguousarray(tiles[idx]), "RGBA")
+            scaled[idx] = numpy.asarray(tile.resize((tileWidth, tileHeight), Image.ANTIALIAS))
+        return scaled
+    blockX, blockY = width // tileWidth, height // tileHeight
+    blocks = tiles.astype(numpy.float32).reshape(count, tileHeight, blockY, tileWidth, blockX, 4)
+    alpha = blocks[..., 3:].sum(axis=(2, 4))
+    colors = (blocks[..., :3] * blocks[..., 3:]).sum(axis=(2, 4)) / numpy.maximum(alpha, 1e-6)
+    result = numpy.concatenate([colors, alpha / (blockX * blockY)], axis=-1)
+    return numpy.clip(result + 0.5, 0, 255).astype(numpy.uint8)
+
+
+# The distinct rows of gids (stacks of tiles) and, for each row, the
+# index of its stack.  Each layer's gids are numbered and the numbers
+# packed into one integer key per row, which is much quicker to sort
+# than the rows.
+def FindDistinctStacks(gids):
+    keys = numpy.zeros(len(gids), dtype=numpy.int64)
+    radix = 1
+    for layer in xrange(gids.shape[1]):
+        values, codes = numpy.unique(gids[:, layer], return_inverse=True)
+        if radix * len(values) >= 2 ** 62:
+            return numpy.unique(gids, axis=0, return_inverse=True)
+        keys += codes * radix
+        radix *= len(values)
+    keys, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+    return gids[first], inverse
+
+
+# Draw source pixels over destination pixels (both RGBA, straight
+# alpha).  Returns the result as uint8.
+def CompositeOver(source, destination):
+    source = source.astype(numpy.float32)
+    destination = destination.astype(numpy.float32)
+    sourceAlpha = source[..., 3:] / 255.0
+    destinationAlpha = destination[..., 3:] / 255.0 * (1.0 - sourceAlpha)
+    alpha = sourceAlpha + destinationAlpha
+    result = numpy.empty(source.shape, dtype=numpy.float32)
+    result[..., :3] = (source[..., :3] * sourceAlpha + destination[..., :3] * destinationAlpha) / \
+        numpy.maximum(alpha, 1e-6)
+    result[..., 3:] = alpha * 255.0
+    return numpy.clip(result + 0.5, 0, 255).astype(numpy.uint8)
+
+
+# Flip tiles (an array of tiles) by a combination of the flip flags.
+def FlipTiles(tiles, flips):
+    if flips & FLIP_DIAGONAL:
+        tiles = tiles.transpose(0, 2, 1, 3)
+    if flips & FLIP_HORIZONTAL:
+        tiles = tiles[:, :, ::-1]
+    if flips & FLIP_VERTICAL:
+        tiles = tiles[:, ::-1]
+    return numpy.ascontiguousarray(tiles)
+
+
+# The gid arrays of the layers of a map, as {layerName: array of shape
+# (mapHeight, mapWidth)}.  ChunkedMapData (and LoadMapForRendering)
+# already has them; for MapData they are rebuilt from layerDict.
+def GetLayerGIDs(mapData):
+    layerGIDs = getattr(mapData, "layerGIDs", None)
+    if layerGIDs:
+        return layerGIDs
+    layerGIDs = {}
+    for layerName, tileData in mapData.layerDict.iteritems():
+        gids = numpy.zeros(mapData.mapWidth * mapData.mapHeight, dtype=numpy.uint32)
+        for idx, tileID, cellX, cellY, topLeft, botRight, flipX, flipY, flipD in tileData.itervalues():
+            gid = tileID
+            if flipX:
+                gid |= MapData.FLIPPED_HORIZONTALLY_FLAG
+            if flipY:
+                gid |= MapData.FLIPPED_VERTICALLY_FLAG
+            if flipD:
+                gid |= MapData.FLIPPED_DIAGONALLY_FLAG
+            gids[idx] = gid
+        layerGIDs[layerName] = gids.reshape(mapData.mapHeight, mapData.mapWidth)
+    return layerGIDs
+
+
+# Read just what rendering needs from a .tmx file: the map size, the
+# tile types, the rooms and the layers (as gid arrays in layerGIDs).
+# This is much quicker than ParseTMXData, since the cells and game
+# objects are not worked out.
+def LoadMapForRendering(fileName):
+    mapData = MapData()
+    mapData.fileName = fileName
+    mapData.tree = etree.parse(fileName)
+    if not mapData.ExtractMapInfo() or not mapData.ExtractTilesetInformation():
+        return None
+    if not mapData.ExtractRoomBoundsInformation():
+        return None
+    mapData.layerGIDs = {}
+    for layer in mapData.tree.getroot().findall("layer"):
+        data = layer.find("data")
+        gids = mapData.ReadEncodedGIDs(data, data.attrib.get('encoding'), data.attrib.get('compression'),
+                                       asArray=True)
+        if gids is None or len(gids) != mapData.mapWidth * mapData.mapHeight:
+            print "Layer %s could not be read." % layer.attrib['name']
+            return None
+        mapData.layerGIDs[layer.attrib['name']] = gids.reshape(mapData.mapHeight, mapData.mapWidth)
+    mapData.tree = None
+    return mapData
+
+
+class MapRenderer(object):
+    def __init__(self, tilesets):
+        self.tilesets = sorted(tilesets, key=lambda tileset: tileset["firstGID"])
+        self.tileWidth = max(tileset["tileWidth"] for tileset in self.tilesets)
+        self.tileHeight = max(tileset["tileHeight"] for tileset in self.tilesets)
+        # (tileWidth, tileHeight, flips) -> the tiles, indexed by gid.
+        self.tileCache = {}
+        # (tileWidth, tileHeight) -> TILE_EMPTY, TILE_OPAQUE or
+        # TILE_BLENDED for each gid (the same for every flip).
+        self.tileKinds = {}
+
+    @staticmethod
+    def FromTMX(fileName):
+        tilesets = ReadTilesets(fileName)
+        if len(tilesets) == 0:
+            print "No tileset images found in %s." % fileName
+            return None
+        return MapRenderer(tilesets)
+
+    # All the tiles of all the tilesets, indexed by gid and scaled to
+    # the size they are drawn at.  Index 0 is a transparent tile.
+    def GetTiles(self, tileWidth, tileHeight, flips=0):
+        key = (tileWidth, tileHeight, flips)
+        if key in self.tileCache:
+            return self.tileCache[key]
+        if flips != 0:
+            tiles = FlipTiles(self.GetTiles(tileWidth, tileHeight), flips)
+        else:
+            parts = [(0, numpy.zeros((1, tileHeight, tileWidth, 4), dtype=numpy.uint8))]
+            for tileset in self.tilesets:
+                if (tileset["tileWidth"], tileset["tileHeight"]) != (self.tileWidth, self.tileHeight):
+                    print "Tileset %s has a different tile size; not drawn." % tileset["name"]
+                    continue
+                parts.append((tileset["firstGID"],
+                              ScaleTiles(LoadTilesetTiles(tileset), tileWidth, tileHeight)))
+            count = max(firstGID + len(part) for firstGID, part in parts)
+            tiles = numpy.zeros((count, tileHeight, tileWidth, 4), dtype=numpy.uint8)
+            for firstGID, part in parts:
+                tiles[firstGID:firstGID + len(part)] = part
+        self.tileCache[key] = tiles
+        return tiles
+
+    # How each tile (by gid) is drawn, from its alpha.
+    def GetTileKinds(self, tileWidth, tileHeight):
+        key = (tileWidth, tileHeight)
+        if key not in self.tileKinds:
+            alpha = self.GetTiles(tileWidth, tileHeight)[..., 3].reshape(-1, tileWidth * tileHeight)
+            kinds = numpy.empty(len(alpha), dtype=numpy.uint8)
+            kinds[:] = TILE_BLENDED
+            kinds[alpha.min(axis=1) == 255] = TILE_OPAQUE
+            kinds[alpha.max(axis=1) == 0] = TILE_EMPTY
+            self.tileKinds[key] = kinds
+        return self.tileKinds[key]
+
+    # The pixels of the tiles for a list of gids, with the flips
+    # applied.  The result has the shape (len(gids), tileHeight,
+    # tileWidth, 4).
+    def GatherTiles(self, gids, tileWidth, tileHeight):
+        tiles = self.GetTiles(tileWidth, tileHeight)
+        localIDs = gids & MapData.GID_MASK
+        localIDs[localIDs >= len(tiles)] = 0
+        flips = gids >> FLIP_SHIFT
+        usedFlips = numpy.unique(flips)
+        if len(usedFlips) == 1 and usedFlips[0] == 0:
+            return tiles[localIDs]
+        result = numpy.empty((len(gids),) + tiles.shape[1:], dtype=numpy.uint8)
+        for flip in usedFlips:
+            mask = flips == flip
+            result[mask] = self.GetTiles(tileWidth, tileHeight, int(flip))[localIDs[mask]]
+        return result
+
+    # Draw stacks of tiles: one cell for each row of gids (one gid per
+    # layer, bottom first).  Returns the pixels, shape (len(stacks),
+    # tileHeight, tileWidth, 4).
+    def CompositeStacks(self, stacks, tileWidth, tileHeight, background=DEFAULT_BACKGROUND):
+        cells = numpy.empty((len(stacks), tileHeight, tileWidth, 4), dtype=numpy.uint8)
+        cells[:] = background
+        kinds = self.GetTileKinds(tileWidth, tileHeight)
+        for layer in xrange(stacks.shape[1]):
+            gids = stacks[:, layer]
+            localIDs = gids & MapData.GID_MASK
+            localIDs[localIDs >= len(kinds)] = 0
+            gidKinds = kinds[localIDs]
+            opaque = numpy.flatnonzero(gidKinds == TILE_OPAQUE)
+            if len(opaque) > 0:
+                cells[opaque] = self.GatherTiles(gids[opaque], tileWidth, tileHeight)
+            blended = numpy.flatnonzero(gidKinds == TILE_BLENDED)
+            if len(blended) > 0:
+                cells[blended] = CompositeOver(self.GatherTiles(gids[blended], tileWidth, tileHeight),
+                                               cells[blended])
+        return cells
+
+    # Draw the layers (a list of gid arrays, bottom first) to an RGBA
+    # image array with the given size of tile.  A band of map rows at
+    # a time, each distinct stack of tiles in the band is drawn once
+    # and then gathered into the cells it is used in.
+    def RenderLayers(self, layers, tileWidth, tileHeight, background=DEFAULT_BACKGROUND):
+        mapHeight, mapWidth = layers[0].shape
+        image = numpy.empty((mapHeight * tileHeight, mapWidth * tileWidth, 4), dtype=numpy.uint8)
+        kinds = self.GetTileKinds(tileWidth, tileHeight)
+        bandRows = max(1, CHUNK_BYTES // (mapWidth * tileWidth * tileHeight * 4))
+        for row in xrange(0, mapHeight, bandRows):
+            rows = min(bandRows, mapHeight - row)
+            gids = numpy.empty((rows * mapWidth, len(layers)), dtype=numpy.uint32)
+            for idx, layer in enumerate(layers):
+                gids[:, idx] = numpy.asarray(layer[row:row + rows]).ravel()
+            # Tiles that draw nothing should not make stacks different.
+            localIDs = gids & MapData.GID_MASK
+            localIDs[localIDs >= len(kinds)] = 0
+            gids[kinds[localIDs] == TILE_EMPTY] = 0
+            if tileWidth * tileHeight < DISTINCT_STACK_PIXELS:
+                cells = self.CompositeStacks(gids, tileWidth, tileHeight, background)
+            else:
+                stacks, inverse = FindDistinctStacks(gids)
+                cells = self.CompositeStacks(stacks, tileWidth, tileHeight, background)[inverse]
+            image[row * tileHeight:(row + rows) * tileHeight] = cells.reshape(
+                rows, mapWidth, tileHeight, tileWidth, 4).swapaxes(1, 2).reshape(
+                rows * tileHeight, mapWidth * tileWidth, 4)
+        return image
+
+    # Draw a map to a PIL image.  With scale < 1, the tiles are drawn
+    # smaller (down to one pixel).
+    def RenderMap(self, mapData, layerNames=PREVIEW_LAYERS, scale=1.0, rooms=False, objects=False,
+                  background=DEFAULT_BACKGROUND):
+        layerGIDs = GetLayerGIDs(mapData)
+        layers = [layerGIDs[layerName] for layerName in layerNames if layerName in layerGIDs]
+        if len(layers) == 0:
+            print "None of the layers %s are in the map." % layerNames
+            return None
+        tileWidth = max(1, int(round(self.tileWidth * scale)))
+        tileHeight = max(1, int(round(self.tileHeight * scale)))
+        image = Image.fromarray(self.RenderLayers(layers, tileWidth, tileHeight, background), "RGBA")
+        if objects and "Objects" in layerGIDs:
+            image = DrawObjectOverlay(image, layerGIDs["Objects"], mapData)
+        if rooms:
+            DrawRoomOverlay(image, mapData.roomInfoDict, tileWidth * 1.0 / mapData.tileWidth,
+                            tileHeight * 1.0 / mapData.tileHeight)
+        return image
+
+    # Draw a minimap that fits in size x size pixels.
+    def RenderMinimap(self, mapData, size=DEFAULT_MINIMAP_SIZE, layerNames=PREVIEW_LAYERS, rooms=False,
+                      objects=False, background=DEFAULT_BACKGROUND):
+        tileSize = max(1, size // max(mapData.mapWidth, mapData.mapHeight))
+        scale = min(tileSize * 1.0 / self.tileWidth, tileSize * 1.0 / self.tileHeight)
+        image = self.RenderMap(mapData, layerNames, scale, False, objects, background)
+        if image is None:
+            return None
+        if max(image.size) > size:
+            factor = size * 1.0 / max(image.size)
+            image = image.resize((max(1, int(image.size[0] * factor)), max(1, int(image.size[1] * factor))),
+                                 Image.ANTIALIAS)
+        if rooms:
+            DrawRoomOverlay(image, mapData.roomInfoDict, image.size[0] * 1.0 / (mapData.mapWidth * mapData.tileWidth),
+                            image.size[1] * 1.0 / (mapData.mapHeight * mapData.tileHeight), labels=False)
+        return image
+
+
+# Draw the room bounds (and names) over the image.  The scale takes
+# map pixels to image pixels.
+def DrawRoomOverlay(image, roomInfoDict, scaleX, scaleY, labels=True):
+    overlay = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    for roomName in sorted(roomInfoDict):
+        (x1, y1), (x2, y2) = roomInfoDict[roomName]['Bounds']
+        box = [int(x1 * scaleX), int(y1 * scaleY), int(x2 * scaleX) - 1, int(y2 * scaleY) - 1]
+        draw.rectangle(box, fill=ROOM_FILL, outline=ROOM_OUTLINE)
+        if labels:
+            draw.text((box[0] + 3, box[1] + 2), roomName, fill=ROOM_LABEL)
+    image.paste(Image.alpha_composite(image, overlay))
+    return image
+
+
+# A color for each OBJECT_TYPE code (see MapData.gidTypeCodes), spread
+# around the color wheel.  Code 0 (no type) is transparent.
+def CreateObjectTypeColors(objectTypeNames):
+    colors = numpy.zeros((len(objectTypeNames), 4), dtype=numpy.uint8)
+    for code in xrange(1, len(objectTypeNames)):
+        red, green, blue = colorsys.hsv_to_rgb((code - 1) * 1.0 / (len(objectTypeNames) - 1), 0.8, 1.0)
+        colors[code] = (int(red * 255), int(green * 255), int(blue * 255), OBJECT_ALPHA)
+    return colors
+
+
+# Tint each cell of the Objects layer by its OBJECT_TYPE.  The tint is
+# worked out per cell from the type codes of the gids and then
+# stretched to the image.
+def DrawObjectOverlay(image, objectGIDs, mapData):
+    colors = CreateObjectTypeColors(mapData.objectTypeNames)
+    tint = Image.fromarray(colors[mapData.GetObjectTypeCodes(objectGIDs)], "RGBA")
+    return Image.alpha_composite(image, tint.resize(image.size, Image.NEAREST))
+
+
+# The simple way: paste one tile at a time with PIL.  Only used to
+# check (and time) RenderMap.
+def RenderMapNaive(mapData, tilesets, layerNames=PREVIEW_LAYERS, background=DEFAULT_BACKGROUND):
+    layerGIDs = GetLayerGIDs(mapData)
+    tileImages = {}
+    for tileset in tilesets:
+        tiles = LoadTilesetTiles(tileset)
+        for idx in xrange(len(tiles)):
+            tileImages[tileset["firstGID"] + idx] = Image.fromarray(tiles[idx], "RGBA")
+    tileWidth, tileHeight = tilesets[0]["tileWidth"], tilesets[0]["tileHeight"]
+    image = Image.new("RGBA", (mapData.mapWidth * tileWidth, mapData.mapHeight * tileHeight), background)
+    for layerName in layerNames:
+        if layerName not in layerGIDs:
+            continue
+        layer = layerGIDs[layerName]
+        for cellY in xrange(mapData.mapHeight):
+            for cellX in xrange(mapData.mapWidth):
+                gid = int(layer[cellY, cellX])
+                tile = tileImages.get(gid & MapData.GID_MASK)
+                if tile is None:
+                    continue
+                flips = gid >> FLIP_SHIFT
+                if flips & FLIP_DIAGONAL:
+                    tile = tile.transpose(Image.TRANSPOSE)
+                if flips & FLIP_HORIZONTAL:
+                    tile = tile.transpose(Image.FLIP_LEFT_RIGHT)
+                if flips & FLIP_VERTICAL:
+                    tile = tile.transpose(Image.FLIP_TOP_BOTTOM)
+                image.alpha_composite(tile, (cellX * tileWidth, cellY * tileHeight))
+    return image
+
+
+# The largest difference between two images, per channel, over the
+# pixels that are not fully transparent in both.
+def CompareImages(image, other):
+    if image.size != other.size:
+        print "Image sizes differ: %s and %s." % (image.size, other.size)
+        return None
+    first = numpy.asarray(image.convert("RGBA"))
+    second = numpy.asarray(other.convert("RGBA"))
+    largest = 0
+    bandRows = max(1, CHUNK_BYTES // (first.shape[1] * 4 * 2))
+    for row in xrange(0, first.shape[0], bandRows):
+        firstBand = first[row:row + bandRows].astype(numpy.int16)
+        secondBand = second[row:row + bandRows].astype(numpy.int16)
+        visible = (firstBand[..., 3] > 0) | (secondBand[..., 3] > 0)
+        if visible.any():
+            largest = max(largest, int(numpy.abs(firstBand - secondBand)[visible].max()))
+    return largest
+
+
+# The scale to draw a preview at: scale, or less if the preview would
+# be bigger than maxSize.  The tiles are drawn a whole number of pixels
+# wide, so the largest tile that fits is worked out first.
+def GetPreviewScale(mapData, renderer, scale=1.0, maxSize=DEFAULT_MAX_PREVIEW_SIZE):
+    tileWidth = max(1, maxSize // mapData.mapWidth)
+    tileHeight = max(1, maxSize // mapData.mapHeight)
+    return min(scale, tileWidth * 1.0 / renderer.tileWidth, tileHeight * 1.0 / renderer.tileHeight)
+
+
+# Render the preview (and minimap) of a .tmx file.  This is what
+# BuildMaps runs for every map.  A preview bigger than maxSize is drawn
+# with smaller tiles.
+def RenderTMX(fileName, outputFileName, minimapFileName=None, minimapSize=DEFAULT_MINIMAP_SIZE,
+              layerNames=PREVIEW_LAYERS, rooms=False, objects=False, maxSize=DEFAULT_MAX_PREVIEW_SIZE):
+    mapData = LoadMapForRendering(fileName)
+    renderer = MapRenderer.FromTMX(fileName)
+    if mapData is None or renderer is None:
+        return False
+    scale = GetPreviewScale(mapData, renderer, 1.0, maxSize)
+    image = renderer.RenderMap(mapData, layerNames, scale, rooms, objects)
+    if image is None:
+        return False
+    image.save(outputFileName)
+    if minimapFileName is not None:
+        renderer.RenderMinimap(mapData, minimapSize, layerNames, rooms, objects).save(minimapFileName)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render a map to a preview image.")
+    parser.add_argument("fileName", nargs="?", default="Spaceship 3.tmx")
+    parser.add_argument("--output", default=None, help="Preview image (default: <map> Preview.png).")
+    parser.add_argument("--minimap", default=None, help="Also write a minimap to this file.")
+    parser.add_argument("--minimap-size", type=int, default=DEFAULT_MINIMAP_SIZE)
+    parser.add_argument("--scale", type=float, default=1.0, help="Draw the preview at this scale.")
+    parser.add_argument("--max-size", type=int, default=DEFAULT_MAX_PREVIEW_SIZE,
+                        help="Draw the preview smaller if it would be more pixels than this either way.")
+    parser.add_argument("--layers", nargs="+", default=PREVIEW_LAYERS)
+    parser.add_argument("--rooms", action="store_true", help="Draw the rooms over the map.")
+    parser.add_argument("--objects", action="store_true", help="Tint the game objects by type.")
+    parser.add_argument("--compare", action="store_true",
+                        help="Also render with PIL, one tile at a time, and compare.")
+    parser.add_argument("--reference", default=None, help="Compare the preview with this image.")
+    args = parser.parse_args()
+    outputFileName = args.output
+    if outputFileName is None:
+        outputFileName = os.path.splitext(args.fileName)[0] + " Preview.png"
+
+    start = time.time()
+    mapData = LoadMapForRendering(args.fileName)
+    renderer = MapRenderer.FromTMX(args.fileName)
+    if mapData is None or renderer is None:
+        raise SystemExit(1)
+    loadSeconds = time.time() - start
+    start = time.time()
+    scale = GetPreviewScale(mapData, renderer, args.scale, args.max_size)
+    image = renderer.RenderMap(mapData, args.layers, scale, args.rooms, args.objects)
+    renderSeconds = time.time() - start
+    image.save(outputFileName)
+    print "Map %d x %d loaded in %.3f s, %d x %d preview drawn in %.3f s: %s" % (
+        mapData.mapWidth, mapData.mapHeight, loadSeconds, image.size[0], image.size[1],
+        renderSeconds, outputFileName)
+    if args.minimap is not None:
+        start = time.time()
+        minimap = renderer.RenderMinimap(mapData, args.minimap_size, args.layers, args.rooms, args.objects)
+        minimap.save(args.minimap)
+        print "%d x %d minimap drawn in %.3f s: %s" % (minimap.size[0], minimap.size[1],
+                                                      time.time() - start, args.minimap)
+    if args.compare:
+        start = time.time()
+        naive = RenderMapNaive(mapData, renderer.tilesets, args.layers)
+        naiveSeconds = time.time() - start
+        plain = renderer.RenderMap(mapData, args.layers)
+        print "One tile at a time with PIL: %.3f s (%.1fx slower); largest difference %s" % (
+            naiveSeconds, naiveSeconds / max(renderSeconds, 1e-6), CompareImages(plain, naive))
+    if args.reference is not None:
+        print "Largest difference from %s: %s" % (args.reference,
+                                                  CompareImages(image, Image.open(args.reference)))
@@ -0,0 +1,227 @@
+"""
+This python script packs a list of sprites (of any size) into a
+texture atlas and writes a manifest of where each sprite ended up.
+
+1. Each sprite is trimmed down to the box around its non-transparent
+   pixels.  The offset of the box is kept so the sprite can be drawn
+   in the right place.
+2. Sprites with exactly the same (trimmed) pixels are only put in
+   the atlas once.  Every name still gets an entry in the manifest,
+   pointing at the shared pixels.
+3. The trimmed sprites are packed with a "skyline" bin packer (tallest
+   first), into the smallest atlas that fits them.
+
+The manifest is a Cocos2d-X sprite frame .plist (format 2) so it can
+be loaded straight into the SpriteFrameCache.
+
+NOTE:
+1.  The origin in Cocos2d-X is the BOTTOM LEFT, so the "offset" in the
+    manifest has the y axis pointing up.  Everything else (frames,
+    source color rects) uses the image (TOP LEFT) origin, which is
+    what Cocos2d-X expects in the .plist.
+"""
+
+import hashlib
+import math
+import os
+import plistlib
+
+from PIL import Image
+
+DEFAULT_PADDING = 1
+DEFAULT_MAX_SIZE = 4096
+
+
+def NextPowerOfTwo(value):
+    return int(math.pow(2, math.ceil(math.log(max(value, 1), 2))))
+
+
+# Packs rectangles into a fixed size bin.  The top edge of everything
+# packed so far is kept as a list of [x, y, width] segments (the
+# "skyline").  Each new rectangle goes where its bottom edge is the
+# lowest (and then left-most).
+class SkylinePacker(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.skyline = [[0, 0, width]]
+
+    # Where the rectangle would go if it started at segment index.
+    # Returns the y it would sit at, or None if it does not fit.
+    def FitAt(self, index, width, height):
+        x = self.skyline[index][0]
+        if x + width > self.width:
+            return None
+        y = 0
+        widthLeft = width
+        while widthLeft > 0:
+            if index >= len(self.skyline):
+                return None
+            segX, segY, segWidth = self.skyline[index]
+            y = max(y, segY)
+            if y + height > self.height:
+                return None
+            widthLeft -= segWidth
+            index += 1
+        return y
+
+    # Find a spot for the rectangle and add it to the skyline.
+    # Returns (x, y) or None if there is no room left.
+    def Insert(self, width, height):
+        best = None
+        for index in xrange(len(self.skyline)):
+            y = self.FitAt(index, width, height)
+            if y is None:
+                continue
+            key = (y + height, self.skyline[index][0])
+            if best is None or key < best[0]:
+                best = (key, index, y)
+        if best is None:
+            return None
+        key, index, y = best
+        x = self.skyline[index][0]
+        self.AddSegment(index, x, y + height, width)
+        return (x, y)
+
+    def AddSegment(self, index, x, y, width):
+        self.skyline.insert(index, [x, y, width])
+        # Shrink or remove the segments that are now covered.
+        end = x + width
+        index += 1
+        while index < len(self.skyline):
+            segment = self.skyline[index]
+            if segment[0] >= end:
+                break
+            overlap = end - segment[0]
+            if overlap >= segment[2]:
+                del self.skyline[index]
+                continue
+            segment[0] += overlap
+            segment[2] -= overlap
+            break
+        # Join neighbors at the same height.
+        index = 0
+        while index < len(self.skyline) - 1:
+            if self.skyline[index][1] == self.skyline[index + 1][1]:
+                self.skyline[index][2] += self.skyline[index + 1][2]
+                del self.skyline[index + 1]
+            else:
+                index += 1
+
+    def UsedHeight(self):
+        return max(segY for segX, segY, segWidth in self.skyline)
+
+
+# Pack a list of (width, height) sizes.  Returns the atlas size and a
+# list of (x, y) positions (in the same order as sizes), or None if
+# they do not fit in maxSize x maxSize.
+def PackSizes(sizes, padding=DEFAULT_PADDING, powerOfTwo=True, maxSize=DEFAULT_MAX_SIZE):
+    if len(sizes) == 0:
+        return (1, 1), []
+    padded = [(width + padding, height + padding) for width, height in sizes]
+    # Tallest first (then widest) packs well with a skyline.
+    order = sorted(xrange(len(padded)), key=lambda idx: (-padded[idx][1], -padded[idx][0]))
+    area = sum(width * height for width, height in padded)
+    minWidth = max(width for width, height in padded)
+    minHeight = max(height for width, height in padded)
+    if powerOfTwo:
+        candidates = []
+        width = NextPowerOfTwo(minWidth)
+        while width <= maxSize:
+            height = NextPowerOfTwo(minHeight)
+            while height <= maxSize:
+                if width * height >= area:
+                    candidates.append((width * height, max(width, height), width, height))
+                height *= 2
+            width *= 2
+        candidates.sort()
+        candidates = [(width, height) for areaOf, side, width, height in candidates]
+    else:
+        width = max(minWidth, int(math.ceil(math.sqrt(area))))
+        candidates = [(min(width, maxSize), maxSize)]
+    for width, height in candidates:
+        packer = SkylinePacker(width, height)
+        positions = [None] * len(padded)
+        for idx in order:
+            position = packer.Insert(padded[idx][0], padded[idx][1])
+            if position is None:
+                break
+            positions[idx] = position
+        else:
+            if not powerOfTwo:
+                height = packer.UsedHeight()
+            return (width, height), positions
+    return None
+
+
+# Trim off the transparent border of an image.  Returns the trimmed
+# image and the box it came from in the original.
+def TrimImage(image):
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    box = image.split()[-1].getbbox()
+    if box is None:
+        # Nothing visible at all; keep a single (transparent) pixel.
+        box = (0, 0, 1, 1)
+    return image.crop(box), box
+
+
+def ImageHash(image):
+    return hashlib.sha1("%s%s%s" % (image.mode, image.size, image.tobytes())).hexdigest()
+
+
+# Build the atlas for the images (one name per image), and write the
+# atlas image and the .plist manifest.  Returns the manifest frames.
+def CreateAtlas(imageList, names, fileName, manifestName, imageFormat="PNG",
+                padding=DEFAULT_PADDING, powerOfTwo=True, maxSize=DEFAULT_MAX_SIZE):
+    # Trim and find the duplicates.
+    uniqueImages = []
+    uniqueIndex = {}
+    sprites = []
+    for image in imageList:
+        trimmed, box = TrimImage(image)
+        key = ImageHash(trimmed)
+        if key not in uniqueIndex:
+            uniqueIndex[key] = len(uniqueImages)
+            uniqueImages.append(trimmed)
+        sprites.append((uniqueIndex[key], box, image.size))
+    print "Sprites = %d, unique = %d" % (len(sprites), len(uniqueImages))
+
+    packed = PackSizes([image.size for image in uniqueImages], padding, powerOfTwo, maxSize)
+    if packed is None:
+        print "Unable to fit %d sprites in a %d x %d atlas." % (len(uniqueImages), maxSize, maxSize)
+        return None
+    (atlasWidth, atlasHeight), positions = packed
+    print "Creating new image:(%d x %d)" % (atlasWidth, atlasHeight)
+    atlas = Image.new("RGBA", (atlasWidth, atlasHeight), (0, 0, 0, 0))
+    for image, position in zip(uniqueImages, positions):
+        atlas.paste(image, position)
+    print "Saving image file: ", fileName
+    atlas.save(fileName, imageFormat)
+
+    frames = {}
+    for name, (unique, box, sourceSize) in zip(names, sprites):
+        x, y = positions[unique]
+        width, height = uniqueImages[unique].size
+        sourceWidth, sourceHeight = sourceSize
+        offsetX = (box[0] + width / 2.0) - sourceWidth / 2.0
+        offsetY = sourceHeight / 2.0 - (box[1] + height / 2.0)
+        frames[name] = {
+            "frame": "{{%d,%d},{%d,%d}}" % (x, y, width, height),
+            "offset": "{%g,%g}" % (offsetX, offsetY),
+            "rotated": False,
+            "sourceColorRect": "{{%d,%d},{%d,%d}}" % (box[0], box[1], width, height),
+            "sourceSize": "{%d,%d}" % (sourceWidth, sourceHeight),
+        }
+    manifest = {
+        "frames": frames,
+        "metadata": {
+            "format": 2,
+            "realTextureFileName": os.path.basename(fileName),
+            "textureFileName": os.path.basename(fileName),
+            "size": "{%d,%d}" % (atlasWidth, atlasHeight),
+        },
+    }
+    print "Saving manifest file: ", manifestName
+    plistlib.writePlist(manifest, manifestName)
+    return frames
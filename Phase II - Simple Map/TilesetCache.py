@@ -0,0 +1,210 @@
+"""
+A cache of parsed tilesets, shared by all the maps that use them.
+
+Every map made from the Spaceship 3 tileset carries the same <tile>
+property blocks, and MapData used to read them again for each map.
+With the cache, a tileset is parsed once:
+
+1. A tileset is either embedded in the .tmx file or kept in an
+   external .tsx file, which the map refers to with
+   <tileset firstgid="..." source="name.tsx"/>.
+2. A tileset is keyed by the SHA-1 of its XML: the bytes of the .tsx
+   file, or the embedded <tileset> element.  So the same tileset is
+   found again whatever map (or copy of the file) it comes from, and
+   a changed tileset is never mistaken for the old one.
+3. Parsed tilesets are kept in the process (GetTilesetCache).  Parsed
+   .tsx files are also written as JSON to a cache directory
+   ("tilesets.cache" next to the .tsx file, by default), so the
+   worker processes of BuildMaps, and later runs, read the JSON
+   instead of parsing the tileset again.  Embedded tilesets are only
+   kept in memory; they have been parsed with the map anyway.
+4. All the properties of every tile are kept, not just OBJECT_TYPE.
+
+NOTE:
+1.  The image source of a tileset is kept as it is in the XML, so it
+    is relative to the file the tileset is in.  GetTileset returns
+    that directory along with the tileset.
+2.  An embedded tileset is keyed with its firstgid, so the same
+    tileset embedded at a different firstgid is parsed again.
+"""
+
+import hashlib
+import json
+import os
+
+from lxml import etree
+
+TILESET_CACHE_DIR = "tilesets.cache"
+CACHE_VERSION = 1
+OBJECT_TYPE_PROPERTY = "OBJECT_TYPE"
+
+
+class TilesetInfo(object):
+    def __init__(self):
+        self.name = None
+        self.tileWidth = 0
+        self.tileHeight = 0
+        self.tileCount = 0
+        self.columns = 0
+        self.margin = 0
+        self.spacing = 0
+        # The image, relative to the file the tileset is in (None if
+        # the tileset has no single image).
+        self.imageSource = None
+        self.imageWidth = 0
+        self.imageHeight = 0
+        # localID -> {property name: value} for every tile with
+        # properties.
+        self.properties = {}
+
+    # Read a <tileset> element (embedded or the root of a .tsx file).
+    @staticmethod
+    def FromElement(element):
+        info = TilesetInfo()
+        info.name = element.attrib.get('name')
+        info.tileWidth = int(element.attrib.get('tilewidth', 0))
+        info.tileHeight = int(element.attrib.get('tileheight', 0))
+        info.tileCount = int(element.attrib.get('tilecount', 0))
+        info.columns = int(element.attrib.get('columns', 0))
+        info.margin = int(element.attrib.get('margin', 0))
+        info.spacing = int(element.attrib.get('spacing', 0))
+        image = element.find("image")
+        if image is not None:
+            info.imageSource = image.attrib['source']
+            info.imageWidth = int(image.attrib.get('width', 0))
+            info.imageHeight = int(image.attrib.get('height', 0))
+        for tile in element.findall("tile"):
+            properties = {}
+            for property in tile.findall("properties/property"):
+                value = property.attrib.get('value')
+                if value is None:
+                    # Multi-line string properties are kept in the text.
+                    value = property.text or ""
+                properties[property.attrib['name']] = value
+            if len(properties) > 0:
+                info.properties[int(tile.attrib['id'])] = properties
+        return info
+
+    def ToDict(self):
+        data = dict(self.__dict__)
+        data["properties"] = [[localID, properties] for localID, properties in sorted(self.properties.iteritems())]
+        return data
+
+    @staticmethod
+    def FromDict(data):
+        info = TilesetInfo()
+        for key, value in data.iteritems():
+            setattr(info, str(key), value)
+        info.name = None if data["name"] is None else str(data["name"])
+        info.imageSource = None if data["imageSource"] is None else str(data["imageSource"])
+        info.properties = dict((localID, dict((str(name), str(value)) for name, value in properties.iteritems()))
+                               for localID, properties in data["properties"])
+        return info
+
+    def GetObjectType(self, localID):
+        return self.properties.get(localID, {}).get(OBJECT_TYPE_PROPERTY)
+
+
+class TilesetCache(object):
+    # With no cacheDir, the parsed .tsx files are written next to the
+    # file they come from.  With cacheDir False, they are only kept in
+    # memory.
+    def __init__(self, cacheDir=None):
+        self.cacheDir = cacheDir
+        # key -> TilesetInfo
+        self.tilesets = {}
+        # Counters.
+        self.tilesetsParsed = 0
+        self.memoryHits = 0
+        self.diskHits = 0
+
+    def GetCacheDir(self, tilesetDir):
+        if self.cacheDir is None:
+            return os.path.join(tilesetDir, TILESET_CACHE_DIR)
+        return self.cacheDir
+
+    # The parsed tileset for a <tileset> element of a map, as (info,
+    # directory the tileset is in).  baseDir is the directory of the
+    # map.  Returns (None, None) if an external tileset is missing.
+    def GetTileset(self, element, baseDir):
+        source = element.attrib.get('source')
+        if source is not None:
+            fileName = os.path.join(baseDir, source)
+            if not os.path.exists(fileName):
+                print "Tileset file %s does not exist!!!" % fileName
+                return None, None
+            with open(fileName, "rb") as tilesetFile:
+                data = tilesetFile.read()
+            tilesetDir = os.path.dirname(os.path.abspath(fileName))
+            parse = lambda: TilesetInfo.FromElement(etree.fromstring(data))
+            onDisk = self.cacheDir is not False
+        else:
+            data = etree.tostring(element, with_tail=False)
+            tilesetDir = os.path.abspath(baseDir)
+            parse = lambda: TilesetInfo.FromElement(element)
+            onDisk = False
+        key = hashlib.sha1(data).hexdigest()
+        cacheName = os.path.join(self.GetCacheDir(tilesetDir), key + ".json") if onDisk else None
+        return self.Lookup(key, cacheName, parse), tilesetDir
+
+    # Find a tileset in memory, then on disk (if cacheName is not None),
+    # and only then parse it.
+    def Lookup(self, key, cacheName, parse):
+        info = self.tilesets.get(key)
+        if info is not None:
+            self.memoryHits += 1
+            return info
+        if cacheName is not None and os.path.exists(cacheName):
+            try:
+                with open(cacheName) as cacheFile:
+                    data = json.load(cacheFile)
+                if data.get("version") == CACHE_VERSION:
+                    info = TilesetInfo.FromDict(data["tileset"])
+                    self.diskHits += 1
+            except (IOError, ValueError, KeyError):
+                info = None
+        if info is None:
+            info = parse()
+            self.tilesetsParsed += 1
+            if cacheName is not None:
+                self.SaveTileset(cacheName, info)
+        self.tilesets[key] = info
+        return info
+
+    # Write the tileset to a temporary file and rename it, so another
+    # process never reads half a file.
+    def SaveTileset(self, cacheName, info):
+        try:
+            cacheDir = os.path.dirname(cacheName)
+            if not os.path.exists(cacheDir):
+                try:
+                    os.makedirs(cacheDir)
+                except OSError:
+                    # Another process may have just made it.
+                    if not os.path.isdir(cacheDir):
+                        raise
+            tempName = "%s.%d.tmp" % (cacheName, os.getpid())
+            with open(tempName, "w") as cacheFile:
+                json.dump({"version": CACHE_VERSION, "tileset": info.ToDict()}, cacheFile)
+            os.rename(tempName, cacheName)
+        except (IOError, OSError) as error:
+            print "Unable to write tileset cache %s: %s" % (cacheName, error)
+
+    def Clear(self):
+        self.tilesets = {}
+
+    def GetCacheReport(self):
+        return {
+            "Tilesets": len(self.tilesets),
+            "Tilesets Parsed": self.tilesetsParsed,
+            "Memory Hits": self.memoryHits,
+            "Disk Hits": self.diskHits,
+        }
+
+
+# The cache shared by everything in the process.
+sharedTilesetCache = TilesetCache()
+
+
+def GetTilesetCache():
+    return sharedTilesetCache